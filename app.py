@@ -1,8 +1,12 @@
 import os
 import uuid
 import requests
-from flask import Flask, request, jsonify, render_template, send_file, after_this_request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import http.cookiejar
+from flask import Flask, Response, request, jsonify, render_template, send_file, stream_with_context
 from flask_cors import CORS
+from werkzeug.wsgi import ClosingIterator
 import yt_dlp
 import logging
 import socket
@@ -10,83 +14,762 @@ import re
 import traceback
 import random
 import glob
+import copy
+import urllib.parse
+from collections import OrderedDict, deque, namedtuple
+import fcntl
+import contextlib
+import asyncio
+import subprocess
+import hashlib
+import json
+import math
+import zipfile
+
+import proxy_tester
 
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
-CORS(app)
+CORS(app, expose_headers=['Retry-After'])
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DOWNLOAD_FOLDER = os.path.join(BASE_DIR, 'downloads')
-COOKIES_FILE = os.path.join(BASE_DIR, 'cookies.txt')
+DOWNLOAD_FOLDER = os.environ.get('DOWNLOAD_FOLDER', os.path.join(BASE_DIR, 'downloads'))
+COOKIES_FILE = os.environ.get('COOKIES_FILE', os.path.join(BASE_DIR, 'cookies.txt'))
 PROXY_URL = os.environ.get('PROXY_URL', 'socks5://host.docker.internal:40000')
 
-if not os.path.exists(DOWNLOAD_FOLDER):
-    os.makedirs(DOWNLOAD_FOLDER)
+RESULT_CACHE_DIR = os.path.join(DOWNLOAD_FOLDER, 'cache')
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(2 * 1024**3)))  # 0 disables the cache
+MP3_QUALITY = '192'
+MP4_MAX_HEIGHT = 1080
+
+LOCK_DIR = os.path.join(DOWNLOAD_FOLDER, 'locks')
+COALESCE_WAIT = int(os.environ.get('COALESCE_WAIT', '600'))  # max seconds a follower waits for the leader
+STATE_DIR = os.path.join(DOWNLOAD_FOLDER, 'state')
+
+for d in (DOWNLOAD_FOLDER, RESULT_CACHE_DIR, LOCK_DIR, STATE_DIR):
+    os.makedirs(d, exist_ok=True)
 
 import concurrent.futures
+import queue
+import threading
+import time
 
-def get_residential_proxy():
-    """Fetch and verify free HTTP proxies by confirming they successfully mask the IP."""
-    try:
-        urls = [
-             "https://raw.githubusercontent.com/TheSpeedX/PROXY-List/master/http.txt",
-             "https://raw.githubusercontent.com/TheSpeedX/PROXY-List/master/socks5.txt",
-             "https://raw.githubusercontent.com/ShiftyTR/Proxy-List/master/http.txt",
-             "https://raw.githubusercontent.com/ShiftyTR/Proxy-List/master/socks5.txt",
-             "https://raw.githubusercontent.com/monosans/proxy-list/main/proxies/http.txt",
-             "https://raw.githubusercontent.com/monosans/proxy-list/main/proxies/socks5.txt"
-        ]
-        
-        all_proxies = []
-        for u in urls:
-            try:
-                r = requests.get(u, timeout=10)
-                ptype = "socks5" if "socks5" in u else "http"
-                all_proxies.extend([(ptype, p.strip()) for p in r.text.splitlines() if p.strip()])
-            except: pass
-            
-        random.shuffle(all_proxies)
-        
-        def check_proxy(proxy_info):
-            ptype, p = proxy_info
-            proxy_url = f"{ptype}://{p}"
+METRICS_DIR = os.path.join(STATE_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = 5
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+# Each process keeps its own counters/histograms and periodically writes them to
+# METRICS_DIR/<pid>-<start>.json; /metrics sums every file so the numbers cover all
+# gunicorn workers. Files of recycled workers are folded into one rollup file.
+_metrics = {'counter': {}, 'histogram': {}}
+_metrics_lock = threading.Lock()
+_metrics_file = os.path.join(METRICS_DIR, f"{os.getpid()}-{int(time.time())}.json")
+_metrics_dirty = False
+_metrics_thread = None
+_METRIC_HELP = {
+    'streamrip_stage_duration_seconds': 'Time spent in each stage of the download pipeline',
+    'streamrip_downloads_total': 'Finished download requests by outcome',
+    'streamrip_result_cache_total': 'Result cache lookups by outcome',
+    'streamrip_coalesced_total': 'Requests that waited for an identical in-flight download',
+    'streamrip_proxy_probes_total': 'Proxy candidates probed by outcome and the stage they failed at',
+    'streamrip_js_solver_spawns_total': 'Challenge solver processes started',
+    'streamrip_batch_items_total': 'Batch items added to an archive, by outcome',
+    'streamrip_admission_total': 'Download requests admitted to or refused by the job pool',
+    'streamrip_transcode_cpu_seconds': 'CPU time (user + system) used by each ffmpeg transcode',
+    'streamrip_hedges_total': 'Hedged attempts started, and whether the hedge or the original attempt won',
+    'streamrip_production_proxy_transitions_total': 'Times the production proxy was marked up or down',
+    'streamrip_http_request_seconds': 'Outbound HTTP calls made outside yt-dlp, until response headers, by service and status',
+}
+
+def _labels_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+def inc_counter(name, amount=1, **labels):
+    global _metrics_dirty
+    key = _labels_key(labels)
+    with _metrics_lock:
+        series = _metrics['counter'].setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+        _metrics_dirty = True
+    _start_metrics_flusher()
+
+def observe(name, value, **labels):
+    global _metrics_dirty
+    key = _labels_key(labels)
+    with _metrics_lock:
+        series = _metrics['histogram'].setdefault(name, {})
+        h = series.setdefault(key, {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, le in enumerate(HISTOGRAM_BUCKETS):
+            if value <= le: h['buckets'][i] += 1
+        h['sum'] += value
+        h['count'] += 1
+        _metrics_dirty = True
+    _start_metrics_flusher()
+
+def site_label(url):
+    if 'youtube.com' in url or 'youtu.be' in url: return 'youtube'
+    if 'instagram.com' in url: return 'instagram'
+    if 'x.com' in url or 'twitter.com' in url: return 'x'
+    return 'other'
+
+@contextlib.contextmanager
+def timed(stage, **labels):
+    """Observe the duration of a pipeline stage in streamrip_stage_duration_seconds.
+
+    The body gets the label dict and may fill in more labels, or set outcome/error
+    itself when it handles a failure without raising.
+    """
+    labels = {'site': '', 'format': '', 'client': '', 'route': '', **labels}
+    start = time.monotonic()
+    try:
+        yield labels
+    except BaseException as e:
+        labels.setdefault('outcome', 'error')
+        labels.setdefault('error', classify_error(e))
+        raise
+    finally:
+        labels.setdefault('outcome', 'ok')
+        labels.setdefault('error', '')
+        observe('streamrip_stage_duration_seconds', time.monotonic() - start, stage=stage, **labels)
+
+def flush_metrics():
+    global _metrics_dirty
+    with _metrics_lock:
+        if not _metrics_dirty: return
+        data = json.dumps(_metrics)
+        _metrics_dirty = False
+    tmp = f"{_metrics_file}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, _metrics_file)
+
+def _metrics_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try: flush_metrics()
+        except OSError as e: app.logger.warning(f"Could not write metrics: {e}")
+
+def _start_metrics_flusher():
+    global _metrics_thread
+    if _metrics_thread is None:
+        _metrics_thread = threading.Thread(target=_metrics_flusher, name='metrics-flush', daemon=True)
+        _metrics_thread.start()
+
+METRICS_ROLLUP = os.path.join(METRICS_DIR, 'rollup.json')
+
+def _merge_metrics(total, data):
+    for name, series in data['counter'].items():
+        for key, value in series.items():
+            total['counter'].setdefault(name, {})[key] = total['counter'].get(name, {}).get(key, 0) + value
+    for name, series in data['histogram'].items():
+        for key, h in series.items():
+            agg = total['histogram'].setdefault(name, {}).setdefault(key, {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0.0, 'count': 0})
+            agg['buckets'] = [a + b for a, b in zip(agg['buckets'], h['buckets'])]
+            agg['sum'] += h['sum']
+            agg['count'] += h['count']
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def rollup_metrics():
+    """Fold the metric files of workers that have exited into METRICS_ROLLUP and delete them.
+
+    Workers share one pid namespace, so a file is only folded in once its pid is gone and
+    it has not been written for a while.
+    """
+    with open(os.path.join(LOCK_DIR, 'metrics-rollup.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = []
+        for p in glob.glob(os.path.join(METRICS_DIR, '*-*.json')):
             try:
-                # Check actual YouTube access - generate_204 is fast and reliable
-                r = requests.get('https://www.youtube.com/generate_204', 
-                                 proxies={'http': proxy_url, 'https': proxy_url}, 
-                                 timeout=4)
-                if r.status_code == 204:
-                    return proxy_url
-            except: pass
-            return None
+                pid = int(os.path.basename(p).split('-', 1)[0])
+                if _pid_alive(pid) or time.time() - os.path.getmtime(p) < 2 * METRICS_FLUSH_INTERVAL: continue
+                with open(p) as f:
+                    dead.append((p, json.load(f)))
+            except (OSError, ValueError): continue
+        if not dead: return
+        try:
+            with open(METRICS_ROLLUP) as f:
+                total = json.load(f)
+        except (OSError, ValueError):
+            total = {'counter': {}, 'histogram': {}}
+        for _, data in dead: _merge_metrics(total, data)
+        tmp = f"{METRICS_ROLLUP}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(total, f)
+        os.replace(tmp, METRICS_ROLLUP)
+        for p, _ in dead:
+            try: os.remove(p)
+            except OSError: pass
+
+def render_metrics():
+    """Sum the metric files of all workers and render them in Prometheus text format."""
+    try:
+        rollup_metrics()
+    except OSError as e:
+        app.logger.warning(f"Could not roll up metrics: {e}")
+    total = {'counter': {}, 'histogram': {}}
+    for p in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            with open(p) as f:
+                _merge_metrics(total, json.load(f))
+        except (OSError, ValueError): continue
+    counters, histograms = total['counter'], total['histogram']
+
+    def fmt(key, extra=()):
+        pairs = [*json.loads(key), *extra]
+        if not pairs: return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    lines = []
+    for name, series in sorted(counters.items()):
+        lines += [f"# HELP {name} {_METRIC_HELP.get(name, name)}", f"# TYPE {name} counter"]
+        lines += [f"{name}{fmt(key)} {value}" for key, value in sorted(series.items())]
+    for name, series in sorted(histograms.items()):
+        lines += [f"# HELP {name} {_METRIC_HELP.get(name, name)}", f"# TYPE {name} histogram"]
+        for key, h in sorted(series.items()):
+            # Buckets are stored per-bucket-cumulative already (value <= le counted in every bucket)
+            for le, n in zip(HISTOGRAM_BUCKETS, h['buckets']):
+                lines.append(f"{name}_bucket{fmt(key, [('le', le)])} {n}")
+            lines.append(f"{name}_bucket{fmt(key, [('le', '+Inf')])} {h['count']}")
+            lines.append(f"{name}_sum{fmt(key)} {h['sum']}")
+            lines.append(f"{name}_count{fmt(key)} {h['count']}")
+    return '\n'.join(lines) + '\n'
 
-        app.logger.info("Searching for a working YouTube proxy...")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
-            # Test more candidates to be sure
-            futures = {executor.submit(check_proxy, p): p for p in all_proxies[:500]}
-            for future in concurrent.futures.as_completed(futures):
-                res = future.result()
-                if res:
-                    executor.shutdown(wait=False, cancel_futures=True)
-                    return res
+# --- Outbound HTTP ---
+# Everything the server fetches itself (not yt-dlp) goes through http_request(), which keeps
+# one pooled, keep-alive session per service so repeated calls to the same host (the PO token
+# sidecar, the proxy lists, a media CDN) reuse connections instead of paying TCP+TLS each time.
+# service -> (keep-alive connections per host, wait for a free one instead of opening more, retries)
+HTTP_SERVICES = {
+    'pot':        (4, True, 1),    # bgutil sidecar: mints are slow and CPU-bound, don't pile on
+    'proxy_list': (4, False, 2),
+    'ejs':        (2, False, 2),
+    'media':      (32, False, 0),  # ranged source reads; _feed_source resumes from the last byte itself
+}
+HTTP_RETRY_BACKOFF = 0.5  # seconds, doubled per retry
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def _http_session(service):
+    # Created lazily so each gunicorn worker builds its own pools after the fork
+    with _http_sessions_lock:
+        session = _http_sessions.get(service)
+        if session is None:
+            per_host, block, retries = HTTP_SERVICES[service]
+            # Retries cover connection failures and 502-504; POSTs are only retried before they're sent
+            retry = Retry(total=retries, read=0 if service == 'pot' else retries, backoff_factor=HTTP_RETRY_BACKOFF,
+                          status_forcelist=(502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=per_host, pool_block=block, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # A shared session must not carry one call's cookies into the next
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _http_sessions[service] = session
+    return session
+
+def http_request(service, method, url, **kwargs):
+    """requests.request() through the pooled session for service, timed in streamrip_http_request_seconds."""
+    start = time.monotonic()
+    outcome = 'error'
+    try:
+        r = _http_session(service).request(method, url, **kwargs)
+        outcome = str(r.status_code)
+        return r
     except Exception as e:
-        app.logger.warning(f"Proxy search error: {e}")
-    return None
+        outcome = classify_error(e)
+        raise
+    finally:
+        observe('streamrip_http_request_seconds', time.monotonic() - start, service=service, outcome=outcome)
+
+PROXY_LIST_URLS = list(proxy_tester.DEFAULT_SOURCES)
+if os.environ.get('PROXY_LIST_URLS'):
+    # Comma-separated; entries that aren't http(s) URLs are read as local files (e.g. for offline testing)
+    PROXY_LIST_URLS = os.environ['PROXY_LIST_URLS'].split(',')
+PROXY_LIST_DIR = os.path.join(STATE_DIR, 'proxy-lists')  # last good copy of each list, with its validators
+PROXY_LIST_REFRESH = int(os.environ.get('PROXY_LIST_REFRESH', '1800'))  # seconds before a list is revalidated
+os.makedirs(PROXY_LIST_DIR, exist_ok=True)
+PROXY_CHECK_URL = os.environ.get('PROXY_CHECK_URL', 'https://www.youtube.com/generate_204')
+PROXY_POOL_ENABLED = os.environ.get('PROXY_POOL_ENABLED', '1') == '1'
+PROXY_POOL_SIZE = int(os.environ.get('PROXY_POOL_SIZE', '10'))          # known-good proxies to keep
+PROXY_POOL_INTERVAL = int(os.environ.get('PROXY_POOL_INTERVAL', '120'))  # seconds between maintenance runs
+PROXY_POOL_MAX_AGE = int(os.environ.get('PROXY_POOL_MAX_AGE', '600'))    # re-check proxies older than this
+PROXY_PROBE_CONCURRENCY = int(os.environ.get('PROXY_PROBE_CONCURRENCY', '1000'))  # candidates probed at once
+PROXY_PROBE_TIMEOUT = float(os.environ.get('PROXY_PROBE_TIMEOUT', '4'))          # seconds per probe stage
+PROXY_PROBE_MEDIA_URL = os.environ.get('PROXY_PROBE_MEDIA_URL')  # optional ranged fetch to measure throughput
+
+PROXY_BREAKER_FAILURES = int(os.environ.get('PROXY_BREAKER_FAILURES', '3'))   # consecutive failures that open a proven proxy's circuit
+PROXY_BREAKER_COOLDOWN = int(os.environ.get('PROXY_BREAKER_COOLDOWN', '300'))  # seconds before an open proxy is re-probed (doubles per trip)
+PROXY_BREAKER_MAX_TRIPS = int(os.environ.get('PROXY_BREAKER_MAX_TRIPS', '4'))  # trips after which a proxy is written off
+PROXY_HEALTH_FILE = os.path.join(STATE_DIR, 'proxy_health.json')
+PROXY_HEALTH_TTL = int(os.environ.get('PROXY_HEALTH_TTL', str(24 * 3600)))     # forget proxies not seen for this long
+PROXY_HEALTH_SYNC_INTERVAL = 30  # seconds between merges with the file other workers write to
+PROXY_SCORE_BYTES = 10 * 1024 * 1024  # transfer size used to weigh latency against throughput when ranking
+PROXY_PRIOR_THROUGHPUT = 1024 * 1024  # bytes/s assumed for a proxy that hasn't carried a download yet
+PROXY_EWMA = 0.3                      # weight of the newest latency/throughput sample
+
+# proxy_url -> health entry (see _new_proxy_entry). Circuit states:
+#   closed     usable; PROXY_BREAKER_FAILURES consecutive failures (or one, before its first success) open it
+#   open       not handed out; re-probed after a cooldown that doubles with every trip
+#   half_open  passed the re-probe; the next live failure opens it again, a success closes it
+#   dead       tripped PROXY_BREAKER_MAX_TRIPS times; kept as a tombstone until PROXY_HEALTH_TTL
+# Every worker keeps its own copy and merges it with PROXY_HEALTH_FILE (newest entry wins),
+# so restarts and sibling workers start from a warm ranking.
+_proxy_pool = {}
+_proxy_pool_lock = threading.Lock()
+_proxy_pool_wakeup = threading.Event()
+_proxy_pool_thread = None
+_proxy_health_dirty = set()
+
+def _new_proxy_entry(latency, throughput=None):
+    return {'state': 'closed', 'latency': latency, 'throughput': throughput, 'uses': 0, 'successes': 0, 'bot_checks': 0,
+            'failures': 0, 'trips': 0, 'opened': 0.0, 'checked': time.time(), 'updated': time.time()}
+
+def _ewma(old, sample):
+    return sample if old is None else old + PROXY_EWMA * (sample - old)
+
+def _proxy_score(e):
+    """Expected seconds to fetch PROXY_SCORE_BYTES through the proxy, counting failed tries."""
+    p = (e['successes'] + 1) / (e['uses'] + 2)
+    return (e['latency'] + PROXY_SCORE_BYTES / (e['throughput'] or PROXY_PRIOR_THROUGHPUT)) / p
+
+def _touch_proxy(proxy_url, e):
+    # Caller holds _proxy_pool_lock
+    e['updated'] = time.time()
+    _proxy_health_dirty.add(proxy_url)
+
+def _trip_proxy(proxy_url, e):
+    # Caller holds _proxy_pool_lock
+    e['trips'] += 1
+    e['state'] = 'dead' if e['trips'] >= PROXY_BREAKER_MAX_TRIPS else 'open'
+    e['opened'] = time.time()
+    _touch_proxy(proxy_url, e)
+
+def _cooled_down(e, now):
+    return e['state'] == 'open' and now - e['opened'] >= PROXY_BREAKER_COOLDOWN * 2 ** (e['trips'] - 1)
+
+def _usable_proxies():
+    with _proxy_pool_lock:
+        return [p for p, e in _proxy_pool.items() if e['state'] in ('closed', 'half_open')]
 
-def get_po_token():
-    """Fetch a PO token from the bgutil sidecar."""
-    pot_url = os.environ.get('POT_PROVIDER_URL', 'http://127.0.0.1:4416')
-    try:
-        app.logger.info(f"Fetching PO Token from {pot_url}...")
-        resp = requests.post(f"{pot_url}/get_pot", json={}, timeout=30)
-        if resp.status_code == 200:
-            data = resp.json()
-            token = data.get('poToken') or data.get('po_token') or data.get('potoken')
-            visitor = data.get('contentBinding') or data.get('visitorData')
-            return token, visitor
-    except: pass
+def sync_proxy_health():
+    """Merge this worker's proxy health with PROXY_HEALTH_FILE and write back what changed."""
+    with open(os.path.join(LOCK_DIR, 'proxy_health.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(PROXY_HEALTH_FILE) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = {}
+        cutoff = time.time() - PROXY_HEALTH_TTL
+        with _proxy_pool_lock:
+            for p, e in stored.items():
+                if p not in _proxy_pool or e['updated'] > _proxy_pool[p]['updated']: _proxy_pool[p] = e
+            for p in [p for p, e in _proxy_pool.items() if e['updated'] < cutoff]: del _proxy_pool[p]
+            changed = bool(_proxy_health_dirty) or len(stored) != len(_proxy_pool)
+            _proxy_health_dirty.clear()
+            data = json.dumps(_proxy_pool)
+        if changed:
+            tmp = f"{PROXY_HEALTH_FILE}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, PROXY_HEALTH_FILE)
+
+# path -> (mtime, set of proxy URLs), so unchanged lists aren't parsed again
+_proxy_list_cache = {}
+
+def _refresh_proxy_list(source):
+    """Revalidate one list if its copy is older than PROXY_LIST_REFRESH; returns the path of the last good copy.
+
+    Uses ETag/Last-Modified so an unchanged list costs a 304. A failed fetch keeps the old copy
+    and is retried on the next refresh. Local files are read in place.
+    """
+    if urllib.parse.urlsplit(source).scheme not in ('http', 'https'):
+        return source if os.path.exists(source) else None
+    key = hashlib.sha1(source.encode()).hexdigest()[:16]
+    path, meta_path = os.path.join(PROXY_LIST_DIR, f'{key}.txt'), os.path.join(PROXY_LIST_DIR, f'{key}.json')
+    # One worker revalidates a list at a time; the others then find it fresh
+    with open(os.path.join(LOCK_DIR, f'proxy-list-{key}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        have_copy = os.path.exists(path)
+        if have_copy and time.time() - meta.get('checked', 0) < PROXY_LIST_REFRESH:
+            return path
+        headers = {}
+        if have_copy and meta.get('etag'): headers['If-None-Match'] = meta['etag']
+        if have_copy and meta.get('last_modified'): headers['If-Modified-Since'] = meta['last_modified']
+        with timed('proxy_list_fetch') as m:
+            try:
+                r = http_request('proxy_list', 'GET', source, headers=headers, timeout=10)
+                if r.status_code == 304:
+                    m.update(outcome='not_modified')
+                else:
+                    r.raise_for_status()
+                    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+                    with open(tmp, 'wb') as f:
+                        f.write(r.content)
+                    os.replace(tmp, path)
+                    meta = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+                meta['checked'] = time.time()
+                tmp = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp, 'w') as f:
+                    json.dump(meta, f)
+                os.replace(tmp, meta_path)
+            except Exception as e:
+                m.update(outcome='error', error=classify_error(e))
+                app.logger.warning(f"Could not refresh proxy list {source}: {e}")
+    return path if os.path.exists(path) else None
+
+def refresh_proxy_lists():
+    """Revalidate all stale lists concurrently; returns {source: path of its last good copy or None}."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(PROXY_LIST_URLS))) as executor:
+        return dict(zip(PROXY_LIST_URLS, executor.map(_refresh_proxy_list, PROXY_LIST_URLS)))
+
+def _fetch_proxy_candidates():
+    """Deduplicated, shuffled proxy URLs from every list source."""
+    candidates = set()
+    for source, path in refresh_proxy_lists().items():
+        if not path: continue
+        try:
+            mtime = os.path.getmtime(path)
+            cached = _proxy_list_cache.get(path)
+            if not cached or cached[0] != mtime:
+                with open(path, errors='replace') as f:
+                    cached = _proxy_list_cache[path] = (mtime, proxy_tester.parse_proxy_list(f.read(), source))
+        except OSError: continue
+        candidates |= cached[1]
+    candidates = list(candidates)
+    random.shuffle(candidates)
+    return candidates
+
+def _probe_proxies(candidates, wanted):
+    """Probe candidates concurrently and return {proxy_url: probe result} for up to `wanted` working ones."""
+    def on_result(result):
+        inc_counter('streamrip_proxy_probes_total', outcome='ok' if result['ok'] else 'failed', stage=result['stage'] or '')
+    with timed('proxy_probe'):
+        return proxy_tester.find_working(candidates, wanted, concurrency=PROXY_PROBE_CONCURRENCY, on_result=on_result,
+                                         check_url=PROXY_CHECK_URL, media_url=PROXY_PROBE_MEDIA_URL, timeout=PROXY_PROBE_TIMEOUT)
+
+def refresh_proxy_pool():
+    """Re-probe stale and cooled-down proxies and top the usable pool back up to PROXY_POOL_SIZE."""
+    now = time.time()
+    with _proxy_pool_lock:
+        recheck = [p for p, e in _proxy_pool.items()
+                   if e['state'] in ('closed', 'half_open') and now - e['checked'] > PROXY_POOL_MAX_AGE or _cooled_down(e, now)]
+    if recheck:
+        rechecked = _probe_proxies(recheck, len(recheck))
+        with _proxy_pool_lock:
+            for p in recheck:
+                e = _proxy_pool.get(p)
+                if not e: continue
+                if p in rechecked:
+                    e['latency'], e['checked'] = _ewma(e['latency'], rechecked[p]['latency']), time.time()
+                    if rechecked[p]['throughput']: e['throughput'] = _ewma(e['throughput'], rechecked[p]['throughput'])
+                    if e['state'] == 'open': e['state'] = 'half_open'
+                    _touch_proxy(p, e)
+                else:
+                    _trip_proxy(p, e)
+
+    missing = PROXY_POOL_SIZE - len(_usable_proxies())
+    if missing > 0:
+        app.logger.info(f"Proxy pool has {PROXY_POOL_SIZE - missing}/{PROXY_POOL_SIZE} proxies, searching for more...")
+        with _proxy_pool_lock:
+            known = set(_proxy_pool)  # includes open and dead proxies, which have already had their chance
+        candidates = [p for p in _fetch_proxy_candidates() if p not in known][:500]
+        found = _probe_proxies(candidates, missing)
+        with _proxy_pool_lock:
+            for p, result in found.items():
+                _proxy_pool[p] = _new_proxy_entry(result['latency'], result['throughput'])
+                _touch_proxy(p, _proxy_pool[p])
+        app.logger.info(f"Proxy pool refreshed: {len(found)} new, {len(_usable_proxies())} usable")
+
+def _proxy_pool_worker():
+    last_refresh, woken = 0, False
+    while True:
+        try:
+            sync_proxy_health()
+            if woken or time.monotonic() - last_refresh >= PROXY_POOL_INTERVAL:
+                last_refresh = time.monotonic()
+                refresh_proxy_pool()
+                sync_proxy_health()
+                refresh_proxy_lists()  # keep the lists warm even while the pool is full
+        except Exception as e:
+            app.logger.warning(f"Proxy pool refresh error: {e}")
+        woken = _proxy_pool_wakeup.wait(PROXY_HEALTH_SYNC_INTERVAL)
+        _proxy_pool_wakeup.clear()
+
+def start_proxy_pool():
+    """Start the background thread that keeps the proxy pool warm (once per process)."""
+    global _proxy_pool_thread
+    if _proxy_pool_thread is None:
+        _proxy_pool_thread = threading.Thread(target=_proxy_pool_worker, name='proxy-pool', daemon=True)
+        _proxy_pool_thread.start()
+
+def get_residential_proxy(avoid=()):
+    """Return a known-good proxy from the pool, or None if the pool is empty.
+
+    Proxies are ranked by _proxy_score(); proxies in `avoid` are skipped unless nothing else is left.
+    Never blocks on network I/O: an empty pool just wakes the maintenance thread.
+    """
+    with _proxy_pool_lock:
+        usable = [p for p, e in _proxy_pool.items() if e['state'] in ('closed', 'half_open')]
+        ranked = sorted((p for p in usable if p not in avoid), key=lambda p: _proxy_score(_proxy_pool[p])) or usable
+    if not ranked:
+        _proxy_pool_wakeup.set()
+        return None
+    # Spread load over the best few instead of hammering a single proxy
+    return random.choice(ranked[:3])
+
+def record_proxy_result(proxy_url, error=None, throughput=None):
+    """Update a proxy's health after a real download or extraction through it.
+
+    error is the classify_error() class of a failure, or None for a success. Only failures
+    that point at the proxy count against it.
+    """
+    if error and error not in ('proxy_failure', 'bot_check', 'throttled'): return
+    with _proxy_pool_lock:
+        e = _proxy_pool.get(proxy_url)
+        if not e: return
+        e['uses'] += 1
+        if error is None:
+            e['successes'] += 1
+            e['failures'] = 0
+            if throughput: e['throughput'] = _ewma(e['throughput'], throughput)
+            if e['state'] == 'half_open': e['state'], e['trips'] = 'closed', 0
+        else:
+            e['failures'] += 1
+            if error == 'bot_check': e['bot_checks'] += 1
+            if e['state'] == 'closed' and (e['failures'] >= PROXY_BREAKER_FAILURES or not e['successes']) \
+                    or e['state'] == 'half_open':
+                _trip_proxy(proxy_url, e)
+        _touch_proxy(proxy_url, e)
+        low = e['state'] not in ('closed', 'half_open') and \
+            sum(x['state'] in ('closed', 'half_open') for x in _proxy_pool.values()) < PROXY_POOL_SIZE // 2
+    if low: _proxy_pool_wakeup.set()
+
+def proxy_health():
+    """Health entries of all known proxies with their score and circuit state, best first."""
+    with _proxy_pool_lock:
+        entries = [{'proxy': p, **e, 'score': round(_proxy_score(e), 2)} for p, e in _proxy_pool.items()]
+    order = {'closed': 0, 'half_open': 1, 'open': 2, 'dead': 3}
+    return sorted(entries, key=lambda e: (order[e['state']], e['score']))
+
+PROXY_MONITOR_INTERVAL = int(os.environ.get('PROXY_MONITOR_INTERVAL', '15'))  # seconds between PROXY_URL probes
+PROXY_MONITOR_UP_AFTER = int(os.environ.get('PROXY_MONITOR_UP_AFTER', '2'))    # consecutive passes before a down proxy is used again
+PROXY_MONITOR_DOWN_AFTER = int(os.environ.get('PROXY_MONITOR_DOWN_AFTER', '3'))  # consecutive failures before an up proxy is dropped
+PROXY_MONITOR_ENABLED = os.environ.get('FLASK_ENV') == 'production' and bool(PROXY_URL)
+
+# Liveness of the production PROXY_URL, kept by a background thread so attempts only read it.
+# The first probe decides; after that the state only flips after a run of opposite results.
+_production_proxy = {'state': 'unknown' if PROXY_MONITOR_ENABLED else 'disabled', 'since': time.time(), 'checked': None,
+                     'latency': None, 'error': None, 'streak': 0}
+_production_proxy_lock = threading.Lock()
+
+def production_proxy_up():
+    return _production_proxy['state'] == 'up'
+
+def _check_production_proxy():
+    with timed('proxy_liveness') as m:
+        result = asyncio.run(proxy_tester.probe(PROXY_URL, check_url=PROXY_CHECK_URL, timeout=PROXY_PROBE_TIMEOUT))
+        if not result['ok']: m.update(outcome='error', error=result['stage'])
+    with _production_proxy_lock:
+        st = _production_proxy
+        passed = result['ok']
+        st.update(checked=time.time(), latency=result['latency'], error=result['error'])
+        # streak counts consecutive results that disagree with the current state
+        st['streak'] = st['streak'] + 1 if passed != (st['state'] == 'up') else 0
+        needed = PROXY_MONITOR_UP_AFTER if passed else PROXY_MONITOR_DOWN_AFTER
+        if st['state'] == 'unknown' or st['streak'] >= needed:
+            state = 'up' if passed else 'down'
+            if state != st['state']:
+                app.logger.warning(f"Production proxy is {state}" + (f": {result['error']}" if result['error'] else ''))
+                inc_counter('streamrip_production_proxy_transitions_total', state=state)
+                st.update(state=state, since=time.time())
+            st['streak'] = 0
+
+def _production_proxy_monitor():
+    while True:
+        try:
+            _check_production_proxy()
+        except Exception as e:
+            app.logger.warning(f"Production proxy check error: {e}")
+        time.sleep(PROXY_MONITOR_INTERVAL)
+
+def production_proxy_status():
+    with _production_proxy_lock:
+        status = dict(_production_proxy)
+    # Don't show credentials embedded in the proxy URL
+    p = urllib.parse.urlsplit(PROXY_URL or '')
+    status['proxy'] = f"{p.scheme}://{p.hostname}:{p.port}" if p.hostname else None
+    return status
+
+POT_PROVIDER_URL = os.environ.get('POT_PROVIDER_URL', 'http://127.0.0.1:4416')
+POT_TTL = int(os.environ.get('POT_TTL', str(6 * 3600)))           # how long a minted token is reused
+POT_REFRESH_AHEAD = int(os.environ.get('POT_REFRESH_AHEAD', '600'))  # re-mint in background this long before expiry
+
+# egress key ('direct' or proxy URL) -> {'token', 'visitor', 'expires'}
+_pot_cache = {}
+_pot_inflight = {}
+_pot_lock = threading.Lock()
+
+def _mint_po_token(egress):
+    """Ask the bgutil sidecar for a fresh PO token bound to the given egress proxy."""
+    with timed('pot_fetch', route='proxy' if egress else 'direct') as m:
+        try:
+            app.logger.info(f"Fetching PO Token from {POT_PROVIDER_URL}...")
+            resp = http_request('pot', 'POST', f"{POT_PROVIDER_URL}/get_pot", json={'proxy': egress} if egress else {}, timeout=30)
+            if resp.status_code == 200:
+                data = resp.json()
+                token = data.get('poToken') or data.get('po_token') or data.get('potoken')
+                visitor = data.get('contentBinding') or data.get('visitorData')
+                return token, visitor
+            m.update(outcome='error', error=f"http_{resp.status_code}")
+        except Exception as e:
+            m.update(outcome='error', error=classify_error(e))
     return None, None
 
+def _refresh_po_token(key, egress):
+    """Mint a token for key, sharing a single in-flight request between concurrent callers."""
+    with _pot_lock:
+        done = _pot_inflight.get(key)
+        leader = done is None
+        if leader:
+            done = _pot_inflight[key] = threading.Event()
+    if not leader:
+        done.wait(35)
+        with _pot_lock:
+            entry = _pot_cache.get(key)
+        return (entry['token'], entry['visitor']) if entry else (None, None)
+    try:
+        token, visitor = _mint_po_token(egress)
+        if token:
+            with _pot_lock:
+                _pot_cache[key] = {'token': token, 'visitor': visitor, 'expires': time.time() + POT_TTL}
+        return token, visitor
+    finally:
+        with _pot_lock:
+            _pot_inflight.pop(key, None)
+        done.set()
+
+def get_po_token(egress=None):
+    """Return (po_token, visitor_data) for requests leaving through `egress` (None = direct).
+
+    Tokens are cached per egress identity; expired entries are minted synchronously,
+    entries close to expiry are served and refreshed in the background.
+    """
+    key = egress or 'direct'
+    with _pot_lock:
+        entry = _pot_cache.get(key)
+        refreshing = key in _pot_inflight
+    now = time.time()
+    if entry and now < entry['expires']:
+        if now > entry['expires'] - POT_REFRESH_AHEAD and not refreshing:
+            threading.Thread(target=_refresh_po_token, args=(key, egress), daemon=True).start()
+        return entry['token'], entry['visitor']
+    return _refresh_po_token(key, egress)
+
+def invalidate_po_token(egress=None):
+    """Forget the cached token for an egress, e.g. after YouTube rejected it."""
+    with _pot_lock:
+        _pot_cache.pop(egress or 'direct', None)
+
+
+_extractors = None
+
+def suitable_extractor(url):
+    """The extractor class yt-dlp would pick for url, or None."""
+    global _extractors
+    if _extractors is None:
+        _extractors = list(yt_dlp.extractor.gen_extractor_classes())
+    return next((ie for ie in _extractors if ie.suitable(url)), None)
+
+def identify_media(url):
+    """Return (extractor_key, video_id) for url without touching the network, or None."""
+    ie = suitable_extractor(url)
+    video_id = ie and ie.get_temp_id(url)
+    return (ie.ie_key(), video_id) if video_id else None
+
+def result_cache_key(url, target_format):
+    """Cache key for a finished file: extractor, video id, format and quality."""
+    media = identify_media(url)
+    if not media or RESULT_CACHE_MAX_BYTES <= 0:
+        return None
+    quality = MP3_QUALITY if target_format == 'mp3' else MP4_MAX_HEIGHT
+    return f"{media[0]}:{media[1]}:{target_format}:{quality}"
+
+def _result_cache_paths(key, target_format):
+    name = hashlib.sha256(key.encode()).hexdigest()[:32]
+    base = os.path.join(RESULT_CACHE_DIR, name)
+    return f"{base}.{target_format}", f"{base}.json"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def lookup_result(key, target_format):
+    """Return the cached entry ({'path', 'download_name', ...}) for key, or None."""
+    path, meta_path = _result_cache_paths(key, target_format)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        os.utime(path)  # mtime doubles as the LRU clock
+    except (OSError, ValueError):
+        return None
+    meta['path'] = path
+    return meta
+
+def publish_result(key, target_format, src, download_name):
+    """Move a finished file into the cache and return its cached path.
+
+    The metadata is written first and the media file is renamed into place last,
+    so readers never see a half-written entry. Returns None if the file is not cached.
+    """
+    size = os.path.getsize(src)
+    if size > RESULT_CACHE_MAX_BYTES:
+        return None
+    path, meta_path = _result_cache_paths(key, target_format)
+    tmp = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump({'key': key, 'download_name': download_name, 'size': size, 'sha256': file_sha256(src), 'created': time.time()}, f)
+    os.replace(tmp, meta_path)
+    os.replace(src, path)
+    evict_results(keep=path)
+    return path
+
+def evict_results(keep=None):
+    """Delete least recently used cache entries until the cache fits RESULT_CACHE_MAX_BYTES."""
+    entries = []
+    for p in glob.glob(os.path.join(RESULT_CACHE_DIR, '*.mp[34]')):
+        try:
+            st = os.stat(p)
+            entries.append((st.st_mtime, st.st_size, p))
+        except OSError: pass
+    total = sum(e[1] for e in entries)
+    for _, size, p in sorted(entries):
+        if total <= RESULT_CACHE_MAX_BYTES: break
+        if p == keep: continue
+        try:
+            os.remove(p)
+            os.remove(os.path.splitext(p)[0] + '.json')
+        except OSError: pass
+        total -= size
 
 
 @app.route('/')
@@ -111,131 +794,2021 @@ def download_extension():
         return send_file(extension_path, as_attachment=True, download_name='StreamRip_Extension.zip', mimetype='application/zip')
     return jsonify({'error': 'Not found'}), 404
 
-@app.route('/api/download', methods=['POST', 'GET'])
-def download():
+# Single-flight: identical downloads (same result cache key) are coalesced across threads and
+# gunicorn workers with flock(). The lock holder is the leader and does the work; everyone
+# else waits for the lock and then finds the leader's output in the result cache.
+def _lock_path(key):
+    return os.path.join(LOCK_DIR, hashlib.sha256(key.encode()).hexdigest()[:32] + '.lock')
+
+def try_lead(key):
+    """Take the leader lock for key without blocking. Returns the lock fd, or None if taken."""
+    fd = os.open(_lock_path(key), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+def leader_active(key):
+    """True while some thread or worker holds the leader lock for key."""
+    fd = os.open(_lock_path(key), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)  # closing also drops our shared lock
+
+@contextlib.contextmanager
+def single_flight(key, on_wait=None):
+    """Hold the leader lock for key, waiting up to COALESCE_WAIT for the current leader.
+
+    Yields True if another leader ran first, in which case its result should be in the cache.
+    """
+    fd = try_lead(key)
+    waited = fd is None
+    if waited:
+        app.logger.info(f"Waiting for in-flight download of {key}")
+        if on_wait: on_wait()
+        deadline = time.monotonic() + COALESCE_WAIT
+        while fd is None:
+            if time.monotonic() > deadline:
+                raise DownloadError('Timed out waiting for an identical download', 504)
+            time.sleep(0.25)
+            fd = try_lead(key)
+    try:
+        yield waited
+    finally:
+        os.close(fd)
+
+INFO_CACHE_DIR = os.path.join(STATE_DIR, 'info')
+INFO_TTL = int(os.environ.get('INFO_TTL', '3600'))  # seconds metadata (title, formats, ...) is reused
+INFO_URL_MARGIN = 120                              # stop using signed stream URLs this long before they expire
+INFO_MEMORY_ENTRIES = 64
+INFO_DISK_ENTRIES = int(os.environ.get('INFO_DISK_ENTRIES', '5000'))  # info files kept on disk, newest first
+os.makedirs(INFO_CACHE_DIR, exist_ok=True)
+
+# Extracted info dicts, keyed by extractor + video id. Kept on disk so every worker can use
+# them, with a small in-memory LRU in front to skip re-parsing the JSON.
+_info_memory = OrderedDict()
+_info_lock = threading.Lock()
+_last_info_cleanup = 0
+
+def _info_key(url):
+    media = identify_media(url)
+    return f"{media[0]}:{media[1]}" if media else None
+
+def _info_path(key):
+    return os.path.join(INFO_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest()[:32] + '.json')
+
+def _stream_urls_expire(info):
+    """Earliest `expire=` timestamp among the signed format URLs, or None if they don't expire."""
+    expiries = []
+    for f in info.get('formats') or [info]:
+        expire = urllib.parse.parse_qs(urllib.parse.urlparse(f.get('url') or '').query).get('expire')
+        if expire and expire[0].isdigit(): expiries.append(int(expire[0]))
+    return min(expiries) if expiries else None
+
+def cache_info(url, info, egress):
+    """Remember an extracted info dict for url; egress is the proxy its stream URLs are bound to."""
+    key = _info_key(url)
+    if not key or not info: return
+    now = time.time()
+    urls_expire = _stream_urls_expire(info)
+    entry = {
+        'info': yt_dlp.YoutubeDL.sanitize_info(copy.deepcopy(info), remove_private_keys=True),
+        'egress': egress,
+        'expires': now + INFO_TTL,
+        'urls_expire': min(urls_expire - INFO_URL_MARGIN, now + INFO_TTL) if urls_expire else now + INFO_TTL,
+    }
+    tmp = f"{_info_path(key)}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, _info_path(key))
+    except (OSError, TypeError, ValueError) as e:
+        app.logger.warning(f"Could not cache info for {key}: {e}")
+        return
+    with _info_lock:
+        _info_memory[key] = entry
+        _info_memory.move_to_end(key)
+        while len(_info_memory) > INFO_MEMORY_ENTRIES: _info_memory.popitem(last=False)
+    cleanup_info()
+
+def cleanup_info():
+    """Delete info files older than INFO_TTL, then the oldest ones past INFO_DISK_ENTRIES."""
+    global _last_info_cleanup
+    now = time.time()
+    if now - _last_info_cleanup < 60: return
+    _last_info_cleanup = now
+    entries = []
+    for p in glob.glob(os.path.join(INFO_CACHE_DIR, '*')):
+        try:
+            entries.append((os.path.getmtime(p), p))
+        except OSError: pass
+    entries.sort(reverse=True)
+    kept = 0
+    for mtime, p in entries:
+        # Files are rewritten on every extraction, so mtime is when the entry was cached
+        if now - mtime < INFO_TTL and kept < INFO_DISK_ENTRIES and p.endswith('.json'):
+            kept += 1
+            continue
+        if p.endswith('.tmp') and now - mtime < 60: continue  # being written right now
+        try: os.remove(p)
+        except OSError: pass
+
+def get_cached_info(url, with_urls=False):
+    """Return (info, egress) for url from the cache, or None.
+
+    with_urls=True only returns entries whose signed stream URLs are still usable.
+    The returned info is a private copy the caller may hand to yt-dlp.
+    """
+    key = _info_key(url)
+    if not key: return None
+    with _info_lock:
+        entry = _info_memory.get(key)
+    if entry is None:
+        try:
+            with open(_info_path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with _info_lock:
+            _info_memory[key] = entry
+            while len(_info_memory) > INFO_MEMORY_ENTRIES: _info_memory.popitem(last=False)
+    now = time.time()
+    if now > (entry['urls_expire'] if with_urls else entry['expires']):
+        return None
+    return copy.deepcopy(entry['info']), entry['egress']
+
+def drop_cached_info(url):
+    key = _info_key(url)
+    if not key: return
+    with _info_lock:
+        _info_memory.pop(key, None)
+    try: os.remove(_info_path(key))
+    except OSError: pass
+
+class DownloadError(Exception):
+    """A download that failed in a way worth reporting to the client."""
+    def __init__(self, message, status=500, error_class=None):
+        super().__init__(message)
+        self.status = status
+        self.error_class = error_class
+
+DOWNLOAD_ATTEMPTS = 5
+RETRY_BACKOFF_MAX = 30  # seconds; cap for the exponential backoff of RETRY_POLICIES
+HEDGE_AFTER = float(os.environ.get('HEDGE_AFTER', '8'))  # seconds without progress before another strategy races the attempt; 0 disables
+
+# --- Error classification ---
+# What to do after a failed attempt depends on why it failed, not on the wording of the
+# message: a removed video fails the same way from every client and proxy, while a bot check
+# or a dead proxy may pass on the next try. classify_error() maps an exception to one of the
+# classes below and the attempt loops follow that class's policy.
+RetryPolicy = namedtuple('RetryPolicy', 'retry switch_proxy switch_client backoff max_attempts blames_strategy')
+RETRY_POLICIES = {
+    #                              retry  proxy  client backoff attempts blames strategy
+    'permanent':       RetryPolicy(False, False, False, 0,      1,       False),  # unavailable, private, 404, unsupported
+    'bot_check':       RetryPolicy(True,  True,  True,  0,      DOWNLOAD_ATTEMPTS, True),  # "not a bot", 403 on media
+    'proxy_failure':   RetryPolicy(True,  True,  False, 0,      DOWNLOAD_ATTEMPTS, True),  # proxy refused/timed out/reset
+    'throttled':       RetryPolicy(True,  True,  False, 5,      3,       True),   # HTTP 429
+    'client_failure':  RetryPolicy(True,  False, True,  0,      3,       True),   # no formats / player not understood
+    'transient':       RetryPolicy(True,  False, False, 1,      2,       False),  # resets, timeouts, 5xx, anything else
+}
+# Statuses reported to the client once a class has used up its attempts (502 otherwise)
+ERROR_STATUS = {'permanent': 422, 'overloaded': 503}
+
+_BOT_CHECK_MESSAGE = re.compile(r"not a bot|confirm you.re not|captcha|unusual traffic", re.I)
+_CLIENT_FAILURE_MESSAGE = re.compile(r'Requested format is not available|No video formats found|'
+                                     r'Only images are available|(?:n|signature) challenge', re.I)
+
+def _error_chain(e):
+    """e followed by the exceptions it wraps (yt-dlp's exc_info/cause, then __cause__/__context__)."""
+    seen = set()
+    while e is not None and id(e) not in seen:
+        seen.add(id(e))
+        yield e
+        exc_info = getattr(e, 'exc_info', None)
+        e = ((exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None)
+             or getattr(e, 'cause', None) or e.__cause__ or e.__context__)
+
+def _http_status(e):
+    if isinstance(e, yt_dlp.networking.exceptions.HTTPError): return e.status
+    if isinstance(e, requests.HTTPError) and e.response is not None: return e.response.status_code
+    return None
+
+def classify_error(e, via_proxy=False):
+    """Map an exception to a RETRY_POLICIES class.
+
+    Exception types and HTTP statuses decide first; message patterns are only consulted for
+    what yt-dlp reports as plain ExtractorErrors (bot checks, missing formats). Connection-level
+    failures count against the proxy when via_proxy is set and as transient otherwise.
+    """
+    chain = list(_error_chain(e))
+    for exc in chain:
+        if getattr(exc, 'error_class', None): return exc.error_class
+    if any(isinstance(exc, (yt_dlp.networking.exceptions.ProxyError, requests.exceptions.ProxyError)) for exc in chain):
+        return 'proxy_failure'
+    for status in filter(None, map(_http_status, chain)):
+        if status == 429: return 'throttled'
+        if status == 407: return 'proxy_failure'
+        if status == 403: return 'bot_check'
+        if status in (404, 410): return 'permanent'
+        if status >= 500: return 'transient'
+    if any(isinstance(exc, (yt_dlp.utils.UnsupportedError, yt_dlp.utils.GeoRestrictedError)) for exc in chain):
+        return 'permanent'
+    if any(isinstance(exc, (yt_dlp.networking.exceptions.TransportError, yt_dlp.utils.ContentTooShortError,
+                            requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError))
+           for exc in chain):
+        return 'proxy_failure' if via_proxy else 'transient'
+    if any(_BOT_CHECK_MESSAGE.search(str(exc)) for exc in chain): return 'bot_check'
+    if any(_CLIENT_FAILURE_MESSAGE.search(str(exc)) for exc in chain): return 'client_failure'
+    extractor_errors = [exc for exc in chain if isinstance(exc, yt_dlp.utils.ExtractorError)]
+    # yt-dlp marks messages meant for the user (unavailable, private, age-gated...) as expected
+    if any(exc.expected for exc in extractor_errors): return 'permanent'
+    if extractor_errors: return 'client_failure'
+    return 'transient'
+
+# Different client strategies to rotate through if one is blocked
+CLIENT_COMBINATIONS = [
+    ['android'],         # Seems to work best without POT right now
+    ['ios', 'android'],
+    ['tv', 'mweb'],
+    ['web_embedded'],
+    ['android_testsuite']
+]
+
+YTDLP_CACHE_DIR = os.path.join(STATE_DIR, 'yt-dlp')        # yt-dlp's own cache (EJS solver scripts, sig functions)
+PLAYER_JS_DIR = os.path.join(STATE_DIR, 'player-js')
+PLAYER_JS_KEEP = 8                                          # player versions kept in memory and on disk
+PLAYER_DATA_ENTRIES = 20000                                 # memoized sts/n/sig results shared between requests
+# Never fetch challenge-solver components from GitHub while serving a request
+YTDLP_OFFLINE_COMPONENTS = os.environ.get('YTDLP_OFFLINE_COMPONENTS', '0') == '1'
+EJS_RELEASE_URL = 'https://github.com/yt-dlp/ejs/releases/download/{version}/{filename}'
+os.makedirs(PLAYER_JS_DIR, exist_ok=True)
+
+def _base_ydl_opts():
+    opts = {
+        'noplaylist': True, 'quiet': False, 'verbose': True, 'nocheckcertificate': True, 'prefer_insecure': True, 'socket_timeout': 60,
+        'cachedir': YTDLP_CACHE_DIR, 'extractor_args': {'youtube': {'jsc': ['deno']}}
+    }
+    if not YTDLP_OFFLINE_COMPONENTS:
+        # Only used if the solver scripts aren't already in YTDLP_CACHE_DIR (see warm_js_components)
+        opts['remote_components'] = ['ejs:github']
+    return opts
+
+class _PlayerJSCache(dict):
+    """Stand-in for YoutubeIE._code_cache shared by every YoutubeDL in the process.
+
+    Keys are yt-dlp's player keys ('<player id>-<variant>'), i.e. one entry per player
+    version. The last PLAYER_JS_KEEP versions stay in memory and in PLAYER_JS_DIR, so a
+    restarted worker doesn't download a player it has already seen.
+    """
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(PLAYER_JS_DIR, re.sub(r'[^\w.-]', '_', key) + '.js')
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                code = f.read()
+        except OSError:
+            return default
+        with self._lock:
+            dict.__setitem__(self, key, code)
+            self._trim()
+        return code
+
+    def __setitem__(self, key, code):
+        with self._lock:
+            dict.__setitem__(self, key, code)
+            self._trim()
+        tmp = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(code)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            app.logger.warning(f"Could not store player JS {key}: {e}")
+        files = sorted(glob.glob(os.path.join(PLAYER_JS_DIR, '*.js')), key=os.path.getmtime)
+        for p in files[:-PLAYER_JS_KEEP]:
+            try: os.remove(p)
+            except OSError: pass
+
+    def _trim(self):
+        while len(self) > PLAYER_JS_KEEP:
+            dict.__delitem__(self, next(iter(self)))
+
+class _LRUDict(OrderedDict):
+    """Bounded, thread-safe dict used as the shared YoutubeIE._player_cache."""
+    def __init__(self, max_entries):
+        super().__init__()
+        self._max_entries = max_entries
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            while len(self) > self._max_entries:
+                self.popitem(last=False)
+
+_player_js_cache = _PlayerJSCache()
+_player_data_cache = _LRUDict(PLAYER_DATA_ENTRIES)
+
+def new_ydl(ydl_opts):
+    """Create a YoutubeDL whose YouTube extractor shares player JS and solved challenges process-wide."""
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    ie = ydl.get_info_extractor('Youtube')
+    ie._code_cache = _player_js_cache
+    ie._player_cache = _player_data_cache
+    return ydl
+
+def warm_js_components():
+    """Download the EJS challenge solver scripts into YTDLP_CACHE_DIR if they are missing or outdated.
+
+    With the scripts cached, yt-dlp never needs GitHub during a request. In offline mode
+    only reports what is missing.
+    """
+    try:
+        from yt_dlp.extractor.youtube.jsc._builtin.vendor import HASHES, VERSION
+    except ImportError:
+        return  # yt-dlp without the EJS solver
+    with yt_dlp.YoutubeDL({'cachedir': YTDLP_CACHE_DIR, 'quiet': True}) as ydl:
+        for script_type, filename in (('lib', 'yt.solver.lib.min.js'), ('core', 'yt.solver.core.min.js')):
+            cached = ydl.cache.load('challenge-solver', script_type)
+            if cached and cached.get('version') == VERSION and hashlib.sha3_512(cached['code'].encode()).hexdigest() == HASHES.get(filename):
+                continue
+            if YTDLP_OFFLINE_COMPONENTS:
+                app.logger.warning(f"Challenge solver {script_type} script v{VERSION} is not cached and offline mode is on")
+                continue
+            try:
+                r = http_request('ejs', 'GET', EJS_RELEASE_URL.format(version=VERSION, filename=filename), timeout=30)
+                r.raise_for_status()
+                if hashlib.sha3_512(r.text.encode()).hexdigest() != HASHES.get(filename):
+                    raise ValueError('hash mismatch')
+            except Exception as e:
+                app.logger.warning(f"Could not fetch challenge solver {script_type} script: {e}")
+                continue
+            ydl.cache.store('challenge-solver', script_type, {'version': VERSION, 'variant': 'minified', 'code': r.text})
+            app.logger.info(f"Cached challenge solver {script_type} script v{VERSION}")
+
+JS_SOLVER_POOL_SIZE = int(os.environ.get('JS_SOLVER_POOL_SIZE', '2'))        # deno processes per worker
+JS_SOLVER_TIMEOUT = int(os.environ.get('JS_SOLVER_TIMEOUT', '30'))           # seconds per solve before the process is killed
+JS_SOLVER_MAX_TASKS = int(os.environ.get('JS_SOLVER_MAX_TASKS', '500'))      # recycle a process after this many solves
+JS_SOLVER_MAX_AGE = int(os.environ.get('JS_SOLVER_MAX_AGE', '3600'))         # ... or after this many seconds
+JS_SOLVER_CHECK_INTERVAL = 60                                                # health check of idle processes
+JS_SOLVER_MEMO_ENTRIES = 50000                                               # memoized (player, challenge) results
+JS_SOLVER_DIR = os.path.join(STATE_DIR, 'jsc')
+os.makedirs(JS_SOLVER_DIR, exist_ok=True)
+
+# Appended to the EJS lib and core scripts: read one JSON request per line from stdin and
+# answer with one JSON line. Preprocessed players are kept per player URL, so a player is
+# only parsed once per process.
+_JS_SOLVER_LOOP = r'''
+const players = new Map();
+const write = (obj) => console.log(JSON.stringify(obj));
+function handle(line) {
+  const msg = JSON.parse(line);
+  if (msg.type === 'ping') return write({type: 'pong'});
+  const pre = players.get(msg.player_url);
+  let data;
+  if (pre) data = {type: 'preprocessed', preprocessed_player: pre, requests: msg.requests};
+  else if (msg.player) data = {type: 'player', player: msg.player, requests: msg.requests, output_preprocessed: true};
+  else return write({type: 'need_player'});
+  const out = jsc(data);
+  if (out.preprocessed_player) {
+    players.set(msg.player_url, out.preprocessed_player);
+    if (players.size > 4) players.delete(players.keys().next().value);
+    delete out.preprocessed_player;
+  }
+  write(out);
+}
+const decoder = new TextDecoder();
+let buf = '';
+for await (const chunk of Deno.stdin.readable) {
+  buf += decoder.decode(chunk, {stream: true});
+  let i;
+  while ((i = buf.indexOf('\n')) >= 0) {
+    const line = buf.slice(0, i);
+    buf = buf.slice(i + 1);
+    if (!line) continue;
+    try { handle(line); } catch (e) { write({type: 'error', error: String(e)}); }
+  }
+}
+'''
+
+class _SolverProcess:
+    """One long-lived deno process running the challenge solver loop."""
+    def __init__(self, deno_path, script_path, script_hash):
+        cmd = [deno_path, 'run', '--ext=js', '--no-code-cache', '--no-prompt', '--no-remote', '--no-lock',
+               '--node-modules-dir=none', '--no-config', '--no-npm', '--cached-only', script_path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     text=True, bufsize=1)
+        self.script_hash = script_hash
+        self.started = time.monotonic()
+        self.tasks = 0
+        self.players = set()  # player URLs this process has already parsed
+        self._lines = queue.Queue()
+        threading.Thread(target=self._pump, args=(self.proc.stdout, self._lines.put), daemon=True).start()
+        threading.Thread(target=self._pump, args=(self.proc.stderr, lambda l: l and app.logger.debug(f"deno: {l.rstrip()}")),
+                         daemon=True).start()
+
+    @staticmethod
+    def _pump(stream, sink):
+        for line in stream:
+            sink(line)
+        sink(None)
+
+    def call(self, msg, timeout=JS_SOLVER_TIMEOUT):
+        self.proc.stdin.write(json.dumps(msg) + '\n')
+        self.proc.stdin.flush()
+        try:
+            line = self._lines.get(timeout=timeout)
+        except queue.Empty:
+            self.close()
+            raise TimeoutError(f'challenge solver did not answer in {timeout}s')
+        if line is None:
+            raise RuntimeError(f'challenge solver exited (returncode: {self.proc.poll()})')
+        return json.loads(line)
+
+    def expired(self):
+        return (self.proc.poll() is not None or self.tasks >= JS_SOLVER_MAX_TASKS
+                or time.monotonic() - self.started > JS_SOLVER_MAX_AGE)
+
+    def close(self):
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=5)
+        except Exception:
+            pass
+
+class JSSolverPool:
+    """Pool of at most `size` solver processes, started on demand and reused across extractions.
+
+    Processes are recycled after JS_SOLVER_MAX_TASKS solves or JS_SOLVER_MAX_AGE seconds,
+    when they fail or time out, and when the solver scripts change. Idle processes are
+    pinged every JS_SOLVER_CHECK_INTERVAL seconds.
+    """
+    def __init__(self, size):
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def _script(self, lib_code, core_code):
+        code = f"{lib_code}\nObject.assign(globalThis, lib);\n{core_code}\n{_JS_SOLVER_LOOP}"
+        script_hash = hashlib.sha256(code.encode()).hexdigest()[:16]
+        path = os.path.join(JS_SOLVER_DIR, f'solver-{script_hash}.js')
+        if not os.path.exists(path):
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(code)
+            os.replace(tmp, path)
+        return path, script_hash
+
+    def _acquire(self, deno_path, lib_code, core_code):
+        path, script_hash = self._script(lib_code, core_code)
+        with self._lock:
+            while self._idle:
+                proc = self._idle.pop()
+                if proc.script_hash == script_hash and not proc.expired():
+                    return proc
+                proc.close()
+        inc_counter('streamrip_js_solver_spawns_total')
+        return _SolverProcess(deno_path, path, script_hash)
+
+    def _release(self, proc):
+        proc.tasks += 1
+        if proc.expired():
+            proc.close()
+            return
+        with self._lock:
+            self._idle.append(proc)
+
+    def solve(self, deno_path, lib_code, core_code, player_url, load_player, reqs):
+        """Send one batch of challenge requests for a player; returns the solver's JSON output."""
+        if self._checker is None:
+            self._checker = threading.Thread(target=self._check_loop, name='jsc-pool', daemon=True)
+            self._checker.start()
+        if not self._slots.acquire(timeout=JS_SOLVER_TIMEOUT):
+            raise TimeoutError('no challenge solver process available')
+        proc = None
+        try:
+            proc = self._acquire(deno_path, lib_code, core_code)
+            msg = {'type': 'solve', 'player_url': player_url, 'requests': reqs}
+            if player_url not in proc.players:
+                msg['player'] = load_player()
+            output = proc.call(msg)
+            if output.get('type') == 'need_player':
+                output = proc.call({**msg, 'player': load_player()})
+            proc.players.add(player_url)
+            self._release(proc)
+            return output
+        except BaseException:
+            if proc: proc.close()
+            raise
+        finally:
+            self._slots.release()
+
+    def _check_loop(self):
+        while True:
+            time.sleep(JS_SOLVER_CHECK_INTERVAL)
+            self._check_idle()
+
+    def _check_idle(self):
+        with self._lock:
+            pending = len(self._idle)
+        for _ in range(pending):
+            # A process being pinged holds a slot like one that is solving, so solve() can't
+            # spawn a replacement for it and the pool stays within `size` processes
+            if not self._slots.acquire(blocking=False): break  # every slot is solving, so none is idle
+            try:
+                with self._lock:
+                    if not self._idle: break
+                    proc = self._idle.pop(0)
+                try:
+                    if not proc.expired() and proc.call({'type': 'ping'}, timeout=5).get('type') == 'pong':
+                        with self._lock:
+                            self._idle.append(proc)
+                        continue
+                except Exception as e:
+                    app.logger.warning(f"Challenge solver process failed health check: {e}")
+                proc.close()
+            finally:
+                self._slots.release()
+
+_js_solver_pool = JSSolverPool(JS_SOLVER_POOL_SIZE)
+_js_solver_memo = _LRUDict(JS_SOLVER_MEMO_ENTRIES)
+
+try:
+    from yt_dlp.extractor.youtube.jsc._builtin.deno import DenoJCP
+    from yt_dlp.extractor.youtube.jsc._builtin.ejs import EJSBaseJCP
+    from yt_dlp.extractor.youtube.jsc.provider import (
+        JsChallengeProviderError, JsChallengeProviderResponse, JsChallengeResponse, JsChallengeType,
+        NChallengeOutput, SigChallengeOutput, register_preference, register_provider)
+except ImportError:
+    DenoJCP = None  # yt-dlp without JS challenge providers
+
+if DenoJCP is not None:
+    @register_provider
+    class PooledDenoJCP(DenoJCP):
+        """Solves challenges with the persistent deno processes in _js_solver_pool.
+
+        Preferred over the stock deno provider, which yt-dlp falls back to if this one fails.
+        """
+        PROVIDER_NAME = 'deno-pool'
+
+        def _iter_script_sources(self):
+            # The deno npm lib variant needs npm imports, which the pool's processes don't allow
+            yield from EJSBaseJCP._iter_script_sources(self)
+
+        def _real_bulk_solve(self, reqs):
+            grouped = OrderedDict()
+            for req in reqs:
+                grouped.setdefault(req.input.player_url, []).append(req)
+            for player_url, grouped_reqs in grouped.items():
+                errors = {}
+                todo = []
+                for i, req in enumerate(grouped_reqs):
+                    missing = [c for c in req.input.challenges
+                               if (player_url, req.type.value, c) not in _js_solver_memo]
+                    if missing:
+                        todo.append((i, req, missing))
+                if todo:
+                    video_id = next((r.video_id for r in grouped_reqs), None)
+                    self.logger.info(f'Solving JS challenges using {self.PROVIDER_NAME}')
+                    try:
+                        with timed('js_solve', site='youtube'):
+                            output = _js_solver_pool.solve(
+                                self.runtime_info.path, self._lib_script.code, self._core_script.code, player_url,
+                                lambda: self._get_player(video_id, player_url),
+                                [{'type': r.type.value, 'challenges': missing} for _, r, missing in todo])
+                    except (OSError, RuntimeError, ValueError) as e:
+                        raise JsChallengeProviderError(f'challenge solver pool failed: {e}')
+                    if output.get('type') == 'error':
+                        raise JsChallengeProviderError(output.get('error'))
+                    for (i, req, _), response_data in zip(todo, output['responses'], strict=True):
+                        if response_data['type'] == 'error':
+                            errors[i] = response_data['error']
+                            continue
+                        for challenge, solution in response_data['data'].items():
+                            _js_solver_memo[(player_url, req.type.value, challenge)] = solution
+                for i, req in enumerate(grouped_reqs):
+                    if i in errors:
+                        yield JsChallengeProviderResponse(req, None, errors[i])
+                        continue
+                    data = {c: _js_solver_memo.get((player_url, req.type.value, c)) for c in req.input.challenges}
+                    yield JsChallengeProviderResponse(req, JsChallengeResponse(req.type, (
+                        NChallengeOutput(data) if req.type is JsChallengeType.N else SigChallengeOutput(data))))
+
+    @register_preference(PooledDenoJCP)
+    def _pooled_deno_preference(provider, reqs):
+        return 2000
+
+STRATEGY_LOG = os.path.join(STATE_DIR, 'strategy_events.jsonl')
+STRATEGY_WINDOW = int(os.environ.get('STRATEGY_WINDOW', str(6 * 3600)))  # seconds of history that count
+STRATEGY_EXPLORE = float(os.environ.get('STRATEGY_EXPLORE', '0.1'))     # chance to try a non-best strategy first
+# Priors for strategies with little history, so they look plausible rather than perfect or hopeless
+STRATEGY_PRIOR_SUCCESS_TIME = 30.0
+STRATEGY_PRIOR_FAILURE_TIME = 20.0
+
+STRATEGY_LOG_COMPACT_BYTES = 1024 * 1024  # logs smaller than this are never compacted
+
+# All workers append outcomes to one JSON-lines log; each keeps a parsed copy and reads only
+# the lines appended since its last read. Once the log is large and its oldest event is two
+# windows old, the stale half is compacted away, so a rewrite happens at most once a window.
+_strategy_events = deque()
+_strategy_log_offset = 0
+_strategy_log_head = None  # first line when last read; it changes when the log is compacted
+_strategy_lock = threading.Lock()
+
+def _strategy_key(clients, mode):
+    return f"{'+'.join(clients)}|{mode}"
+
+def _load_strategy_events():
+    global _strategy_log_offset, _strategy_log_head
+    cutoff = time.time() - STRATEGY_WINDOW
     try:
-        if request.method == 'POST':
-            data = request.get_json() or {}
-            url, target_format = data.get('url'), data.get('format', 'mp3')
+        with open(STRATEGY_LOG, 'rb') as f:
+            head = f.readline()
+            if head != _strategy_log_head or os.fstat(f.fileno()).st_size < _strategy_log_offset:
+                _strategy_events.clear()
+                _strategy_log_offset, _strategy_log_head = 0, head
+            f.seek(_strategy_log_offset)
+            data = f.read()
+    except OSError:
+        return
+    end = data.rfind(b'\n') + 1  # a line still being written is picked up next time
+    for line in data[:end].splitlines():
+        try:
+            e = json.loads(line)
+        except ValueError: continue
+        if e['ts'] >= cutoff: _strategy_events.append(e)
+    _strategy_log_offset += end
+    while _strategy_events and _strategy_events[0]['ts'] < cutoff: _strategy_events.popleft()
+
+def _oldest_strategy_event():
+    with open(STRATEGY_LOG) as f:
+        try:
+            return json.loads(f.readline())['ts']
+        except (ValueError, KeyError):
+            return 0  # a torn first line is compacted away too
+
+def record_strategy(key, ok, elapsed):
+    """Record the outcome of one attempt made with strategy `key`."""
+    line = json.dumps({'s': key, 'ok': ok, 't': round(elapsed, 3), 'ts': time.time()}) + '\n'
+    with _strategy_lock:
+        with open(STRATEGY_LOG, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+            f.flush()
+            if f.tell() > STRATEGY_LOG_COMPACT_BYTES and _oldest_strategy_event() < time.time() - 2 * STRATEGY_WINDOW:
+                _compact_strategy_log()
+
+def _compact_strategy_log():
+    # Caller holds the log's flock. The file is rewritten in place: replacing it would leave
+    # writers already waiting for the lock appending to the old, unlinked file.
+    cutoff = time.time() - STRATEGY_WINDOW
+    with open(STRATEGY_LOG, 'r+') as f:
+        keep = []
+        for line in f:
+            try:
+                e = json.loads(line)
+            except ValueError: continue
+            if e['ts'] >= cutoff: keep.append(line if line.endswith('\n') else line + '\n')
+        f.seek(0)
+        f.writelines(keep)
+        f.truncate()
+
+def strategy_stats():
+    """Per-strategy success rate, latency and expected time-to-success over the sliding window."""
+    with _strategy_lock:
+        _load_strategy_events()
+        events = list(_strategy_events)
+    stats = {}
+    for mode in ('proxy', 'direct'):
+        for clients in CLIENT_COMBINATIONS:
+            stats[_strategy_key(clients, mode)] = {'clients': clients, 'mode': mode, 'attempts': 0, 'successes': 0,
+                                                   'success_time': 0.0, 'failure_time': 0.0}
+    for e in events:
+        st = stats.get(e['s'])
+        if not st: continue
+        st['attempts'] += 1
+        if e['ok']:
+            st['successes'] += 1
+            st['success_time'] += e['t']
         else:
-            url, target_format = request.args.get('url'), request.args.get('format', 'mp3')
+            st['failure_time'] += e['t']
+    for st in stats.values():
+        failures = st['attempts'] - st['successes']
+        # Beta(1, 1) prior on success and one pseudo-observation for each latency
+        p = (st['successes'] + 1) / (st['attempts'] + 2)
+        ls = (st.pop('success_time') + STRATEGY_PRIOR_SUCCESS_TIME) / (st['successes'] + 1)
+        lf = (st.pop('failure_time') + STRATEGY_PRIOR_FAILURE_TIME) / (failures + 1)
+        st['success_rate'] = round(p, 3)
+        st['mean_success_time'] = round(ls, 2)
+        st['mean_failure_time'] = round(lf, 2)
+        # Expected time if we kept retrying this strategy until it succeeds (geometric)
+        st['expected_time'] = round(ls + lf * (1 - p) / p, 2)
+    return stats
 
-        if not url: return jsonify({'error': 'URL required'}), 400
+def plan_strategies(url):
+    """Return the (clients, mode) attempts to make for url, best expected time first.
 
-        is_youtube = 'youtube.com' in url or 'youtu.be' in url
-        is_instagram = 'instagram.com' in url
-        unique_id = str(uuid.uuid4())
-        output_template = os.path.join(DOWNLOAD_FOLDER, f'%(title)s_{unique_id}.%(ext)s')
-
-        ydl_opts = {
-            'outtmpl': output_template,
-            'format': 'bestaudio/best' if target_format == 'mp3' else 'bestvideo[ext=mp4][height<=1080]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-            'noplaylist': True, 'quiet': False, 'verbose': True, 'nocheckcertificate': True, 'prefer_insecure': True, 'socket_timeout': 60,
-            'remote_components': ['ejs:github'], 'extractor_args': {'youtube': {'jsc': ['deno']}}
-        }
-        if target_format == 'mp3':
-            ydl_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]
-        elif target_format == 'mp4': ydl_opts['merge_output_format'] = 'mp4'
-
-        attempts = 5
-        last_error = ""
-        downloaded_file, info = None, None
-
-        # Different client strategies to rotate through if one is blocked
-        client_combinations = [
-            ['android'],         # Seems to work best without POT right now
-            ['ios', 'android'],
-            ['tv', 'mweb'],
-            ['web_embedded'],
-            ['android_testsuite']
-        ]
-
-        for attempt in range(attempts):
-            app.logger.info(f"Download attempt {attempt+1}/{attempts}")
-            if is_youtube:
-                current_clients = client_combinations[attempt % len(client_combinations)]
-                app.logger.info(f"Using player_client: {current_clients}")
-                # Update bypass clients
-                ydl_opts['extractor_args']['youtube'].update({
-                    'player_client': current_clients,
-                    'player_skip': ['web', 'web_creator']
-                })
-                # Decide proxy vs local IP (local IP needs PO Token)
-                proxy = get_residential_proxy()
-                if proxy:
-                    ydl_opts['proxy'] = proxy
-                    app.logger.info(f"Trying with proxy: {proxy}")
-                    # Remove PO token when using proxy (IP binding mismatch)
-                    ydl_opts['extractor_args']['youtube'].pop('po_token', None)
-                    ydl_opts['extractor_args']['youtube'].pop('visitor_data', None)
-                else:
-                    app.logger.info("Direct connection - fetching PO Token")
-                    pot, visitor = get_po_token()
-                    if pot:
-                        # Append POT for all rotated clients dynamically
-                        tokens = [f"{c}+{pot}" for c in current_clients if c not in ['android', 'android_testsuite']]
-                        if tokens:
-                            ydl_opts['extractor_args']['youtube']['po_token'] = tokens
-                        if visitor: ydl_opts['extractor_args']['youtube']['visitor_data'] = [visitor]
-                    if os.environ.get('FLASK_ENV') == 'production' and PROXY_URL:
-                        try:
-                            # Verify if the main datacenter proxy works
-                            r = requests.get('https://m.youtube.com', proxies={'http': PROXY_URL, 'https': PROXY_URL}, timeout=3)
-                            if r.status_code == 200:
-                                ydl_opts['proxy'] = PROXY_URL
-                                app.logger.info(f"Using production proxy: {PROXY_URL}")
-                        except: pass
-            elif os.environ.get('FLASK_ENV') == 'production' and PROXY_URL:
+    Non-YouTube URLs get a single [None] plan since player clients don't apply.
+    """
+    if not ('youtube.com' in url or 'youtu.be' in url):
+        return [None]
+    stats = strategy_stats()
+    have_proxies = bool(_usable_proxies())
+    ranked = sorted((st for st in stats.values() if have_proxies or st['mode'] == 'direct'),
+                    key=lambda st: st['expected_time'])
+    plan = [(st['clients'], st['mode']) for st in ranked]
+    if len(plan) > 1 and random.random() < STRATEGY_EXPLORE:
+        plan.insert(0, plan.pop(random.randrange(1, len(plan))))
+    return plan
+
+def _configure_attempt(ydl_opts, url, strategy, avoid_proxies=()):
+    """Set player clients, proxy, PO token and cookies on ydl_opts for one attempt.
+
+    strategy is a (clients, mode) pair from plan_strategies(), or None for non-YouTube URLs.
+    avoid_proxies are pool proxies that already failed this request.
+    Returns (proxy, strategy_key): the residential proxy in use (or None) and the key of the
+    strategy actually used, which differs from the plan when no proxy was available.
+    """
+    is_youtube = strategy is not None
+    proxy = None
+    ydl_opts.pop('proxy', None)
+    current_clients, mode = strategy or (None, None)
+    if is_youtube:
+        app.logger.info(f"Using player_client: {current_clients}")
+        # Update bypass clients
+        ydl_opts['extractor_args']['youtube'].update({
+            'player_client': current_clients,
+            'player_skip': ['web', 'web_creator']
+        })
+        # Remove PO token from the previous attempt; a proxy can't use it anyway (IP binding mismatch)
+        ydl_opts['extractor_args']['youtube'].pop('po_token', None)
+        ydl_opts['extractor_args']['youtube'].pop('visitor_data', None)
+        # Decide proxy vs local IP (local IP needs PO Token)
+        proxy = get_residential_proxy(avoid_proxies) if mode == 'proxy' else None
+        if proxy:
+            ydl_opts['proxy'] = proxy
+            app.logger.info(f"Trying with proxy: {proxy}")
+        else:
+            # The datacenter proxy is used while the monitor thread sees it working
+            if PROXY_MONITOR_ENABLED and production_proxy_up():
                 ydl_opts['proxy'] = PROXY_URL
-            
-            if os.path.exists(COOKIES_FILE): ydl_opts['cookiefile'] = COOKIES_FILE
-            if is_instagram: ydl_opts['user_agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+                app.logger.info("Using production proxy")
+            app.logger.info("Direct connection - fetching PO Token")
+            pot, visitor = get_po_token(ydl_opts.get('proxy'))
+            if pot:
+                # Append POT for all rotated clients dynamically
+                tokens = [f"{c}+{pot}" for c in current_clients if c not in ['android', 'android_testsuite']]
+                if tokens:
+                    ydl_opts['extractor_args']['youtube']['po_token'] = tokens
+                if visitor: ydl_opts['extractor_args']['youtube']['visitor_data'] = [visitor]
+    elif os.environ.get('FLASK_ENV') == 'production' and PROXY_URL:
+        ydl_opts['proxy'] = PROXY_URL
+
+    if os.path.exists(COOKIES_FILE): ydl_opts['cookiefile'] = COOKIES_FILE
+    if 'instagram.com' in url: ydl_opts['user_agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+    return proxy, _strategy_key(current_clients, 'proxy' if proxy else 'direct') if is_youtube else None
+
+class _AttemptPlan:
+    """Walks plan_strategies(url) for one request, following RETRY_POLICIES after each failure."""
+    def __init__(self, url):
+        self.plan = plan_strategies(url)
+        self.index = 0
+        self.attempts = 0
+        self.failures = {}
+        self.last_error, self.last_class = None, 'transient'
+        self.backoff = 0
+        self.avoid_proxies = set()
+        self.failed_strategies = []  # strategies that already failed this request; never hedged with
+
+    def strategy(self):
+        self.attempts += 1
+        return self.plan[self.index % len(self.plan)]
+
+    def _advance(self, same_clients):
+        """Move to the next strategy with the same (or, if not same_clients, different) clients."""
+        current = self.plan[self.index % len(self.plan)]
+        for step in range(1, len(self.plan)):
+            candidate = self.plan[(self.index + step) % len(self.plan)]
+            if (candidate[0] == current[0]) == same_clients and (not same_clients or candidate[1] == 'proxy'):
+                self.index += step
+                return
+        if not same_clients: self.index += 1
+
+    def failed(self, e, strategy, proxy, ydl_opts, strategy_key, elapsed):
+        """Record a failed attempt and update proxy/token state. Returns True if another attempt may help."""
+        if strategy not in self.failed_strategies: self.failed_strategies.append(strategy)
+        cls = classify_error(e, via_proxy=bool(ydl_opts.get('proxy')))
+        self.last_error, self.last_class = e, cls
+        policy = RETRY_POLICIES[cls]
+        count = self.failures[cls] = self.failures.get(cls, 0) + 1
+        app.logger.warning(f"Attempt failed ({cls}): {e}")
+        if cls == 'bot_check':
+            app.logger.error("Youtube still detecting us as bot with this proxy/setup.")
+            if not proxy: invalidate_po_token(ydl_opts.get('proxy'))
+        if proxy:
+            record_proxy_result(proxy, cls)
+            if policy.switch_proxy: self.avoid_proxies.add(proxy)
+        # Only blocking-style errors say anything about the strategy itself
+        if strategy_key and policy.blames_strategy: record_strategy(strategy_key, False, elapsed)
+        if not policy.retry or count >= policy.max_attempts or self.attempts >= DOWNLOAD_ATTEMPTS:
+            return False
+        current = self.plan[self.index % len(self.plan)]
+        if current and policy.switch_client: self._advance(same_clients=False)
+        elif current and policy.switch_proxy and current[1] == 'direct': self._advance(same_clients=True)
+        self.backoff = min(RETRY_BACKOFF_MAX, policy.backoff * 2 ** (count - 1)) * random.uniform(0.8, 1.2)
+        return True
+
+    def hedge(self, running):
+        """A strategy to race against the running ones: another route first, then other clients.
+
+        Candidates are taken in plan order from the current position, skipping strategies
+        that are running or already failed for this request.
+        """
+        if self.attempts >= DOWNLOAD_ATTEMPTS: return None
+        routes = {s[1] for s in running if s}
+        ahead = [self.plan[(self.index + i) % len(self.plan)] for i in range(len(self.plan))]
+        candidates = sorted((s for s in ahead if s and s not in running and s not in self.failed_strategies),
+                            key=lambda s: s[1] in routes)
+        if not candidates: return None
+        self.attempts += 1
+        return candidates[0]
+
+    def error(self):
+        return DownloadError(f'Failed after {self.attempts} attempts. Last: {self.last_error}',
+                             ERROR_STATUS.get(self.last_class, 502), self.last_class)
+
+class _Cancelled(Exception):
+    """Raised inside an attempt that lost a hedged race."""
+    error_class = 'cancelled'
+
+class _Attempt:
+    """One strategy being tried on its own thread, with its own copy of the yt-dlp options."""
+    def __init__(self, strategy, number, ydl_opts, race):
+        self.strategy, self.number = strategy, number
+        self.id = uuid.uuid4().hex
+        self.ydl_opts = copy.deepcopy(ydl_opts)
+        self.proxy = self.strategy_key = self.throughput = None
+        self.cancelled = threading.Event()
+        self.started = self.last_progress = time.monotonic()
+        self._race = race
 
+    def progress(self):
+        """Note progress; returns True if this attempt is the one reporting it. Aborts a cancelled attempt."""
+        if self.cancelled.is_set(): raise _Cancelled(f'Attempt {self.number} lost the race')
+        self.last_progress = time.monotonic()
+        with self._race['lock']:
+            if self._race['leader'] is None: self._race['leader'] = self
+            return self._race['leader'] is self
+
+def run_attempts(url, ydl_opts, run, cleanup=None):
+    """Try the strategy plan for url until run(attempt) returns; returns (result, attempt).
+
+    Each attempt runs on its own thread with attempt.ydl_opts already set up by
+    _configure_attempt(). When the running attempt makes no progress for HEDGE_AFTER
+    seconds (run calls attempt.progress() as it goes) a second strategy is started
+    next to it and the first to finish wins. Losers are told to stop through
+    attempt.progress() and cleanup(attempt) removes whatever they left behind;
+    an extraction that is still talking to YouTube can't be interrupted and is
+    cleaned up when it returns.
+    """
+    plan = _AttemptPlan(url)
+    race = {'lock': threading.Lock(), 'leader': None}
+    results = queue.Queue()
+    running = []
+
+    def attempt_thread(attempt):
+        try:
+            attempt.proxy, attempt.strategy_key = _configure_attempt(attempt.ydl_opts, url, attempt.strategy, plan.avoid_proxies)
+            outcome = (run(attempt), None)
+        except Exception as e:
+            outcome = (None, e)
+        # Checked under the lock run_attempts cancels under, so a result is either read or cleaned up
+        with race['lock']:
+            if not attempt.cancelled.is_set():
+                results.put((attempt, *outcome))
+                return
+        if cleanup: cleanup(attempt)
+
+    def launch(strategy, hedge=False):
+        attempt = _Attempt(strategy, plan.attempts, ydl_opts, race)
+        app.logger.info(f"{'Hedged attempt' if hedge else 'Attempt'} {attempt.number}/{DOWNLOAD_ATTEMPTS} for {url}")
+        running.append(attempt)
+        threading.Thread(target=attempt_thread, args=(attempt,), daemon=True, name=f'attempt-{attempt.id[:8]}').start()
+
+    launch(plan.strategy())
+    can_hedge = HEDGE_AFTER > 0
+    try:
+        while True:
+            hedge_at = running[0].last_progress + HEDGE_AFTER if can_hedge and len(running) == 1 else None
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    if not info:
-                        raise Exception("yt-dlp returned no info")
-                    
-                    rd = info.get('requested_downloads')
-                    downloaded_file = rd[0]['filepath'] if rd and rd[0].get('filepath') else ydl.prepare_filename(info)
-                    if target_format == 'mp3' and not downloaded_file.endswith('.mp3'):
-                        base, _ = os.path.splitext(downloaded_file)
-                        if os.path.exists(base + '.mp3'): downloaded_file = base + '.mp3'
-                    
-                    if os.path.exists(downloaded_file):
-                        app.logger.info(f"Successfully downloaded: {downloaded_file}")
-                        break
-            except Exception as e:
-                last_error = str(e)
-                app.logger.warning(f"Attempt failed: {last_error}")
-                # Log more details on the error to see blocking patterns
-                if "Sign in to confirm" in last_error or "not a bot" in last_error:
-                    app.logger.error("Youtube still detecting us as bot with this proxy/setup.")
-                
-                # If it's a permanent error (not a proxy/bot detect), don't bother retrying 
-                # (unless it's a proxy error, then we *do* want to retry with a different proxy)
-                if "ProxyError" not in last_error and "403" not in last_error and "timed out" not in last_error and "reset by peer" not in last_error:
-                     # e.g. "Video unavailable" or "Invalud URL"
-                     if "bot" not in last_error: break
-        else: return jsonify({'error': f'Failed after {attempts} attempts. Last: {last_error}'}), 500
-
-        # Success handling - info is guaranteed to be truthy due to the check above
-        original_title = info.get('title', 'video')
-        clean_title = re.sub(r'[\\/*?:"<>|]', '', original_title)[:100].strip()
-        download_name = f"{clean_title}.{target_format}"
-        mimetype = 'video/mp4' if target_format == 'mp4' else 'audio/mpeg'
-        
-        @after_this_request
-        def remove_file(response):
+                attempt, result, error = results.get(timeout=max(0, hedge_at - time.monotonic()) if hedge_at else None)
+            except queue.Empty:
+                strategy = plan.hedge([a.strategy for a in running])
+                if strategy is None:
+                    can_hedge = False  # nothing left to race with; just wait for the running attempt
+                else:
+                    inc_counter('streamrip_hedges_total', outcome='started')
+                    launch(strategy, hedge=True)
+                continue
+            running.remove(attempt)
+            with race['lock']:
+                if race['leader'] is attempt: race['leader'] = None
+            if error is None:
+                if attempt.strategy_key: record_strategy(attempt.strategy_key, True, time.monotonic() - attempt.started)
+                if attempt.proxy: record_proxy_result(attempt.proxy, throughput=attempt.throughput)
+                if running: inc_counter('streamrip_hedges_total', outcome='won' if attempt.number > running[0].number else 'lost')
+                return result, attempt
+            if cleanup: cleanup(attempt)
+            retry = plan.failed(error, attempt.strategy, attempt.proxy, attempt.ydl_opts, attempt.strategy_key, time.monotonic() - attempt.started)
+            # A permanent error fails the same way for every strategy, so don't wait for the other one
+            if (not running and not retry) or not RETRY_POLICIES[plan.last_class].retry:
+                raise plan.error()
+            if not running:
+                if plan.backoff: time.sleep(plan.backoff)
+                launch(plan.strategy())
+    finally:
+        with race['lock']:
+            for attempt in running: attempt.cancelled.set()
+        # Attempts that finished before they were cancelled left results nobody will read
+        while True:
             try:
-                if downloaded_file and os.path.exists(downloaded_file): os.remove(downloaded_file)
-            except: pass
+                attempt, _, _ = results.get_nowait()
+            except queue.Empty:
+                break
+            if cleanup: cleanup(attempt)
+
+def run_download(url, target_format, on_stage=None):
+    """Run the extract/download/transcode pipeline for url and return the finished file.
+
+    Returns {'path', 'download_name', 'mimetype', 'cached', 'sha256'}; cached files belong
+    to the result cache and must not be deleted by the caller. on_stage(state, **progress) is
+    called as the pipeline moves through 'extracting', 'downloading' and 'transcoding',
+    and on every yt-dlp progress/postprocessor hook with the details of that stage.
+    """
+    stage = on_stage or (lambda state, **progress: None)
+    labels = {'site': site_label(url), 'format': target_format}
+    try:
+        result = _run_download(url, target_format, stage)
+    except Exception as e:
+        inc_counter('streamrip_downloads_total', outcome='error', error=classify_error(e), **labels)
+        raise
+    inc_counter('streamrip_downloads_total', outcome='ok', error='', **labels)
+    return result
+
+def _run_download(url, target_format, stage):
+    cache_key = result_cache_key(url, target_format)
+    if not cache_key:
+        return _download_uncached(url, target_format, None, stage)
+
+    cached = lookup_result(cache_key, target_format)
+    if not cached:
+        inc_counter('streamrip_result_cache_total', outcome='miss')
+        def on_wait():
+            inc_counter('streamrip_coalesced_total')
+            stage('queued', coalesced=True)
+        with single_flight(cache_key, on_wait=on_wait) as waited:
+            cached = lookup_result(cache_key, target_format) if waited else None
+            if not cached:
+                return _download_uncached(url, target_format, cache_key, stage)
+    else:
+        inc_counter('streamrip_result_cache_total', outcome='hit')
+    return _cached_result(cache_key, target_format, cached)
+
+def _cached_result(cache_key, target_format, cached):
+    """The run_download result for a result cache entry."""
+    app.logger.info(f"Serving {cache_key} from result cache")
+    mimetype = 'video/mp4' if target_format == 'mp4' else 'audio/mpeg'
+    return {'path': cached['path'], 'download_name': cached['download_name'], 'mimetype': mimetype, 'cached': True,
+            'sha256': cached.get('sha256') or file_sha256(cached['path'])}
+
+class _PhaseTimer:
+    """Splits one yt-dlp run into extraction, media download and postprocessing time via its hooks."""
+    def __init__(self, **labels):
+        self.labels = labels
+        self.start = time.monotonic()
+        self.download_start = self.download_end = None
+        self.pp_started = {}
+
+    def on_progress(self, d):
+        now = time.monotonic()
+        if self.download_start is None: self.download_start = now
+        if d['status'] == 'finished': self.download_end = now
+
+    def on_postprocessor(self, d):
+        if d['status'] == 'started':
+            self.pp_started[d.get('postprocessor')] = time.monotonic()
+        elif d['status'] == 'finished' and d.get('postprocessor') in self.pp_started:
+            observe('streamrip_stage_duration_seconds', time.monotonic() - self.pp_started.pop(d.get('postprocessor')),
+                    stage='postprocess', outcome='ok', error='', **self.labels)
+
+    def finish(self, error=None):
+        """Record the stages of this run; a failure is charged to the stage that was running."""
+        now = time.monotonic()
+        failed = {'outcome': 'error', 'error': classify_error(error)} if error else None
+        ok = {'outcome': 'ok', 'error': ''}
+        extract_end = self.download_start or now
+        observe('streamrip_stage_duration_seconds', extract_end - self.start, stage='extraction',
+                **(failed if failed and self.download_start is None else ok), **self.labels)
+        if self.download_start is not None:
+            observe('streamrip_stage_duration_seconds', (self.download_end or now) - self.download_start, stage='download',
+                    **(failed if failed and self.download_end is None else ok), **self.labels)
+        for started in self.pp_started.values():
+            observe('streamrip_stage_duration_seconds', now - started, stage='postprocess', **(failed or ok), **self.labels)
+
+def _route_label(proxy, ydl_opts):
+    if proxy: return 'proxy'
+    return 'production_proxy' if ydl_opts.get('proxy') else 'direct'
+
+def _download_uncached(url, target_format, cache_key, stage):
+    mimetype = 'video/mp4' if target_format == 'mp4' else 'audio/mpeg'
+    ydl_opts = _base_ydl_opts()
+    ydl_opts['format'] = 'bestaudio/best' if target_format == 'mp3' else f'bestvideo[ext=mp4][height<={MP4_MAX_HEIGHT}]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+    # MP3 conversion happens after the download, in a transcode slot (see transcode_file)
+    if target_format == 'mp4': ydl_opts['merge_output_format'] = 'mp4'
+    labels = {'site': site_label(url), 'format': target_format}
+    # Hedged attempts report from their own threads
+    stage_lock = threading.Lock()
+    def report(state, **progress):
+        with stage_lock: stage(state, **progress)
+
+    def set_hooks(opts, timer, attempt=None):
+        def progress_hook(d):
+            timer.on_progress(d)
+            leading = attempt.progress() if attempt else True
+            if attempt and d['status'] == 'finished' and d.get('elapsed'):
+                attempt.throughput = (d.get('total_bytes') or d.get('downloaded_bytes') or 0) / d['elapsed']
+            if d['status'] == 'downloading' and leading:
+                report('downloading', downloaded_bytes=d.get('downloaded_bytes'),
+                       total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+                       speed=d.get('speed'), eta=d.get('eta'))
+
+        def postprocessor_hook(d):
+            timer.on_postprocessor(d)
+            if attempt: attempt.progress()
+            report('transcoding', postprocessor=d.get('postprocessor'), postprocessor_status=d.get('status'))
+
+        opts['progress_hooks'] = [progress_hook]
+        opts['postprocessor_hooks'] = [postprocessor_hook]
+
+    def remove_outputs(token):
+        """Delete the partial, fragment and finished files of the yt-dlp run whose outtmpl ends in token."""
+        for path in glob.glob(os.path.join(glob.escape(DOWNLOAD_FOLDER), f'*_{token}.*')):
+            try: os.remove(path)
+            except OSError: pass
+
+    downloaded_file, info = None, None
+
+    # Reuse a recent extraction (from /api/info, another format or a retry) while its stream URLs are valid
+    cached = get_cached_info(url, with_urls=True)
+    if cached:
+        cached_info, egress = cached
+        stage('extracting', cached_info=True)
+        token = uuid.uuid4().hex
+        opts = dict(ydl_opts, outtmpl=os.path.join(DOWNLOAD_FOLDER, f'%(title)s_{token}.%(ext)s'))
+        if egress: opts['proxy'] = egress
+        if os.path.exists(COOKIES_FILE): opts['cookiefile'] = COOKIES_FILE
+        timer = _PhaseTimer(client='cached_info', route='proxy' if egress else 'direct', **labels)
+        set_hooks(opts, timer)
+        try:
+            with new_ydl(opts) as ydl:
+                info = ydl.process_ie_result(cached_info, download=True)
+                downloaded_file = _downloaded_path(ydl, info, target_format)
+            timer.finish()
+            app.logger.info(f"Downloaded {url} from cached info")
+        except Exception as e:
+            timer.finish(e)
+            app.logger.warning(f"Download from cached info failed, extracting again: {e}")
+            drop_cached_info(url)
+            remove_outputs(token)
+            downloaded_file = None
+
+    def download(attempt):
+        opts = attempt.ydl_opts
+        opts['outtmpl'] = os.path.join(DOWNLOAD_FOLDER, f'%(title)s_{attempt.id}.%(ext)s')
+        report('extracting', attempt=attempt.number, attempts=DOWNLOAD_ATTEMPTS, strategy=attempt.strategy_key)
+        timer = _PhaseTimer(client='+'.join(attempt.strategy[0]) if attempt.strategy else '',
+                            route=_route_label(attempt.proxy, opts), **labels)
+        set_hooks(opts, timer, attempt)
+        try:
+            with new_ydl(opts) as ydl:
+                info = ydl.extract_info(url, download=True)
+                if not info:
+                    raise Exception("yt-dlp returned no info")
+                attempt.progress()
+                cache_info(url, info, opts.get('proxy'))
+                downloaded_file = _downloaded_path(ydl, info, target_format)
+            if not os.path.exists(downloaded_file):
+                raise Exception(f"yt-dlp reported {downloaded_file} but it doesn't exist")
+        except Exception as e:
+            timer.finish(e)
+            raise
+        timer.finish()
+        app.logger.info(f"Successfully downloaded: {downloaded_file}")
+        return info, downloaded_file
+
+    def remove_partial(attempt):
+        remove_outputs(attempt.id)
+
+    if not (downloaded_file and os.path.exists(downloaded_file)):
+        (info, downloaded_file), _ = run_attempts(url, ydl_opts, download, cleanup=remove_partial)
+
+    if target_format == 'mp3':
+        downloaded_file = transcode_file(downloaded_file, target_format, stage, site=labels['site'])
+    download_name = _download_name(info, target_format)
+    sha256 = file_sha256(downloaded_file)
+    cached_file = publish_result(cache_key, target_format, downloaded_file, download_name) if cache_key else None
+    if cached_file:
+        return {'path': cached_file, 'download_name': download_name, 'mimetype': mimetype, 'cached': True, 'sha256': sha256}
+    return {'path': downloaded_file, 'download_name': download_name, 'mimetype': mimetype, 'cached': False, 'sha256': sha256}
+
+def _downloaded_path(ydl, info, target_format):
+    rd = info.get('requested_downloads')
+    downloaded_file = rd[0]['filepath'] if rd and rd[0].get('filepath') else ydl.prepare_filename(info)
+    if target_format == 'mp3' and not downloaded_file.endswith('.mp3'):
+        base, _ = os.path.splitext(downloaded_file)
+        if os.path.exists(base + '.mp3'): downloaded_file = base + '.mp3'
+    return downloaded_file
+
+def _download_name(info, target_format):
+    original_title = info.get('title', 'video')
+    clean_title = re.sub(r'[\\/*?:"<>|]', '', original_title)[:100].strip()
+    return f"{clean_title}.{target_format}"
+
+# Transcoding is CPU-bound, so it is capped per machine rather than per worker: every ffmpeg
+# run holds one of TRANSCODE_SLOTS lock files. Runs that find no free slot wait in a FIFO
+# shared by all workers: each takes a ticket file named after its arrival time and holds a
+# lock on it while it waits, and only the oldest live ticket may take a slot that frees up.
+# A ticket whose lock is free belongs to a waiter that died and is skipped.
+TRANSCODE_SLOTS = int(os.environ.get('TRANSCODE_SLOTS', str(len(os.sched_getaffinity(0)))))  # default: usable cores
+TRANSCODE_QUEUE_TIMEOUT = int(os.environ.get('TRANSCODE_QUEUE_TIMEOUT', '600'))  # seconds to wait for a free slot
+TRANSCODE_QUEUE_DIR = os.path.join(LOCK_DIR, 'transcode-queue')
+os.makedirs(TRANSCODE_QUEUE_DIR, exist_ok=True)
+
+def _take_ticket():
+    """Join the transcode queue; returns (ticket name, fd holding its lock)."""
+    name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    tmp = os.path.join(TRANSCODE_QUEUE_DIR, f'.{name}.tmp')
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    # Renamed only once locked, so no one mistakes it for an abandoned ticket
+    os.replace(tmp, os.path.join(TRANSCODE_QUEUE_DIR, name))
+    return name, fd
+
+def _first_in_line(ticket):
+    """True if no live ticket is older than ticket; removes abandoned tickets on the way."""
+    for name in sorted(n for n in os.listdir(TRANSCODE_QUEUE_DIR) if not n.startswith('.')):
+        if name >= ticket: return True
+        path = os.path.join(TRANSCODE_QUEUE_DIR, name)
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False  # an older waiter is still alive
+        else:
+            try: os.remove(path)
+            except OSError: pass
+        finally:
+            os.close(fd)
+    return True
+
+def _try_slot():
+    for i in random.sample(range(TRANSCODE_SLOTS), TRANSCODE_SLOTS):
+        fd = os.open(os.path.join(LOCK_DIR, f'transcode-slot-{i}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+@contextlib.contextmanager
+def transcode_slot(on_wait=None, **labels):
+    """Hold one of the machine-wide transcode slots for the duration of the block.
+
+    Waits in line behind earlier callers from any worker, for up to TRANSCODE_QUEUE_TIMEOUT.
+    """
+    deadline = time.monotonic() + TRANSCODE_QUEUE_TIMEOUT
+    fd = None
+    with timed('transcode_queue', **labels):
+        ticket, ticket_fd = _take_ticket()
+        try:
+            while fd is None:
+                if _first_in_line(ticket): fd = _try_slot()
+                if fd is None:
+                    if on_wait: on_wait(); on_wait = None
+                    if time.monotonic() > deadline:
+                        raise DownloadError('Server is busy transcoding, try again later', 503, 'overloaded')
+                    time.sleep(0.05)
+        finally:
+            try: os.remove(os.path.join(TRANSCODE_QUEUE_DIR, ticket))
+            except OSError: pass
+            os.close(ticket_fd)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+def _reap(proc):
+    """Wait for proc and return the CPU seconds (user + system) it used."""
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:  # already reaped by Popen
+        proc.wait()
+        return 0.0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+def transcode_file(src, target_format, stage, **labels):
+    """Convert a downloaded file to MP3 in a transcode slot and return the new path.
+
+    Replaces yt-dlp's FFmpegExtractAudio so the CPU-heavy part of a download is queued
+    separately from the network-bound part. The source file is removed on success.
+    """
+    if src.endswith(f'.{target_format}'): return src
+    dst = f"{os.path.splitext(src)[0]}.{target_format}"
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    with transcode_slot(on_wait=lambda: stage('queued', transcode_slot=False), format=target_format, **labels):
+        stage('transcoding', postprocessor='ffmpeg', postprocessor_status='started')
+        with timed('transcode', format=target_format, **labels) as m:
+            proc = subprocess.Popen(
+                ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-threads', '1', '-y', '-i', src, '-vn',
+                 '-f', 'mp3', '-b:a', f'{MP3_QUALITY}k', tmp],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            stderr = proc.stderr.read()
+            cpu = _reap(proc)
+            observe('streamrip_transcode_cpu_seconds', cpu, format=target_format, **labels)
+            if proc.returncode != 0:
+                m.update(outcome='error', error='ffmpeg_failed')
+                try: os.remove(tmp)
+                except OSError: pass
+                raise DownloadError(f"ffmpeg failed (exit {proc.returncode}): {stderr.decode(errors='replace').strip()[-500:]}")
+    os.replace(tmp, dst)
+    os.remove(src)
+    stage('transcoding', postprocessor='ffmpeg', postprocessor_status='finished', cpu_seconds=round(cpu, 3))
+    return dst
+
+STREAM_CHUNK_SIZE = 10 * 1024 * 1024  # YouTube throttles un-ranged requests, so fetch in ranges like yt-dlp
+STREAM_READ_SIZE = 64 * 1024
+
+def extract_media_info(url, format_spec='bestaudio/best', with_urls=True):
+    """Extract info for url without downloading, answering from the info cache when possible.
+
+    Uses the same client/proxy/PO token rotation as run_download and returns (info, egress)
+    where egress is the proxy the stream URLs are bound to. with_urls=False accepts cached
+    entries whose stream URLs have expired (metadata only).
+    """
+    ydl_opts = _base_ydl_opts()
+    ydl_opts['format'] = format_spec
+    cached = get_cached_info(url, with_urls=with_urls)
+    if cached:
+        info, egress = cached
+        try:
+            # Re-run format selection offline against the cached formats
+            with new_ydl({'format': format_spec, 'quiet': True, 'cachedir': YTDLP_CACHE_DIR}) as ydl:
+                return ydl.process_ie_result(info, download=False), egress
+        except Exception as e:
+            app.logger.warning(f"Cached info for {url} unusable: {e}")
+
+    def extract(attempt):
+        opts = attempt.ydl_opts
+        with timed('extraction', site=site_label(url), client='+'.join(attempt.strategy[0]) if attempt.strategy else '',
+                   route=_route_label(attempt.proxy, opts)), new_ydl(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+        if not info:
+            raise Exception("yt-dlp returned no info")
+        attempt.progress()  # a hedge that lost doesn't get to overwrite the cache
+        cache_info(url, info, opts.get('proxy'))
+        return info
+
+    info, attempt = run_attempts(url, ydl_opts, extract)
+    return info, attempt.ydl_opts.get('proxy')
+
+def extract_stream_source(url):
+    """Resolve url to a directly fetchable audio stream; returns (info, egress)."""
+    # WebM/Opus can be decoded from a pipe; m4a may keep its index at the end of the file
+    info, egress = extract_media_info(url, 'bestaudio[ext=webm][protocol^=http]/bestaudio[protocol^=http]/best[protocol^=http]')
+    if not info.get('url'):
+        raise DownloadError('No directly streamable audio format')
+    return info, egress
+
+def _feed_source(src_url, headers, proxy, sink, failed):
+    """Copy the source stream into sink (ffmpeg's stdin) using ranged requests."""
+    proxies = {'http': proxy, 'https': proxy} if proxy else None
+    start, total = 0, None
+    try:
+        while total is None or start < total:
+            with http_request('media', 'GET', src_url, headers={**headers, 'Range': f'bytes={start}-{start + STREAM_CHUNK_SIZE - 1}'},
+                              proxies=proxies, stream=True, timeout=30) as r:
+                r.raise_for_status()
+                content_range = r.headers.get('Content-Range', '')
+                total = int(content_range.rsplit('/', 1)[1]) if '/' in content_range and not content_range.endswith('*') else -1
+                received = 0
+                for chunk in r.iter_content(STREAM_READ_SIZE):
+                    sink.write(chunk)
+                    received += len(chunk)
+            start += received
+            if r.status_code != 206 or total < 0 or received == 0:
+                break  # server ignored the range and sent everything
+    except Exception as e:
+        app.logger.warning(f"Stream source failed: {e}")
+        failed.set()
+    finally:
+        try: sink.close()
+        except OSError: pass
+
+def _produce_stream(url, info, proxy, out, target_format, cache_key, download_name, done, lock_fd, slot):
+    """Transcode the source into `out` (the .part file) and publish it to the cache if it completes.
+
+    `slot` is the transcode slot stream_transcode already holds; it is released here.
+    """
+    part = out.name
+    proc = subprocess.Popen(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-threads', '1', '-i', 'pipe:0', '-vn',
+         '-f', 'mp3', '-b:a', f'{MP3_QUALITY}k', 'pipe:1'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    failed = threading.Event()
+    feeder = threading.Thread(target=_feed_source, args=(info['url'], info.get('http_headers') or {}, proxy, proc.stdin, failed),
+                              name='stream-feed', daemon=True)
+    feeder.start()
+    m = {'site': site_label(url), 'format': target_format, 'route': 'proxy' if proxy else 'direct'}
+    started = time.monotonic()
+    published = None
+    try:
+        while True:
+            chunk = proc.stdout.read1(STREAM_READ_SIZE)
+            if not chunk: break
+            out.write(chunk)
+            out.flush()
+        observe('streamrip_transcode_cpu_seconds', _reap(proc), format=target_format, site=m['site'])
+        feeder.join()
+        out.close()
+        if proc.returncode == 0 and not failed.is_set():
+            if cache_key: published = publish_result(cache_key, target_format, part, download_name)
+        else:
+            app.logger.warning(f"Streaming transcode of {url} ended early (ffmpeg exit {proc.returncode})")
+            m.update(outcome='error', error='source_failed' if failed.is_set() else 'ffmpeg_failed')
+    except Exception as e:
+        app.logger.warning(f"Streaming transcode of {url} failed: {e}")
+        m.update(outcome='error', error=classify_error(e))
+    finally:
+        observe('streamrip_stage_duration_seconds', time.monotonic() - started, stage='stream_transcode',
+                client='', outcome=m.pop('outcome', 'ok'), error=m.pop('error', ''), **m)
+        if proc.returncode is None:
+            proc.kill()
+            _reap(proc)
+        slot.__exit__(None, None, None)
+        out.close()
+        if os.path.exists(part): os.remove(part)
+        # Without a published file the meta written for followers is a stale cache entry
+        if cache_key and not published: _remove_stream_meta(cache_key, target_format)
+        done.set()
+        if lock_fd is not None: os.close(lock_fd)
+
+def _remove_stream_meta(cache_key, target_format):
+    try: os.remove(_result_cache_paths(cache_key, target_format)[1])
+    except OSError: pass
+
+def _tail(f, is_done):
+    """Yield bytes from a file that another thread or worker is still writing."""
+    try:
+        while True:
+            chunk = f.read(STREAM_READ_SIZE)
+            if chunk:
+                yield chunk
+            elif is_done():
+                while chunk := f.read(STREAM_READ_SIZE):
+                    yield chunk
+                return
+            else:
+                time.sleep(0.05)
+    finally:
+        f.close()
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        while chunk := f.read(STREAM_READ_SIZE):
+            yield chunk
+
+def stream_transcode(url, target_format='mp3'):
+    """Return (download_name, generator) that yields MP3 bytes while the source is still downloading.
+
+    The transcode runs in a background thread writing a .part file next to its result cache
+    entry, and every client (including the one that started it) tails that file, so a client
+    disconnecting never cuts the stream short for others. Identical requests that arrive while
+    it runs - in this worker or another one - follow the same .part file instead of starting a
+    second transcode. The finished file is published to the result cache.
+    """
+    cache_key = result_cache_key(url, target_format)
+    lock_fd = None
+    if cache_key:
+        path, meta_path = _result_cache_paths(cache_key, target_format)
+        part = f"{path}.part"
+        deadline = time.monotonic() + COALESCE_WAIT
+        while True:
+            lock_fd = try_lead(cache_key)
+            if lock_fd is not None:
+                cached = lookup_result(cache_key, target_format)
+                if not cached: break  # we are the leader
+                os.close(lock_fd)
+                return cached['download_name'], _read_file(cached['path'])
+            # Someone else is producing this file: follow their .part file once it exists
+            try:
+                f = open(part, 'rb')
+                with open(meta_path) as m:
+                    download_name = json.load(m)['download_name']
+                app.logger.info(f"Following in-flight stream of {cache_key}")
+                return download_name, _tail(f, lambda: not leader_active(cache_key))
+            except (OSError, ValueError):
+                pass
+            if time.monotonic() > deadline:
+                raise DownloadError('Timed out waiting for an identical download', 504)
+            time.sleep(0.2)
+    else:
+        part = os.path.join(DOWNLOAD_FOLDER, f"{uuid.uuid4().hex}.{target_format}.part")
+
+    slot = None
+    try:
+        info, proxy = extract_stream_source(url)
+        download_name = _download_name(info, target_format)
+        # Wait for a transcode slot here, before any response is sent, so a full box answers 503
+        waiting = transcode_slot(format=target_format, site=site_label(url))
+        waiting.__enter__()
+        slot = waiting
+        if cache_key:
+            # Followers read the file name from here before the entry is published
+            tmp = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'w') as m:
+                json.dump({'key': cache_key, 'download_name': download_name}, m)
+            os.replace(tmp, meta_path)
+        out = open(part, 'wb')
+        reader = open(part, 'rb')
+    except BaseException:
+        if slot is not None: slot.__exit__(None, None, None)
+        if cache_key: _remove_stream_meta(cache_key, target_format)
+        if lock_fd is not None: os.close(lock_fd)
+        raise
+    done = threading.Event()
+    threading.Thread(target=_produce_stream, name='stream-transcode', daemon=True,
+                     args=(url, info, proxy, out, target_format, cache_key, download_name, done, lock_fd, slot)).start()
+    return download_name, _tail(reader, done.is_set)
+
+JOBS_DIR = os.path.join(DOWNLOAD_FOLDER, 'jobs')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '8'))  # downloads running at once per process (CPU work is capped by TRANSCODE_SLOTS)
+JOB_TTL = int(os.environ.get('JOB_TTL', '3600'))       # seconds a finished job stays fetchable
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+_job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+_last_job_cleanup = 0
+
+# Job records live on disk so any gunicorn worker can answer status requests.
+def _job_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def save_job(job):
+    job['updated'] = time.time()
+    tmp = f"{_job_path(job['id'])}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp, _job_path(job['id']))
+
+def load_job(job_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+        return None
+    try:
+        with open(_job_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def update_job(job, **fields):
+    job.update(fields)
+    save_job(job)
+
+def cleanup_jobs():
+    """Forget jobs older than JOB_TTL and delete their uncached output files."""
+    global _last_job_cleanup
+    now = time.time()
+    if now - _last_job_cleanup < 60: return
+    _last_job_cleanup = now
+    for p in glob.glob(os.path.join(JOBS_DIR, '*.json')):
+        try:
+            if now - os.path.getmtime(p) < JOB_TTL: continue
+            with open(p) as f:
+                job = json.load(f)
+            if job.get('path') and not job.get('cached') and os.path.exists(job['path']):
+                os.remove(job['path'])
+            os.remove(p)
+        except (OSError, ValueError): pass
+
+JOB_PROGRESS_INTERVAL = 0.5  # minimum seconds between progress writes for the same job
+
+def _run_job(job):
+    last_write = 0
+    def on_stage(state, **progress):
+        nonlocal last_write
+        changed = job['state'] != state
+        job['state'] = state
+        # A new attempt starts a fresh progress record; later stages keep its attempt/client info
+        previous = {} if state == 'extracting' else job.get('progress', {})
+        job['progress'] = {**previous, **progress, 'stage': state}
+        if changed or time.monotonic() - last_write >= JOB_PROGRESS_INTERVAL:
+            last_write = time.monotonic()
+            save_job(job)
+    try:
+        result = run_download(job['url'], job['format'], on_stage=on_stage)
+    except Exception as e:
+        if not isinstance(e, DownloadError): app.logger.error(traceback.format_exc())
+        update_job(job, state='failed', error=str(e), status=getattr(e, 'status', 500))
+        raise
+    update_job(job, state='done', **result)
+    return result
+
+ADMIT_QUEUE = int(os.environ.get('ADMIT_QUEUE', '32'))          # jobs waiting for a pool thread before new ones get 503
+ADMIT_PER_CLIENT = int(os.environ.get('ADMIT_PER_CLIENT', '4'))  # queued + running jobs per client IP before 429
+ADMIT_WINDOW = 300         # seconds of finished jobs used to estimate how fast the queue drains
+ADMIT_DEFAULT_RETRY = 30   # Retry-After when there is no recent history
+
+class Overloaded(DownloadError):
+    """The job pool can't take the request now; retry_after is a hint in seconds."""
+    def __init__(self, message, status, retry_after):
+        super().__init__(message, status, 'overloaded')
+        self.retry_after = retry_after
+
+# Admission works per worker process, like the job pool it guards. Admitted jobs wait in one
+# FIFO per client and pool threads serve the clients in turn, so a client with many jobs
+# can't starve the others.
+_admission_lock = threading.Lock()
+_client_queues = OrderedDict()  # client -> deque of (job, future) not started yet
+_client_jobs = {}               # client -> queued + running jobs
+_queued_jobs = 0
+_finished_jobs = deque()        # finish times within ADMIT_WINDOW
+
+def _retry_after(jobs_ahead):
+    """Seconds until jobs_ahead more jobs should have finished at the recent drain rate."""
+    now = time.time()
+    while _finished_jobs and now - _finished_jobs[0] > ADMIT_WINDOW: _finished_jobs.popleft()
+    if len(_finished_jobs) < 2: return ADMIT_DEFAULT_RETRY
+    rate = len(_finished_jobs) / max(now - _finished_jobs[0], 1.0)
+    return max(1, min(600, math.ceil(jobs_ahead / rate)))
+
+def _check_admission(client):
+    # Caller holds _admission_lock
+    if _client_jobs.get(client, 0) >= ADMIT_PER_CLIENT:
+        inc_counter('streamrip_admission_total', outcome='client_limit')
+        raise Overloaded(f'Too many downloads in progress for this client (limit {ADMIT_PER_CLIENT})', 429,
+                         _retry_after(_client_jobs[client] - ADMIT_PER_CLIENT + 1))
+    if _queued_jobs >= ADMIT_QUEUE:
+        inc_counter('streamrip_admission_total', outcome='queue_full')
+        raise Overloaded('Server is busy, try again later', 503, _retry_after(_queued_jobs - ADMIT_QUEUE + 1))
+
+def check_admission(client):
+    """Raise Overloaded if a new download from client would be refused right now."""
+    with _admission_lock:
+        _check_admission(client)
+
+def admit_stream(client):
+    """Count a streaming download against client's limit; return (started, finished) callbacks.
+
+    Streams don't use the job pool, but they hold a client slot from admission until the
+    response is closed, and count as queued until started() (once they have a transcode slot).
+    """
+    global _queued_jobs
+    with _admission_lock:
+        _check_admission(client)
+        _client_jobs[client] = _client_jobs.get(client, 0) + 1
+        _queued_jobs += 1
+    inc_counter('streamrip_admission_total', outcome='admitted')
+    queued = [True]
+    def started():
+        global _queued_jobs
+        with _admission_lock:
+            if queued: _queued_jobs -= 1; queued.clear()
+    def finished():
+        started()
+        with _admission_lock:
+            _client_jobs[client] -= 1
+            if not _client_jobs[client]: del _client_jobs[client]
+    return started, finished
+
+def submit_job(url, target_format, client='', enforce=True):
+    """Admit a download to the job pool and return (job, future).
+
+    Raises Overloaded (429 past ADMIT_PER_CLIENT jobs for the client, 503 past ADMIT_QUEUE
+    waiting jobs) unless enforce is False, for work that was admitted as a whole already.
+    """
+    global _queued_jobs
+    cleanup_jobs()
+    job = {'id': uuid.uuid4().hex, 'url': url, 'format': target_format, 'state': 'queued', 'created': time.time()}
+    future = concurrent.futures.Future()
+    with _admission_lock:
+        if enforce: _check_admission(client)
+        save_job(job)
+        _client_queues.setdefault(client, deque()).append((job, future))
+        _client_jobs[client] = _client_jobs.get(client, 0) + 1
+        _queued_jobs += 1
+    inc_counter('streamrip_admission_total', outcome='admitted')
+    _job_executor.submit(_run_next_job)
+    return job, future
+
+def _run_next_job():
+    """Run the next job in round-robin order over clients (one call per submitted job)."""
+    global _queued_jobs
+    with _admission_lock:
+        client, jobs = next(iter(_client_queues.items()))
+        job, future = jobs.popleft()
+        del _client_queues[client]
+        if jobs: _client_queues[client] = jobs  # back of the line
+        _queued_jobs -= 1
+    try:
+        if not future.set_running_or_notify_cancel():
+            update_job(job, state='failed', error='Cancelled', status=410)
+            return
+        try:
+            future.set_result(_run_job(job))
+        except Exception as e:
+            future.set_exception(e)
+    finally:
+        with _admission_lock:
+            _client_jobs[client] -= 1
+            if not _client_jobs[client]: del _client_jobs[client]
+            _finished_jobs.append(time.time())
+
+def client_ip():
+    """The caller's IP; behind the local reverse proxy this is the last X-Forwarded-For hop."""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded and request.remote_addr in ('127.0.0.1', '::1'):
+        return forwarded.split(',')[-1].strip()
+    return request.remote_addr or ''
+
+def error_response(e):
+    """JSON error response for a DownloadError, with Retry-After when the server is overloaded."""
+    if isinstance(e, Overloaded):
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+    else:
+        response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    return response
+
+def _job_view(job):
+    view = {k: job.get(k) for k in ('id', 'url', 'format', 'state', 'progress', 'error', 'created', 'updated', 'download_name')}
+    view['status_url'] = f"/api/jobs/{job['id']}"
+    view['events_url'] = f"/api/jobs/{job['id']}/events"
+    if job['state'] == 'done': view['file_url'] = f"/api/jobs/{job['id']}/file"
+    return view
+
+def send_result(result, url, target_format, file_url=None):
+    """Send a finished file with Range, ETag and conditional GET support.
+
+    The ETag is the file's SHA-256, so it stays the same for the same content no matter
+    which job or worker produced it. file_url is the stable URL clients can resume from.
+    """
+    response = send_file(result['path'], as_attachment=True, download_name=result['download_name'],
+                         mimetype=result['mimetype'], conditional=True, etag=result.get('sha256') or True)
+    if file_url: response.headers['Content-Location'] = file_url
+    return _timed_send(response, url, target_format)
+
+def _timed_send(response, url, target_format):
+    """Observe the file_send stage once the server has finished writing the response body."""
+    started = time.monotonic()
+    def done():
+        observe('streamrip_stage_duration_seconds', time.monotonic() - started, stage='file_send',
+                site=site_label(url), format=target_format, client='', route='', outcome='ok', error='')
+    # send_file responses are passed straight through to the server, skipping call_on_close
+    response.response = ClosingIterator(response.response, done)
+    return response
+
+def _request_params():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        return data.get('url'), data.get('format', 'mp3')
+    return request.args.get('url'), request.args.get('format', 'mp3')
+
+def _request_flag(name):
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    return str(data.get(name, '')).lower() in ('1', 'true', 'yes')
+
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '100'))  # items per batch after playlist expansion
+BATCH_PARALLEL = int(os.environ.get('BATCH_PARALLEL', '3'))      # items of one batch queued on the job pool at once
+
+def expand_batch(urls):
+    """Turn the requested URLs into a list of media URLs, expanding playlists.
+
+    Returns (items, failures): up to BATCH_MAX_ITEMS media URLs, and
+    {'url', 'error'} records for inputs that could not be expanded.
+    """
+    items, failures = [], []
+    for url in urls:
+        ie = suitable_extractor(url)
+        # Extractors that only ever return one video need no extra request
+        if ie is not None and ie._RETURN_TYPE == 'video':
+            items.append(url)
+            continue
+        ydl_opts = {**_base_ydl_opts(), 'noplaylist': False, 'extract_flat': 'in_playlist', 'playlistend': BATCH_MAX_ITEMS}
+        _configure_attempt(ydl_opts, url, None)
+        try:
+            with timed('playlist_expand', site=site_label(url)), new_ydl(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            failures.append({'url': url, 'error': str(e)})
+            continue
+        if info.get('_type') != 'playlist':
+            cache_info(url, info, None)  # a full extraction of a single item; the download can reuse it
+            items.append(url)
+            continue
+        for entry in info.get('entries') or []:
+            entry_url = entry and (entry.get('webpage_url') or entry.get('url'))
+            if entry_url: items.append(entry_url)
+    return items[:BATCH_MAX_ITEMS], failures
+
+class _ZipSink:
+    """Write-only, unseekable file object that buffers what ZipFile writes until it is drained."""
+    def __init__(self):
+        self._chunks = []
+        self._written = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._written
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_batch_zip(items, target_format, failures=(), client=''):
+    """Download items through the job pool and yield a ZIP archive as entries finish.
+
+    At most BATCH_PARALLEL items are queued at once, on behalf of client. The batch was
+    admitted as a whole, so its items are never refused individually. Entries are named by
+    their position in the batch; manifest.json at the end lists every item with its file
+    or error.
+    """
+    width = len(str(len(items)))
+    manifest = [{'url': f['url'], 'state': 'failed', 'error': f['error']} for f in failures]
+    sink = _ZipSink()
+    zf = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED)
+    pending = {}
+    queue_items = list(enumerate(items, 1))
+    try:
+        while queue_items or pending:
+            while queue_items and len(pending) < BATCH_PARALLEL:
+                index, url = queue_items.pop(0)
+                job, future = submit_job(url, target_format, client=client, enforce=False)
+                pending[future] = (index, url, job['id'])
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                index, url, job_id = pending.pop(future)
+                record = {'index': index, 'url': url, 'job_id': job_id}
+                try:
+                    result = future.result()
+                except Exception as e:
+                    inc_counter('streamrip_batch_items_total', outcome='failed')
+                    manifest.append({**record, 'state': 'failed', 'error': str(e)})
+                    continue
+                name = f"{index:0{width}d} - {result['download_name']}"
+                zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                try:
+                    with open(result['path'], 'rb') as src, zf.open(zinfo, 'w', force_zip64=True) as dst:
+                        while chunk := src.read(STREAM_READ_SIZE):
+                            dst.write(chunk)
+                            yield sink.drain()
+                finally:
+                    if not result['cached']:
+                        try: os.remove(result['path'])
+                        except OSError: pass
+                inc_counter('streamrip_batch_items_total', outcome='ok')
+                manifest.append({**record, 'state': 'done', 'file': name})
+                yield sink.drain()
+        manifest.sort(key=lambda m: m.get('index', 0))
+        zf.writestr(zipfile.ZipInfo('manifest.json', date_time=time.localtime()[:6]),
+                    json.dumps({'format': target_format, 'items': manifest}, indent=2))
+        zf.close()
+        yield sink.drain()
+    finally:
+        # Client went away: drop what hasn't started; running items finish and expire with their jobs
+        for future in pending:
+            future.cancel()
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    url, target_format = _request_params()
+    if not url: return jsonify({'error': 'URL required'}), 400
+    try:
+        job, _ = submit_job(url, target_format, client=client_ip())
+    except Overloaded as e:
+        return error_response(e)
+    return jsonify(_job_view(job)), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = load_job(job_id)
+    if not job: return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_view(job))
+
+SSE_POLL_INTERVAL = 0.5
+SSE_HEARTBEAT = 15
+
+def job_event(job):
+    """Return (event name, Server-Sent Event message) for the current state of a job."""
+    event = job['state'] if job['state'] in ('done', 'failed') else 'progress'
+    return event, f"event: {event}\ndata: {json.dumps(_job_view(job))}\n\n"
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream job progress as Server-Sent Events until the job is done or failed."""
+    job = load_job(job_id)
+    if not job: return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        last_update, last_sent = None, time.monotonic()
+        current = job
+        while True:
+            if current and current['updated'] != last_update:
+                last_update = current['updated']
+                last_sent = time.monotonic()
+                event, message = job_event(current)
+                yield message
+                if event != 'progress': return
+            elif time.monotonic() - last_sent >= SSE_HEARTBEAT:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(SSE_POLL_INTERVAL)
+            current = load_job(job_id)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+JOB_FILE_WAIT = int(os.environ.get('JOB_FILE_WAIT', '1800'))  # seconds /file?wait=1 holds on to an unfinished job
+
+@app.route('/api/jobs/<job_id>/file', methods=['GET'])
+def job_file(job_id):
+    """Send a finished job's file; with wait=1, first wait for the job to finish.
+
+    wait=1 lets a browser download start as soon as the job is submitted, so it doesn't
+    depend on the page that submitted it staying open.
+    """
+    job = load_job(job_id)
+    if job and _request_flag('wait'):
+        deadline = time.monotonic() + JOB_FILE_WAIT
+        while job and job['state'] not in ('done', 'failed') and time.monotonic() < deadline:
+            time.sleep(SSE_POLL_INTERVAL)
+            job = load_job(job_id)
+    if not job: return jsonify({'error': 'Job not found'}), 404
+    if job['state'] == 'failed': return jsonify({'error': job.get('error')}), job.get('status', 500)
+    if job['state'] != 'done': return jsonify({'error': f"Job is {job['state']}"}), 409
+    if not os.path.exists(job['path']): return jsonify({'error': 'File expired'}), 410
+    # Every delivery restarts the grace period, so an interrupted transfer can still be resumed
+    try: os.utime(_job_path(job_id))
+    except OSError: pass
+    return send_result(job, job['url'], job['format'], file_url=f"/api/jobs/{job_id}/file")
+
+@app.route('/api/info', methods=['GET', 'POST'])
+def media_info():
+    """Title, duration and available formats for a URL, without downloading anything."""
+    url, _ = _request_params()
+    if not url: return jsonify({'error': 'URL required'}), 400
+    cached = get_cached_info(url) is not None
+    try:
+        info, _ = extract_media_info(url, with_urls=False)
+    except DownloadError as e:
+        return jsonify({'error': str(e)}), e.status
+    formats = [{k: f.get(k) for k in ('format_id', 'ext', 'protocol', 'acodec', 'vcodec', 'height', 'abr', 'tbr', 'filesize', 'filesize_approx')}
+               for f in info.get('formats') or []]
+    return jsonify({
+        'id': info.get('id'), 'extractor': info.get('extractor_key'), 'title': info.get('title'),
+        'duration': info.get('duration'), 'uploader': info.get('uploader'), 'thumbnail': info.get('thumbnail'),
+        'webpage_url': info.get('webpage_url'), 'formats': formats, 'cached': cached,
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    flush_metrics()
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/strategies', methods=['GET'])
+def strategies():
+    stats = sorted(strategy_stats().items(), key=lambda kv: kv[1]['expected_time'])
+    return jsonify({'window_seconds': STRATEGY_WINDOW, 'strategies': [{'key': k, **st} for k, st in stats]})
+
+@app.route('/api/proxies', methods=['GET'])
+def proxies():
+    entries = proxy_health()
+    return jsonify({'usable': sum(e['state'] in ('closed', 'half_open') for e in entries), 'proxies': entries})
+
+@app.route('/api/production-proxy', methods=['GET'])
+def production_proxy():
+    return jsonify(production_proxy_status())
+
+@app.route('/api/download', methods=['POST', 'GET'])
+def download():
+    """Synchronous wrapper around the job pool, kept for existing clients."""
+    try:
+        url, target_format = _request_params()
+        if not url: return jsonify({'error': 'URL required'}), 400
+        client = client_ip()
+
+        # Cache hits are sent right away instead of waiting in the job pool behind real downloads
+        cache_key = result_cache_key(url, target_format)
+        cached = cache_key and lookup_result(cache_key, target_format)
+        if cached:
+            inc_counter('streamrip_result_cache_total', outcome='hit')
+            inc_counter('streamrip_downloads_total', outcome='ok', error='', site=site_label(url), format=target_format)
+            return send_result(_cached_result(cache_key, target_format, cached), url, target_format)
+
+        # stream=1: send MP3 bytes while the source is still downloading
+        if target_format == 'mp3' and _request_flag('stream'):
+            try:
+                started, finished = admit_stream(client)
+                try:
+                    download_name, body = stream_transcode(url)
+                except BaseException:
+                    finished()
+                    raise
+            except DownloadError as e:
+                return error_response(e)
+            started()
+            response = Response(stream_with_context(body), mimetype='audio/mpeg')
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+            response.call_on_close(finished)
             return response
-        return send_file(downloaded_file, as_attachment=True, download_name=download_name, mimetype=mimetype)
+
+        try:
+            job, future = submit_job(url, target_format, client=client)
+            result = future.result()
+        except DownloadError as e:
+            return error_response(e)
+
+        # The file stays with its job for JOB_TTL, so a dropped transfer resumes from Content-Location
+        return send_result(result, url, target_format, file_url=f"/api/jobs/{job['id']}/file")
     except Exception as e:
         app.logger.error(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/batch', methods=['POST', 'GET'])
+def batch_download():
+    """Download several URLs, or every item of a playlist, as one streamed ZIP archive."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        urls = data.get('urls') or ([data['url']] if data.get('url') else [])
+        target_format = data.get('format', 'mp3')
+    else:
+        urls = request.args.getlist('url')
+        target_format = request.args.get('format', 'mp3')
+    # A string or object here would be iterated as characters or keys
+    if not isinstance(urls, list) or not urls or not all(isinstance(u, str) and u for u in urls):
+        return jsonify({'error': 'URL list required'}), 400
+    if len(urls) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_MAX_ITEMS} URLs per batch'}), 400
+    client = client_ip()
+    try:
+        check_admission(client)
+    except Overloaded as e:
+        return error_response(e)
+    items, failures = expand_batch(urls)
+    if not items:
+        return jsonify({'error': 'Nothing to download', 'failures': failures}), 400
+    response = Response(stream_with_context(stream_batch_zip(items, target_format, failures, client)), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f'batch-{target_format}.zip')
+    return response
+
+if PROXY_POOL_ENABLED:
+    start_proxy_pool()
+if PROXY_MONITOR_ENABLED:
+    threading.Thread(target=_production_proxy_monitor, name='proxy-monitor', daemon=True).start()
+threading.Thread(target=warm_js_components, name='warm-js', daemon=True).start()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000) # Gunicorn handles gunicorn, this is for dev
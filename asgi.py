@@ -0,0 +1,169 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import re
+import sys
+import tempfile
+import time
+
+import app as streamrip
+
+# ASGI entry point: gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+#
+# The event loop only moves bytes. Every Flask request runs on a thread of _executor, and
+# every chunk of a streamed response body is pulled from the WSGI iterable on that pool too,
+# so a route that blocks (a download, a transcode, a tailed stream) never stalls the loop.
+# Job progress events are served natively on the loop, so idle SSE clients cost no thread.
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '256'))  # blocking requests in flight per process
+BODY_SPOOL_SIZE = 1024 * 1024                              # request bodies above this go to a temp file
+FILE_BLOCK_SIZE = 256 * 1024                               # read size for files sent with send_file
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+_DONE = object()
+_JOB_EVENTS = re.compile(r'/api/jobs/([0-9a-f]{32})/events')
+
+class _FileWrapper:
+    """wsgi.file_wrapper that reads larger blocks than werkzeug asks for, to cut thread hops."""
+    def __init__(self, f, block_size=8192):
+        self.f = f
+        self.block_size = max(block_size, FILE_BLOCK_SIZE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.f.read(self.block_size)
+        if not data: raise StopIteration
+        return data
+
+    def close(self):
+        self.f.close()
+
+    # werkzeug's range support seeks and reads through the wrapped file
+    def seekable(self):
+        return self.f.seekable()
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def tell(self):
+        return self.f.tell()
+
+    def read(self, *args):
+        return self.f.read(*args)
+
+async def _read_body(receive):
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect': return None
+        body.write(message.get('body', b''))
+        if not message.get('more_body'): break
+    body.seek(0)
+    return body
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0], 'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body, 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+        'wsgi.file_wrapper': _FileWrapper, 'wsgi.input_terminated': True,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    # The body is spooled in full, so its length is known even when it arrived chunked
+    environ['CONTENT_LENGTH'] = str(body.seek(0, os.SEEK_END))
+    body.seek(0)
+    return environ
+
+async def _watch_disconnect(receive, disconnected):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+
+async def _run_wsgi(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    body = await _read_body(receive)
+    if body is None: return
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+    # Flask keeps the request context in context variables. Running every step of this request
+    # in one Context keeps it visible whichever pool thread picks up the next chunk.
+    ctx = contextvars.copy_context()
+    iterable = await loop.run_in_executor(_executor, ctx.run, streamrip.app, _environ(scope, body), start_response)
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    try:
+        chunks = iter(iterable)
+        await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(_executor, ctx.run, next, chunks, _DONE)
+            if chunk is _DONE:
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                break
+            if chunk: await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        watcher.cancel()
+        # Closing runs the generators' cleanup (e.g. cancelling batch items nobody will receive)
+        if hasattr(iterable, 'close'): await loop.run_in_executor(_executor, ctx.run, iterable.close)
+        body.close()
+
+async def _job_events(job_id, scope, receive, send):
+    """Async twin of the /api/jobs/<id>/events route: no thread is held while a client waits."""
+    job = streamrip.load_job(job_id)
+    if not job: return await _run_wsgi(scope, receive, send)  # let Flask produce the 404
+    headers = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+               (b'x-accel-buffering', b'no')]
+    if any(name == b'origin' for name, _ in scope['headers']):
+        headers.append((b'access-control-allow-origin', b'*'))  # same as CORS(app) on the Flask routes
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        last_update, last_sent = None, time.monotonic()
+        while not disconnected.is_set():
+            if job and job['updated'] != last_update:
+                last_update = job['updated']
+                last_sent = time.monotonic()
+                event, message = streamrip.job_event(job)
+                await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+                if event != 'progress': break
+            elif time.monotonic() - last_sent >= streamrip.SSE_HEARTBEAT:
+                last_sent = time.monotonic()
+                await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+            await asyncio.sleep(streamrip.SSE_POLL_INTERVAL)
+            job = streamrip.load_job(job_id)
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        watcher.cancel()
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                _executor.shutdown(wait=False, cancel_futures=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    match = _JOB_EVENTS.fullmatch(scope['path'])
+    if match and scope['method'] == 'GET':
+        return await _job_events(match.group(1), scope, receive, send)
+    return await _run_wsgi(scope, receive, send)
@@ -0,0 +1,528 @@
+"""Offline end-to-end benchmark for the download API.
+
+Starts local stand-ins for everything the server talks to - a media origin serving a known
+WAV track, the bgutil /get_pot sidecar, the public proxy lists and a set of HTTP and SOCKS5
+proxies, all with injectable latency and failure rates - then starts the server against
+them and drives /api/download. Reports latency percentiles, throughput and server CPU time
+per request, and stores or compares baselines in benchmarks/.
+
+    python benchmark.py -n 40 -c 4 --format mp3
+    python benchmark.py -n 40 -c 4 --save-baseline mp3-c4
+    python benchmark.py -n 40 -c 4 --compare mp3-c4
+
+Media URLs are direct links (yt-dlp's generic extractor), so extraction is cheap and the
+numbers are dominated by download, transcode and delivery. The proxy stand-ins are
+exercised by the server's proxy pool probing; the POT sidecar only by YouTube URLs.
+"""
+import argparse
+import array
+import base64
+import concurrent.futures
+import http.server
+import io
+import json
+import math
+import os
+import random
+import re
+import select
+import shlex
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import wave
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_DIR = os.path.join(BASE_DIR, 'benchmarks')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+# Metrics that --compare checks, and whether a higher value is better
+COMPARED = {'latency.p50': False, 'latency.p95': False, 'latency.p99': False,
+            'cpu_per_request': False, 'throughput_rps': True}
+
+
+class Fault:
+    """Latency (seconds), failure probability and bandwidth cap (bytes/s, 0 = none) for a stand-in."""
+    def __init__(self, latency=0.0, fail=0.0, rate=0):
+        self.latency, self.fail, self.rate = latency, fail, rate
+
+    def delay(self):
+        if self.latency: time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def fails(self):
+        return random.random() < self.fail
+
+
+def make_wav(seconds, sample_rate=44100):
+    """A deterministic 441 Hz mono tone; one period is exactly 100 samples."""
+    period = array.array('h', (int(12000 * math.sin(2 * math.pi * i / 100)) for i in range(100))).tobytes()
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(period * (seconds * sample_rate // 100))
+    return buf.getvalue()
+
+
+# --- Fake internet: media origin, proxy lists, generate_204 and the POT sidecar ---
+
+class FakeInternet(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, media, origin_fault, pot_fault, proxy_lists):
+        super().__init__(addr, _FakeInternetHandler)
+        self.media, self.origin_fault, self.pot_fault, self.proxy_lists = media, origin_fault, pot_fault, proxy_lists
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class _FakeInternetHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='text/plain', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers: self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD': self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        srv = self.server
+        if path == '/generate_204':
+            srv.count('generate_204')
+            return self._send(204)
+        m = re.fullmatch(r'/proxies/(http|socks5)\.txt', path)
+        if m:
+            srv.count('proxy_list')
+            return self._send(200, '\n'.join(srv.proxy_lists[m.group(1)]).encode())
+        if re.fullmatch(r'/media/[\w-]+\.wav', path):
+            return self._media()
+        self._send(404, b'not found')
+
+    def _media(self):
+        srv, fault = self.server, self.server.origin_fault
+        srv.count('media')
+        fault.delay()
+        if fault.fails():
+            srv.count('media_failed')
+            return self._send(503, b'injected failure')
+        data, start, status = srv.media, 0, 200
+        headers = [('Accept-Ranges', 'bytes')]
+        m = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else len(data) - 1
+            headers.append(('Content-Range', f'bytes {start}-{end}/{len(data)}'))
+            data, status = data[start:end + 1], 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'audio/wav')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers: self.send_header(k, v)
+        self.end_headers()
+        if self.command == 'HEAD': return
+        chunk = 64 * 1024
+        started = time.monotonic()
+        try:
+            for offset in range(0, len(data), chunk):
+                self.wfile.write(data[offset:offset + chunk])
+                if fault.rate:
+                    ahead = (offset + chunk) / fault.rate - (time.monotonic() - started)
+                    if ahead > 0: time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != '/get_pot':
+            return self._send(404, b'not found')
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        srv = self.server
+        srv.count('get_pot')
+        srv.pot_fault.delay()
+        if srv.pot_fault.fails():
+            return self._send(500, b'injected failure')
+        body = json.dumps({'poToken': f'bench-{random.getrandbits(64):016x}', 'contentBinding': 'bench-visitor'})
+        self._send(200, body.encode(), 'application/json')
+
+
+# --- Proxies ---
+
+def _pipe(a, b):
+    sockets = [a, b]
+    try:
+        while True:
+            readable, _, _ = select.select(sockets, [], [], 60)
+            if not readable: return
+            for s in readable:
+                data = s.recv(64 * 1024)
+                if not data: return
+                (b if s is a else a).sendall(data)
+    except OSError:
+        pass
+
+
+def _recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk: raise ConnectionError('short read')
+        data += chunk
+    return data
+
+
+class ProxyServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, handler, fault, auth=None):
+        super().__init__(addr, handler)
+        self.fault = fault
+        self.auth = auth  # (username, password) the proxy requires, or None
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class _HTTPProxyHandler(socketserver.BaseRequestHandler):
+    """CONNECT tunnels and absolute-URI forwarding, enough for requests and yt-dlp."""
+    def handle(self):
+        srv, client = self.server, self.request
+        srv.connections += 1
+        srv.fault.delay()
+        if srv.fault.fails(): return
+        head = b''
+        while b'\r\n\r\n' not in head:
+            chunk = client.recv(4096)
+            if not chunk: return
+            head += chunk
+        head, rest = head.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        if srv.auth:
+            sent = {n.strip().lower(): v.strip() for n, _, v in (l.partition(':') for l in lines[1:])}
+            if sent.get('proxy-authorization') != 'Basic ' + base64.b64encode(':'.join(srv.auth).encode()).decode():
+                client.sendall(b'HTTP/1.1 407 Proxy Authentication Required\r\nContent-Length: 0\r\n\r\n')
+                return
+        try:
+            if method == 'CONNECT':
+                host, port = target.rsplit(':', 1)
+                upstream = socket.create_connection((host, int(port)), timeout=10)
+                client.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            else:
+                url = urllib.parse.urlsplit(target)
+                upstream = socket.create_connection((url.hostname, url.port or 80), timeout=10)
+                path = urllib.parse.urlunsplit(('', '', url.path or '/', url.query, ''))
+                headers = [l for l in lines[1:] if not l.lower().startswith(('proxy-connection:', 'proxy-authorization:', 'connection:'))]
+                upstream.sendall(f"{method} {path} {version}\r\n".encode('latin-1') +
+                                 '\r\n'.join(headers + ['Connection: close']).encode('latin-1') + b'\r\n\r\n' + rest)
+        except OSError:
+            client.sendall(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n')
+            return
+        with upstream:
+            _pipe(client, upstream)
+
+
+class _SOCKS5Handler(socketserver.BaseRequestHandler):
+    """SOCKS5 with the CONNECT command only; username/password auth (RFC 1929) when server.auth is set."""
+    def handle(self):
+        srv, client = self.server, self.request
+        srv.connections += 1
+        srv.fault.delay()
+        if srv.fault.fails(): return
+        try:
+            _, n_methods = _recv_exact(client, 2)
+            methods = _recv_exact(client, n_methods)
+            if srv.auth:
+                if 2 not in methods:
+                    client.sendall(b'\x05\xff')
+                    return
+                client.sendall(b'\x05\x02')
+                _, n = _recv_exact(client, 2)
+                user = _recv_exact(client, n).decode()
+                password = _recv_exact(client, _recv_exact(client, 1)[0]).decode()
+                ok = (user, password) == tuple(srv.auth)
+                client.sendall(b'\x01\x00' if ok else b'\x01\x01')
+                if not ok: return
+            else:
+                client.sendall(b'\x05\x00')
+            _, cmd, _, atyp = _recv_exact(client, 4)
+            if atyp == 1: host = socket.inet_ntoa(_recv_exact(client, 4))
+            elif atyp == 3: host = _recv_exact(client, _recv_exact(client, 1)[0]).decode()
+            else: host = socket.inet_ntop(socket.AF_INET6, _recv_exact(client, 16))
+            port = struct.unpack('!H', _recv_exact(client, 2))[0]
+            if cmd != 1:
+                client.sendall(b'\x05\x07\x00\x01' + bytes(6))
+                return
+            upstream = socket.create_connection((host, port), timeout=10)
+        except OSError:
+            try: client.sendall(b'\x05\x01\x00\x01' + bytes(6))
+            except OSError: pass
+            return
+        client.sendall(b'\x05\x00\x00\x01' + bytes(6))
+        with upstream:
+            _pipe(client, upstream)
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# --- Server under test ---
+
+def process_group_cpu(pgid):
+    """CPU seconds used by the live processes of a process group, including reaped children."""
+    total = 0
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        fields = stat[stat.rfind(')') + 2:].split()
+        if int(fields[2]) == pgid:
+            total += sum(int(x) for x in fields[11:15])  # utime, stime, cutime, cstime
+    return total / CLOCK_TICKS
+
+
+def start_server(cmd, env, log_path, base_url, timeout=90):
+    log = open(log_path, 'wb')
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with {proc.returncode}, see {log_path}')
+        try:
+            if requests.get(f'{base_url}/api/cookies-status', timeout=2).status_code == 200:
+                return proc
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    stop_server(proc)
+    raise RuntimeError(f'server did not come up within {timeout}s, see {log_path}')
+
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, 15)
+        proc.wait(timeout=15)
+    except (OSError, subprocess.TimeoutExpired):
+        os.killpg(proc.pid, 9)
+
+
+def stage_means(metrics_text):
+    """Mean seconds per pipeline stage from the server's /metrics output."""
+    sums, counts = {}, {}
+    for line in metrics_text.splitlines():
+        m = re.match(r'streamrip_stage_duration_seconds_(sum|count)\{.*?stage="([^"]+)".*\} ([\d.e+-]+)$', line)
+        if m:
+            target = sums if m.group(1) == 'sum' else counts
+            target[m.group(2)] = target.get(m.group(2), 0) + float(m.group(3))
+    return {stage: round(sums.get(stage, 0) / n, 4) for stage, n in sorted(counts.items()) if n}
+
+
+# --- Load ---
+
+def one_request(base_url, media_url, fmt, stream):
+    params = {'url': media_url, 'format': fmt}
+    if stream: params['stream'] = '1'
+    started = time.monotonic()
+    ttfb, size = None, 0
+    try:
+        with requests.get(f'{base_url}/api/download', params=params, stream=True, timeout=600) as r:
+            for chunk in r.iter_content(64 * 1024):
+                if ttfb is None: ttfb = time.monotonic() - started
+                size += len(chunk)
+            status = r.status_code
+    except requests.RequestException as e:
+        status = type(e).__name__
+    return {'status': status, 'latency': time.monotonic() - started, 'ttfb': ttfb, 'bytes': size}
+
+
+def percentile(values, q):
+    if not values: return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))], 4)
+
+
+def summarize(results, wall, cpu):
+    ok = [r for r in results if r['status'] == 200]
+    latencies = [r['latency'] for r in ok]
+    ttfbs = [r['ttfb'] for r in ok if r['ttfb'] is not None]
+    errors = {}
+    for r in results:
+        if r['status'] != 200: errors[str(r['status'])] = errors.get(str(r['status']), 0) + 1
+    return {
+        'requests': len(results), 'ok': len(ok), 'errors': errors,
+        'latency': {f'p{q}': percentile(latencies, q) for q in (50, 95, 99)} | {
+            'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+            'max': round(max(latencies), 4) if latencies else None},
+        'ttfb': {f'p{q}': percentile(ttfbs, q) for q in (50, 95, 99)},
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(ok) / wall, 4) if wall else None,
+        'throughput_mbps': round(sum(r['bytes'] for r in ok) * 8 / 1e6 / wall, 3) if wall else None,
+        'cpu_seconds': round(cpu, 3),
+        'cpu_per_request': round(cpu / len(ok), 4) if ok else None,
+    }
+
+
+def _lookup(report, dotted):
+    for part in dotted.split('.'):
+        report = (report or {}).get(part)
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Print current vs baseline for the COMPARED metrics; return the names that regressed."""
+    regressed = []
+    print(f"\n{'metric':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, higher_is_better in COMPARED.items():
+        old, new = _lookup(baseline, name), _lookup(report, name)
+        if old is None or new is None:
+            print(f"{name:<20}{str(old):>12}{str(new):>12}{'n/a':>10}")
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        if flag: regressed.append(name)
+        print(f"{name:<20}{old:>12.4f}{new:>12.4f}{change:>+10.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark for /api/download')
+    parser.add_argument('-n', '--requests', type=int, default=20, help='measured requests')
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured requests before the run')
+    parser.add_argument('--format', default='mp3', choices=['mp3', 'mp4'])
+    parser.add_argument('--stream', action='store_true', help='use stream=1 (mp3 only)')
+    parser.add_argument('--duration', type=int, default=60, help='length of the served track in seconds')
+    parser.add_argument('--origin-latency', type=float, default=0.0)
+    parser.add_argument('--origin-fail', type=float, default=0.0)
+    parser.add_argument('--origin-rate', type=int, default=0, help='origin bandwidth per request in bytes/s')
+    parser.add_argument('--pot-latency', type=float, default=0.2)
+    parser.add_argument('--pot-fail', type=float, default=0.0)
+    parser.add_argument('--proxies', type=int, default=4, help='HTTP and SOCKS5 proxies started (each)')
+    parser.add_argument('--dead-proxies', type=int, default=20, help='unreachable entries added to the proxy lists')
+    parser.add_argument('--proxy-latency', type=float, default=0.05)
+    parser.add_argument('--proxy-fail', type=float, default=0.1)
+    parser.add_argument('--server-cmd', default='{python} -m gunicorn --bind 127.0.0.1:{port} asgi:app '
+                        '-k uvicorn.workers.UvicornWorker --workers 2 --timeout 300',
+                        help='command that starts the server; {python} and {port} are filled in')
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE')
+    parser.add_argument('--name', default=None, help='name recorded in the report')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression for --compare')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='streamrip-bench-')
+    media = make_wav(args.duration)
+    lists = {'http': [], 'socks5': []}
+    proxies = []
+    for kind, handler in (('http', _HTTPProxyHandler), ('socks5', _SOCKS5Handler)):
+        for _ in range(args.proxies):
+            p = _serve(ProxyServer(('127.0.0.1', 0), handler, Fault(args.proxy_latency, args.proxy_fail)))
+            proxies.append(p)
+            lists[kind].append(f'127.0.0.1:{p.port}')
+        lists[kind] += [f'127.0.0.1:{_free_port()}' for _ in range(args.dead_proxies // 2)]
+    internet = _serve(FakeInternet(('127.0.0.1', 0), media, Fault(args.origin_latency, args.origin_fail, args.origin_rate),
+                                   Fault(args.pot_latency, args.pot_fail), lists))
+    origin = f'http://127.0.0.1:{internet.server_address[1]}'
+
+    port = _free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    env = {
+        **os.environ,
+        'DOWNLOAD_FOLDER': os.path.join(workdir, 'downloads'),
+        'COOKIES_FILE': os.path.join(workdir, 'cookies.txt'),
+        'PROXY_LIST_URLS': f'{origin}/proxies/http.txt,{origin}/proxies/socks5.txt',
+        'PROXY_CHECK_URL': f'{origin}/generate_204',
+        'POT_PROVIDER_URL': origin,
+        'YTDLP_OFFLINE_COMPONENTS': '1',
+        # One benchmark client must not trip the per-client limit
+        'ADMIT_PER_CLIENT': '100000',
+    }
+    env.update(kv.split('=', 1) for kv in args.server_env)
+    cmd = shlex.split(args.server_cmd.format(python=sys.executable, port=port))
+    print(f'Starting server: {shlex.join(cmd)} (logs in {workdir}/server.log)')
+    server = start_server(cmd, env, os.path.join(workdir, 'server.log'), base_url)
+    try:
+        track = 0
+        def next_url():
+            nonlocal track
+            track += 1
+            return f'{origin}/media/track-{track}.wav'
+
+        for _ in range(args.warmup):
+            one_request(base_url, next_url(), args.format, args.stream)
+        print(f'Running {args.requests} requests at concurrency {args.concurrency}...')
+        urls = [next_url() for _ in range(args.requests)]
+        cpu_before = process_group_cpu(server.pid)
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda u: one_request(base_url, u, args.format, args.stream), urls))
+        wall = time.monotonic() - started
+        cpu = process_group_cpu(server.pid) - cpu_before
+        time.sleep(6)  # let every worker flush its metrics
+        try:
+            stages = stage_means(requests.get(f'{base_url}/metrics', timeout=10).text)
+        except requests.RequestException:
+            stages = {}
+    finally:
+        stop_server(server)
+
+    report = {
+        'name': args.name or args.save_baseline or 'run',
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'save_baseline', 'compare', 'name')},
+        **summarize(results, wall, cpu),
+        'stages': stages,
+        'stand_ins': {**internet.counts, 'proxy_connections': sum(p.connections for p in proxies)},
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f'{args.save_baseline}.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved baseline {args.save_baseline}')
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'{args.compare}.json')) as f:
+            regressed = compare(report, json.load(f), args.tolerance)
+        if regressed:
+            print(f"\nRegressed beyond {args.tolerance:.0%}: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
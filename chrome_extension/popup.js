@@ -48,6 +48,73 @@ document.addEventListener('DOMContentLoaded', () => {
     downloadBtn.addEventListener('click', () => handleDownload('mp3', downloadBtn));
     downloadMp4Btn.addEventListener('click', () => handleDownload('mp4', downloadMp4Btn));
 
+    function describeProgress(job, format) {
+        const p = job.progress || {};
+        const attempt = p.attempt > 1 ? ` (attempt ${p.attempt}/${p.attempts})` : '';
+        switch (job.state) {
+            case 'queued':
+                return 'Waiting for the server...';
+            case 'extracting':
+                return `Looking up the video${attempt}...`;
+            case 'downloading': {
+                const mb = (bytes) => (bytes / 1048576).toFixed(1);
+                let text = `Downloading ${mb(p.downloaded_bytes || 0)} MB`;
+                if (p.total_bytes) text += ` of ${mb(p.total_bytes)} MB`;
+                if (p.eta) text += `, ${p.eta}s left`;
+                return text + attempt;
+            }
+            case 'transcoding':
+                return `Converting to ${format.toUpperCase()}...`;
+            default:
+                return `Processing ${format.toUpperCase()}...`;
+        }
+    }
+
+    // Progress is only shown while the popup is open; the download itself doesn't depend on it
+    function followJob(job, format) {
+        const events = new EventSource(`${serverUrl}${job.events_url}`);
+        events.addEventListener('progress', (e) => {
+            setStatus(describeProgress(JSON.parse(e.data), format), 'info');
+        });
+        events.addEventListener('done', () => {
+            events.close();
+            setStatus('Downloading to folder...', 'info');
+        });
+        events.addEventListener('failed', (e) => {
+            events.close();
+            setStatus(JSON.parse(e.data).error || 'Download failed.', 'error');
+        });
+        return events;
+    }
+
+    // A saturated server answers 429/503 with Retry-After; wait that long (plus jitter) and resubmit
+    const MAX_SUBMIT_ATTEMPTS = 5;
+
+    async function retryDelay(response, attempt) {
+        let seconds = parseInt(response.headers.get('Retry-After'), 10);
+        if (!seconds) {
+            try { seconds = (await response.clone().json()).retry_after; } catch (e) { }
+        }
+        return (seconds || 2 ** attempt) * (1 + Math.random() * 0.25);
+    }
+
+    async function submitJob(serverUrl, url, format) {
+        for (let attempt = 1; ; attempt++) {
+            const response = await fetch(`${serverUrl}/api/jobs`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'ngrok-skip-browser-warning': '69420'
+                },
+                body: JSON.stringify({ url, format })
+            });
+            if ((response.status !== 429 && response.status !== 503) || attempt >= MAX_SUBMIT_ATTEMPTS) return response;
+            const delay = await retryDelay(response, attempt);
+            setStatus(`Server is busy, retrying in ${Math.ceil(delay)}s...`, 'info');
+            await new Promise(resolve => setTimeout(resolve, delay * 1000));
+        }
+    }
+
     async function handleDownload(format, btn) {
         if (!serverUrl) return;
         const url = urlInput.value;
@@ -60,15 +127,16 @@ document.addEventListener('DOMContentLoaded', () => {
 
         btnText.style.display = 'none';
         spinner.style.display = 'block';
-        setStatus(`Processing ${format.toUpperCase()}... this may take a moment.`, 'info');
+        setStatus(`Processing ${format.toUpperCase()}...`, 'info');
 
         try {
-            const getUrl = new URL(`${serverUrl}/api/download`);
-            getUrl.searchParams.append('url', url);
-            getUrl.searchParams.append('format', format);
+            const response = await submitJob(serverUrl, url, format);
+            const submitted = await response.json();
+            if (!response.ok) throw new Error(submitted.error || `Server error ${response.status}`);
 
+            // The browser downloads the file as soon as the job is done, even if the popup has closed by then
             chrome.downloads.download({
-                url: getUrl.toString(),
+                url: `${serverUrl}/api/jobs/${submitted.id}/file?wait=1`,
                 saveAs: false,
                 headers: [
                     { name: 'ngrok-skip-browser-warning', value: '69420' }
@@ -81,7 +149,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     return;
                 }
 
-                setStatus('Downloading to folder...', 'info');
+                const events = followJob(submitted, format);
 
                 const listener = (delta) => {
                     if (delta.id === downloadId && delta.state) {
@@ -93,7 +161,8 @@ document.addEventListener('DOMContentLoaded', () => {
                                 window.close();
                             }, 2000);
                         } else if (delta.state.current === 'interrupted') {
-                            setStatus('Download failed or cancelled.', 'error');
+                            events.close();
+                            if (!statusMessage.classList.contains('error')) setStatus('Download failed or cancelled.', 'error');
                             chrome.downloads.onChanged.removeListener(listener);
                             resetBtns();
                         }
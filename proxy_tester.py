@@ -1,62 +1,307 @@
-import requests
+import argparse
+import asyncio
+import base64
+import ipaddress
+import json
+import logging
 import random
-import concurrent.futures
+import resource
+import ssl
+import struct
+import sys
+import time
+import urllib.parse
 
-def get_proxies(url):
-    try:
-        r = requests.get(url, timeout=5)
-        return [p.strip() for p in r.text.splitlines() if p.strip()]
-    except:
-        return []
+import requests
 
-urls = [
-    "https://raw.githubusercontent.com/TheSpeedX/PROXY-List/master/socks5.txt",
+logger = logging.getLogger(__name__)
+
+# Staged proxy prober, used by app.py's proxy pool and runnable on its own:
+#
+#   python proxy_tester.py --wanted 3
+#   python proxy_tester.py --source proxies.txt --media-url https://example.com/clip.webm --json
+#
+# Each candidate goes through a funnel of cheap-to-expensive checks and is dropped at the
+# first one it fails: TCP connect to the proxy, the SOCKS5/CONNECT handshake, TLS with the
+# target, the check request (a 204 from YouTube), and optionally a small ranged media fetch
+# to measure throughput. Everything runs on one event loop, so thousands of candidates can
+# be in flight with one socket and one coroutine each.
+
+DEFAULT_SOURCES = [
     "https://raw.githubusercontent.com/TheSpeedX/PROXY-List/master/http.txt",
-    "https://raw.githubusercontent.com/ShiftyTR/Proxy-List/master/socks5.txt",
+    "https://raw.githubusercontent.com/TheSpeedX/PROXY-List/master/socks5.txt",
     "https://raw.githubusercontent.com/ShiftyTR/Proxy-List/master/http.txt",
-    "https://raw.githubusercontent.com/monosans/proxy-list/main/proxies/socks5.txt",
-    "https://raw.githubusercontent.com/monosans/proxy-list/main/proxies/http.txt"
+    "https://raw.githubusercontent.com/ShiftyTR/Proxy-List/master/socks5.txt",
+    "https://raw.githubusercontent.com/monosans/proxy-list/main/proxies/http.txt",
+    "https://raw.githubusercontent.com/monosans/proxy-list/main/proxies/socks5.txt"
 ]
+CHECK_URL = 'https://www.youtube.com/generate_204'
+STAGES = ('parse', 'tcp', 'handshake', 'tls', 'check', 'media', 'error')  # 'error': anything unexpected
+MEDIA_BYTES = 256 * 1024  # size of the ranged fetch used to measure throughput
+MAX_HEADER_LINES = 100
+
+class ProbeFailed(Exception):
+    """A candidate failed one stage of the funnel."""
+    def __init__(self, stage, reason):
+        super().__init__(f'{stage}: {reason}')
+        self.stage = stage
+
+async def _stage(stage, aw, timeout):
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except ProbeFailed:
+        raise
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, ssl.SSLError) as e:
+        raise ProbeFailed(stage, repr(e))
+
+async def _socks5_connect(reader, writer, host, port, auth=None):
+    if auth:
+        writer.write(b'\x05\x02\x00\x02')  # version 5, two methods: no authentication, username/password
+    else:
+        writer.write(b'\x05\x01\x00')  # version 5, one method: no authentication
+    version, method = await reader.readexactly(2)
+    if version != 5 or method not in (0, 2) or (method == 2 and not auth):
+        raise ProbeFailed('handshake', 'SOCKS5 proxy wants authentication')
+    if method == 2:
+        # RFC 1929 username/password subnegotiation
+        user, password = (v.encode() for v in auth)
+        if len(user) > 255 or len(password) > 255:
+            raise ProbeFailed('handshake', 'SOCKS5 credentials too long')
+        writer.write(bytes([1, len(user)]) + user + bytes([len(password)]) + password)
+        if (await reader.readexactly(2))[1] != 0:
+            raise ProbeFailed('handshake', 'SOCKS5 authentication failed')
+    try:
+        addr = ipaddress.ip_address(host)
+        dest = (b'\x01' if addr.version == 4 else b'\x04') + addr.packed
+    except ValueError:
+        dest = b'\x03' + bytes([len(host)]) + host.encode('idna')
+    writer.write(b'\x05\x01\x00' + dest + struct.pack('!H', port))
+    _, rep, _, atyp = await reader.readexactly(4)
+    if rep != 0:
+        raise ProbeFailed('handshake', f'SOCKS5 reply {rep}')
+    # Skip the bound address
+    size = {1: 4, 4: 16}.get(atyp) or (await reader.readexactly(1))[0]
+    await reader.readexactly(size + 2)
+
+async def _read_head(reader):
+    """Read an HTTP response head; returns (status, {lowercased name: value})."""
+    status_line = (await reader.readline()).decode('latin-1')
+    parts = status_line.split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ValueError(f'not an HTTP response: {status_line[:40]!r}')
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line: break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(parts[1]), headers
+
+def _proxy_authorization(auth):
+    return 'Proxy-Authorization: Basic ' + base64.b64encode(':'.join(auth).encode()).decode()
+
+async def _http_connect(reader, writer, host, port, auth=None):
+    lines = [f'CONNECT {host}:{port} HTTP/1.1', f'Host: {host}:{port}'] + ([_proxy_authorization(auth)] if auth else [])
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    status, _ = await _read_head(reader)
+    if status != 200:
+        raise ProbeFailed('handshake', f'CONNECT answered {status}')
+
+async def _open(proxy, target, timeout, stage=None):
+    """Connect to target through proxy; returns (reader, writer, request_target, request_headers).
+
+    request_headers are extra header lines the request needs (proxy credentials when it is
+    forwarded by an HTTP proxy rather than tunnelled). Failures are reported as the funnel
+    stage they happened in, or as `stage` if given.
+    """
+    # Public lists are full of junk (bad ports, stray brackets); urlsplit and .port raise ValueError on it
+    try:
+        p, t = urllib.parse.urlsplit(proxy), urllib.parse.urlsplit(target)
+        proxy_host, proxy_port = p.hostname, p.port
+        auth = (urllib.parse.unquote(p.username), urllib.parse.unquote(p.password or '')) if p.username else None
+        tls = t.scheme == 'https'
+        port = t.port or (443 if tls else 80)
+    except ValueError as e:
+        raise ProbeFailed('parse', f'{proxy!r}: {e}')
+    if p.scheme not in ('http', 'https', 'socks5', 'socks5h') or not proxy_host or not proxy_port:
+        raise ProbeFailed('parse', f'unsupported proxy {proxy!r}')
+    reader, writer = await _stage(stage or 'tcp', asyncio.open_connection(proxy_host, proxy_port), timeout)
+    try:
+        path, headers = urllib.parse.urlunsplit(('', '', t.path or '/', t.query, '')), []
+        if p.scheme.startswith('socks5'):
+            await _stage(stage or 'handshake', _socks5_connect(reader, writer, t.hostname, port, auth), timeout)
+        elif tls:
+            await _stage(stage or 'handshake', _http_connect(reader, writer, t.hostname, port, auth), timeout)
+        else:
+            path = target  # plain HTTP through an HTTP proxy uses the absolute URI, no tunnel
+            if auth: headers.append(_proxy_authorization(auth))
+        if tls:
+            await _stage(stage or 'tls', writer.start_tls(ssl.create_default_context(), server_hostname=t.hostname), timeout)
+        return reader, writer, path, headers
+    except BaseException:
+        writer.transport.abort()
+        raise
+
+async def _get(reader, writer, target, path, headers=()):
+    host = urllib.parse.urlsplit(target).netloc
+    lines = [f'GET {path} HTTP/1.1', f'Host: {host}', 'User-Agent: Mozilla/5.0', 'Connection: close', *headers]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    return await _read_head(reader)
 
-all_proxies = []
-for u in urls:
-    pts = get_proxies(u)
-    ptype = "socks5" if "socks5" in u else "http"
-    all_proxies.extend([(ptype, p) for p in pts])
-
-random.shuffle(all_proxies)
-print(f"Testing {len(all_proxies)} total proxies...")
-
-def check_proxy(proxy_info):
-    ptype, p = proxy_info
-    proxy_url = f"{ptype}://{p}"
-    proxies = {
-        'http': proxy_url,
-        'https': proxy_url
-    }
+async def probe(proxy, check_url=CHECK_URL, media_url=None, timeout=4.0):
+    """Run one candidate through the funnel.
+
+    Returns {'proxy', 'ok', 'stage', 'error', 'connect', 'latency', 'throughput'}: stage and error
+    name the first failed stage (None when ok); connect is the TCP connect time and latency the
+    time until the check URL answered, in seconds; throughput is in bytes/s when media_url is set.
+    """
+    result = {'proxy': proxy, 'ok': False, 'stage': None, 'error': None, 'connect': None, 'latency': None, 'throughput': None}
+    start = time.monotonic()
+    writer = None
     try:
-        # Check actual YouTube access instead of just a handshake
-        r = requests.get('https://www.youtube.com', proxies=proxies, timeout=5)
-        if r.status_code == 200:
-            return proxy_url
+        reader, writer, path, headers = await _open(proxy, check_url, timeout)
+        result['connect'] = round(time.monotonic() - start, 4)
+        status, _ = await _stage('check', _get(reader, writer, check_url, path, headers), timeout)
+        if status != 204:
+            raise ProbeFailed('check', f'status {status}')
+        result['latency'] = round(time.monotonic() - start, 4)
+        writer.transport.abort()
+        if media_url:
+            reader, writer, path, headers = await _open(proxy, media_url, timeout, stage='media')
+            began = time.monotonic()
+            headers.append(f'Range: bytes=0-{MEDIA_BYTES - 1}')
+            status, headers = await _stage('media', _get(reader, writer, media_url, path, headers), timeout)
+            if status not in (200, 206):
+                raise ProbeFailed('media', f'status {status}')
+            try:
+                wanted = min(MEDIA_BYTES, int(headers.get('content-length', MEDIA_BYTES)))
+            except ValueError:
+                raise ProbeFailed('media', f"bad Content-Length {headers['content-length']!r}")
+            body = await _stage('media', reader.readexactly(wanted), timeout)
+            result['throughput'] = round(len(body) / max(time.monotonic() - began, 1e-6))
+        result['ok'] = True
+    except ProbeFailed as e:
+        result['stage'], result['error'] = e.stage, str(e)
     except Exception as e:
-        pass
-    return None
-
-working = []
-tested = 0
-with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
-    # Only test the first 200 to save time
-    futures = {executor.submit(check_proxy, p): p for p in all_proxies[:200]}
-    for future in concurrent.futures.as_completed(futures):
-        res = future.result()
+        result['stage'], result['error'] = 'error', repr(e)
+    finally:
+        if writer: writer.transport.abort()
+    return result
+
+def _raise_fd_limit(wanted):
+    """Raise the soft open-files limit towards wanted; returns how many sockets we may open."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError): pass
+    return wanted if soft == resource.RLIM_INFINITY else soft
+
+async def probe_many(candidates, wanted=None, concurrency=1000, on_result=None, **probe_args):
+    """Probe candidates with up to `concurrency` in flight; returns {proxy: result} of working ones.
+
+    candidates can be any iterable and is consumed lazily, so memory stays bounded by
+    `concurrency`. Once `wanted` proxies work, probes still in flight are cancelled and their
+    sockets closed before this returns. on_result(result) is called for every finished probe.
+    """
+    concurrency = max(1, min(concurrency, _raise_fd_limit(concurrency + 64) - 64))
+    found = {}
+    candidates = iter(candidates)
+
+    async def worker():
+        for proxy in candidates:
+            # One bad candidate (or a failing on_result) must not end this worker
+            try:
+                result = await probe(proxy, **probe_args)
+                if on_result: on_result(result)
+            except Exception as e:
+                logger.warning(f"Probe of {proxy!r} failed: {e!r}")
+                continue
+            if result['ok'] and not (wanted and len(found) >= wanted):
+                found[proxy] = result
+                if wanted and len(found) >= wanted:
+                    for task in workers:
+                        if task is not asyncio.current_task(): task.cancel()
+                    return
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers, return_exceptions=True)
+    finally:
+        for task in workers: task.cancel()
+    return found
+
+def find_working(candidates, wanted=None, **kwargs):
+    """Blocking wrapper around probe_many() for threads without an event loop."""
+    return asyncio.run(probe_many(candidates, wanted, **kwargs))
+
+def parse_proxy_list(text, source=''):
+    """Proxy URLs from a list with one proxy per line; '#' starts a comment.
+
+    Lines without a scheme get socks5:// if the source name mentions socks5, http:// otherwise.
+    """
+    ptype = "socks5" if "socks5" in source else "http"
+    proxies = set()
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line: proxies.add(line if '://' in line else f"{ptype}://{line}")
+    return proxies
+
+def load_candidates(sources, timeout=10):
+    """Read proxy lists (URLs or local files) into deduplicated, shuffled proxy URLs."""
+    candidates = set()
+    session = requests.Session()  # most lists share a host; keep the connection
+    for source in sources:
+        try:
+            if urllib.parse.urlsplit(source).scheme in ('http', 'https'):
+                text = session.get(source, timeout=timeout).text
+            else:
+                with open(source) as f:
+                    text = f.read()
+        except (OSError, requests.RequestException) as e:
+            logger.warning(f"Could not read {source}: {e}")
+            continue
+        candidates.update(parse_proxy_list(text, source))
+    candidates = list(candidates)
+    random.shuffle(candidates)
+    return candidates
+
+def main():
+    parser = argparse.ArgumentParser(description='Find working proxies for reaching YouTube.')
+    parser.add_argument('--source', action='append', help='proxy list URL or file (repeatable; default: the public lists)')
+    parser.add_argument('--limit', type=int, default=0, help='probe at most this many candidates (0: all)')
+    parser.add_argument('--wanted', type=int, default=0, help='stop after this many working proxies (0: probe everything)')
+    parser.add_argument('--concurrency', type=int, default=1000, help='probes in flight')
+    parser.add_argument('--timeout', type=float, default=4.0, help='seconds allowed for each stage')
+    parser.add_argument('--check-url', default=CHECK_URL, help='URL that must answer 204 through the proxy')
+    parser.add_argument('--media-url', help='also fetch the first 256 KiB of this URL to measure throughput')
+    parser.add_argument('--json', action='store_true', help='print working proxies as JSON lines')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s')
+
+    candidates = load_candidates(args.source or DEFAULT_SOURCES)
+    if args.limit: candidates = candidates[:args.limit]
+    print(f"Testing {len(candidates)} total proxies...", file=sys.stderr)
+    failed_at = dict.fromkeys(STAGES, 0)
+    tested = 0
+
+    def on_result(result):
+        nonlocal tested
         tested += 1
-        if res:
-            working.append(res)
-            print(f"FOUND WORKING: {res}")
-            if len(working) >= 3:
-                break
-        if tested % 50 == 0:
-            print(f"Tested {tested}...")
-
-print(f"Done. Found {len(working)} working: {working}")
+        if result['ok']:
+            print(json.dumps(result) if args.json else f"FOUND WORKING: {result['proxy']} ({result['latency']:.2f}s)", flush=True)
+        else:
+            failed_at[result['stage']] += 1
+        if tested % 500 == 0:
+            print(f"Tested {tested}...", file=sys.stderr)
+
+    started = time.monotonic()
+    working = find_working(candidates, args.wanted or None, concurrency=args.concurrency, on_result=on_result,
+                           check_url=args.check_url, media_url=args.media_url, timeout=args.timeout)
+    print(f"Done in {time.monotonic() - started:.1f}s. Found {len(working)} working of {tested} tested; "
+          f"failed at {', '.join(f'{k}: {v}' for k, v in failed_at.items() if v) or 'no stage'}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -42,21 +42,91 @@ document.addEventListener('DOMContentLoaded', () => {
         handleDownload('mp4', mp4Btn);
     });
 
-    async function handleDownload(format, btn) {
-        const url = urlInput.value.trim();
-        if (!url) return;
+    function formatBytes(bytes) {
+        if (!bytes) return '0 B';
+        const units = ['B', 'KB', 'MB', 'GB'];
+        const i = Math.min(Math.floor(Math.log(bytes) / Math.log(1024)), units.length - 1);
+        return `${(bytes / Math.pow(1024, i)).toFixed(1)} ${units[i]}`;
+    }
 
-        setLoading(true, btn, `Processing ${format.toUpperCase()}... this may take up to a minute.`);
-        clearStatus();
+    function describeProgress(job, format) {
+        const p = job.progress || {};
+        const attempt = p.attempt > 1 ? ` (attempt ${p.attempt}/${p.attempts})` : '';
+        switch (job.state) {
+            case 'queued':
+                return p.transcode_slot === false ? 'Waiting for a free converter...' : 'Waiting for a free worker...';
+            case 'extracting':
+                return `Looking up the video${attempt}...`;
+            case 'downloading': {
+                let text = `Downloading ${formatBytes(p.downloaded_bytes)}`;
+                if (p.total_bytes) text += ` of ${formatBytes(p.total_bytes)} (${Math.round(100 * p.downloaded_bytes / p.total_bytes)}%)`;
+                if (p.speed) text += ` at ${formatBytes(p.speed)}/s`;
+                if (p.eta) text += `, ${p.eta}s left`;
+                return text + attempt;
+            }
+            case 'transcoding':
+                return `Converting to ${format.toUpperCase()}...`;
+            default:
+                return `Processing ${format.toUpperCase()}...`;
+        }
+    }
 
-        try {
-            const response = await fetch('/api/download', {
+    function waitForJob(job, format) {
+        return new Promise((resolve, reject) => {
+            const events = new EventSource(job.events_url);
+            events.addEventListener('progress', (e) => {
+                setStatus(describeProgress(JSON.parse(e.data), format), 'loading');
+            });
+            events.addEventListener('done', (e) => {
+                events.close();
+                resolve(JSON.parse(e.data));
+            });
+            events.addEventListener('failed', (e) => {
+                events.close();
+                reject(new Error(JSON.parse(e.data).error || `Failed to download ${format}`));
+            });
+            events.onerror = () => {
+                // The browser reconnects on its own; only give up if the stream was closed for good
+                if (events.readyState === EventSource.CLOSED) reject(new Error('Lost connection to the server.'));
+            };
+        });
+    }
+
+    // A saturated server answers 429/503 with Retry-After; wait that long (plus jitter) and resubmit
+    const MAX_SUBMIT_ATTEMPTS = 5;
+
+    async function retryDelay(response, attempt) {
+        let seconds = parseInt(response.headers.get('Retry-After'), 10);
+        if (!seconds) {
+            try { seconds = (await response.clone().json()).retry_after; } catch (e) { }
+        }
+        return (seconds || 2 ** attempt) * (1 + Math.random() * 0.25);
+    }
+
+    async function submitJob(url, format) {
+        for (let attempt = 1; ; attempt++) {
+            const response = await fetch('/api/jobs', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
                 body: JSON.stringify({ url, format })
             });
+            if ((response.status !== 429 && response.status !== 503) || attempt >= MAX_SUBMIT_ATTEMPTS) return response;
+            const delay = await retryDelay(response, attempt);
+            setStatus(`Server is busy, retrying in ${Math.ceil(delay)}s...`, 'loading');
+            await new Promise(resolve => setTimeout(resolve, delay * 1000));
+        }
+    }
+
+    async function handleDownload(format, btn) {
+        const url = urlInput.value.trim();
+        if (!url) return;
+
+        setLoading(true, btn, `Processing ${format.toUpperCase()}...`);
+
+        try {
+            const response = await submitJob(url, format);
 
             if (!response.ok) {
                 let errorMessage = `Failed to download ${format}`;
@@ -69,32 +139,16 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errorMessage);
             }
 
-            // Update status for streaming phase
-            setStatus(`Streaming ${format.toUpperCase()} to browser...`, 'loading');
-
-            const contentDisposition = response.headers.get('Content-Disposition');
-            let filename = `file.${format}`;
-            if (contentDisposition && contentDisposition.includes('attachment')) {
-                const filenameMatch = contentDisposition.match(/filename="?(.+)"?/);
-                if (filenameMatch && filenameMatch.length === 2) {
-                    filename = filenameMatch[1];
-                }
-            }
-
-            const blob = await response.blob();
+            const job = await waitForJob(await response.json(), format);
 
-            // Final phase: saving file
+            // The server keeps the finished file around, so let the browser download it directly
             setStatus('Saving file...', 'loading');
-
-            const downloadUrl = window.URL.createObjectURL(blob);
             const a = document.createElement('a');
             a.style.display = 'none';
-            a.href = downloadUrl;
-            a.download = filename;
+            a.href = job.file_url;
+            a.download = job.download_name || `file.${format}`;
             document.body.appendChild(a);
             a.click();
-
-            window.URL.revokeObjectURL(downloadUrl);
             document.body.removeChild(a);
 
             setStatus('Download complete!', 'success');
@@ -0,0 +1,16 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# Importing app starts background threads; keep them off the network during tests
+os.environ.setdefault('PROXY_POOL_ENABLED', '0')
+os.environ.setdefault('YTDLP_OFFLINE_COMPONENTS', '1')
+os.environ.pop('FLASK_ENV', None)
+# Keep caches, jobs, locks and cookies out of the working tree
+_workdir = tempfile.mkdtemp(prefix='streamrip-tests-')
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.environ['DOWNLOAD_FOLDER'] = os.path.join(_workdir, 'downloads')
+os.environ['COOKIES_FILE'] = os.path.join(_workdir, 'cookies.txt')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,13 @@
+import io
+
+from werkzeug.wrappers import Request
+
+import asgi
+
+
+def test_chunked_request_body_reaches_flask():
+    # No Content-Length header: the client sent the body with Transfer-Encoding: chunked
+    scope = {'type': 'http', 'method': 'POST', 'path': '/api/jobs', 'query_string': b'', 'http_version': '1.1',
+             'headers': [(b'content-type', b'application/json'), (b'transfer-encoding', b'chunked')]}
+    request = Request(asgi._environ(scope, io.BytesIO(b'{"url": "https://x.com/a/status/1"}')))
+    assert request.get_json() == {'url': 'https://x.com/a/status/1'}
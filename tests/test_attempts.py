@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+import yt_dlp
+
+import app
+
+YOUTUBE = 'https://www.youtube.com/watch?v=abc'
+PLAN = [(['android'], 'direct'), (['tv', 'mweb'], 'direct'), (['ios', 'android'], 'direct')]
+
+
+@pytest.fixture(autouse=True)
+def offline_attempts(monkeypatch):
+    monkeypatch.setattr(app, 'plan_strategies', lambda url: list(PLAN) if 'youtube' in url else [None])
+    monkeypatch.setattr(app, '_configure_attempt', lambda opts, url, strategy, avoid=(): (None, None))
+    monkeypatch.setattr(app, 'HEDGE_AFTER', 0.2)
+    monkeypatch.setattr(app, 'RETRY_POLICIES', {k: p._replace(backoff=0) for k, p in app.RETRY_POLICIES.items()})
+
+
+def extractor_error(msg, expected=True):
+    e = yt_dlp.utils.ExtractorError(msg, expected=expected)
+    return yt_dlp.utils.DownloadError(f'ERROR: {msg}', (type(e), e, None))
+
+
+def test_stalled_attempt_without_hedge_candidate_still_finishes():
+    # Non-YouTube plans are [None]: there is nothing to race, so the stalled attempt is simply awaited
+    def run(attempt):
+        time.sleep(0.5)
+        return 'done'
+    result, attempt = app.run_attempts('https://www.instagram.com/p/abc/', {}, run)
+    assert result == 'done' and attempt.number == 1
+
+
+def test_hedge_wins_against_stalled_attempt_and_loser_is_cleaned_up():
+    release, cleaned = threading.Event(), []
+    def run(attempt):
+        if attempt.strategy == PLAN[0]:
+            release.wait(5)
+            attempt.progress()  # raises once the attempt has lost
+            return 'slow'
+        return 'fast'
+    result, attempt = app.run_attempts(YOUTUBE, {}, run, cleanup=cleaned.append)
+    assert result == 'fast' and attempt.number == 2
+    release.set()
+    for _ in range(50):
+        if cleaned: break
+        time.sleep(0.02)
+    assert [a.strategy for a in cleaned] == [PLAN[0]]
+
+
+def test_permanent_error_fails_after_one_attempt():
+    calls = []
+    def run(attempt):
+        calls.append(attempt.strategy)
+        raise extractor_error('Video unavailable')
+    with pytest.raises(app.DownloadError) as e:
+        app.run_attempts(YOUTUBE, {}, run)
+    assert len(calls) == 1
+    assert (e.value.status, e.value.error_class) == (422, 'permanent')
+
+
+def test_client_failure_moves_to_other_clients():
+    seen = []
+    def run(attempt):
+        seen.append(attempt.strategy)
+        if len(seen) == 1: raise extractor_error('Requested format is not available')
+        return 'ok'
+    assert app.run_attempts(YOUTUBE, {}, run)[0] == 'ok'
+    assert seen[0][0] != seen[1][0]
+
+
+def test_attempts_are_capped():
+    calls = []
+    def run(attempt):
+        calls.append(attempt.number)
+        raise extractor_error('Sign in to confirm you’re not a bot')
+    with pytest.raises(app.DownloadError) as e:
+        app.run_attempts(YOUTUBE, {}, run)
+    assert len(calls) == app.DOWNLOAD_ATTEMPTS
+    assert e.value.error_class == 'bot_check'
+
+
+def test_plan_hedge_prefers_other_route_and_respects_cap():
+    plan = app._AttemptPlan(YOUTUBE)
+    plan.plan = [(['android'], 'direct'), (['tv'], 'direct'), (['android'], 'proxy')]
+    assert plan.hedge([(['android'], 'direct')]) == (['android'], 'proxy')
+    plan.attempts = app.DOWNLOAD_ATTEMPTS
+    assert plan.hedge([(['android'], 'direct')]) is None
+    assert app._AttemptPlan('https://example.com/a.mp4').hedge([None]) is None
+
+
+def test_hedge_skips_strategies_that_already_failed(monkeypatch):
+    plan = [(['android'], 'direct'), (['ios', 'android'], 'direct'), (['android'], 'direct')]
+    monkeypatch.setattr(app, 'plan_strategies', lambda url: list(plan))
+    seen = []
+    def run(attempt):
+        seen.append(attempt.strategy)
+        if len(seen) == 1: raise extractor_error('Sign in to confirm you’re not a bot')
+        time.sleep(0.5)  # stalls past HEDGE_AFTER
+        return 'ok'
+    assert app.run_attempts(YOUTUBE, {}, run)[0] == 'ok'
+    assert seen == plan[:2]
+
+
+def test_plan_hedge_searches_from_current_position():
+    plan = app._AttemptPlan(YOUTUBE)
+    plan.plan = [(['tv'], 'proxy'), (['android'], 'direct'), (['ios'], 'proxy')]
+    plan.index = 1
+    assert plan.hedge([(['android'], 'direct')]) == (['ios'], 'proxy')
+
+
+def test_loser_finishing_alongside_the_winner_is_cleaned_up():
+    for _ in range(10):
+        release, cleaned = threading.Event(), []
+        def run(attempt):
+            if attempt.strategy == PLAN[0]:
+                release.wait(5)
+                return 'slow'  # finishes without calling progress(), right as the hedge wins
+            release.set()
+            return 'fast'
+        result, winner = app.run_attempts(YOUTUBE, {}, run, cleanup=cleaned.append)
+        for _ in range(50):
+            if cleaned: break
+            time.sleep(0.02)
+        assert len(cleaned) == 1 and cleaned[0] is not winner
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+import app
+
+URL = 'https://www.instagram.com/p/abc/'
+
+
+@pytest.fixture
+def cached(monkeypatch, tmp_path):
+    key = f'test-{tmp_path.name}'
+    monkeypatch.setattr(app, 'result_cache_key', lambda url, fmt: key)
+    src = tmp_path / 'clip.mp3'
+    src.write_bytes(b'ID3cached')
+    app.publish_result(key, 'mp3', str(src), 'clip.mp3')
+    return key
+
+
+@pytest.mark.parametrize('stream', ['0', '1'])
+def test_cache_hit_is_sent_without_the_job_pool(cached, monkeypatch, stream):
+    monkeypatch.setattr(app, 'submit_job', lambda *a, **k: pytest.fail('cache hit went through the job pool'))
+    monkeypatch.setattr(app, 'stream_transcode', lambda *a, **k: pytest.fail('cache hit was transcoded'))
+    response = app.app.test_client().get('/api/download', query_string={'url': URL, 'stream': stream})
+    assert response.status_code == 200 and response.data == b'ID3cached'
+    assert response.headers['ETag']
+
+
+def test_job_file_wait_holds_the_request_until_the_job_is_done(monkeypatch, tmp_path):
+    src = tmp_path / 'clip.mp3'
+    src.write_bytes(b'ID3job')
+    def run_download(url, fmt, on_stage):
+        time.sleep(0.5)
+        return {'path': str(src), 'download_name': 'clip.mp3', 'mimetype': 'audio/mpeg', 'cached': False, 'sha256': 'x'}
+    monkeypatch.setattr(app, 'run_download', run_download)
+    job, _ = app.submit_job(URL, 'mp3')
+    client = app.app.test_client()
+    assert client.get(f"/api/jobs/{job['id']}/file").status_code == 409
+    response = client.get(f"/api/jobs/{job['id']}/file", query_string={'wait': '1'})
+    assert response.status_code == 200 and response.data == b'ID3job'
+
+
+@pytest.mark.parametrize('urls', ['https://x.com/a/status/1', {'https://x.com/a/status/1': 1}, [], ['']])
+def test_batch_requires_a_list_of_urls(urls):
+    response = app.app.test_client().post('/api/batch', json={'urls': urls})
+    assert response.status_code == 400 and response.get_json() == {'error': 'URL list required'}
@@ -0,0 +1,51 @@
+import pytest
+import requests
+import yt_dlp
+
+import app
+
+
+def ytdlp_error(e):
+    """Wrap e the way YoutubeDL.extract_info reports it."""
+    return yt_dlp.utils.DownloadError(f'ERROR: {e}', (type(e), e, None))
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f'{status} error', response=response)
+
+
+def chained(outer, cause):
+    try:
+        try:
+            raise cause
+        except Exception as e:
+            raise outer from e
+    except Exception as e:
+        return e
+
+
+@pytest.mark.parametrize('error, expected', [
+    (app.DownloadError('Server is busy', 503, 'overloaded'), 'overloaded'),
+    (ytdlp_error(yt_dlp.networking.exceptions.ProxyError('refused')), 'proxy_failure'),
+    (chained(RuntimeError('fetch failed'), http_error(429)), 'throttled'),
+    (http_error(407), 'proxy_failure'),
+    (http_error(403), 'bot_check'),
+    (http_error(410), 'permanent'),
+    (http_error(502), 'transient'),
+    (ytdlp_error(yt_dlp.utils.UnsupportedError('https://example.com/')), 'permanent'),
+    (ytdlp_error(yt_dlp.utils.ExtractorError("Sign in to confirm you're not a bot", expected=True)), 'bot_check'),
+    (ytdlp_error(yt_dlp.utils.ExtractorError('Requested format is not available', expected=True)), 'client_failure'),
+    (ytdlp_error(yt_dlp.utils.ExtractorError('Video unavailable', expected=True)), 'permanent'),
+    (ytdlp_error(yt_dlp.utils.ExtractorError('Unable to extract player response')), 'client_failure'),
+    (ValueError('something else'), 'transient'),
+])
+def test_classify_error(error, expected):
+    assert app.classify_error(error) == expected
+
+
+def test_connection_errors_count_against_the_proxy_only_when_one_was_used():
+    error = ytdlp_error(yt_dlp.networking.exceptions.TransportError('connection reset'))
+    assert app.classify_error(error) == 'transient'
+    assert app.classify_error(error, via_proxy=True) == 'proxy_failure'
@@ -0,0 +1,43 @@
+import os
+import time
+
+import pytest
+
+import app
+
+
+def test_cleanup_info_drops_expired_entries_and_caps_the_directory(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'INFO_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'INFO_DISK_ENTRIES', 2)
+    monkeypatch.setattr(app, '_last_info_cleanup', 0)
+    now = time.time()
+    ages = {'expired.json': app.INFO_TTL + 10, 'old.json': 30, 'newer.json': 20, 'newest.json': 10,
+            'abandoned.json.abc.tmp': app.INFO_TTL + 10}
+    for name, age in ages.items():
+        (tmp_path / name).write_text('{}')
+        os.utime(tmp_path / name, (now - age, now - age))
+    app.cleanup_info()
+    assert sorted(os.listdir(tmp_path)) == ['newer.json', 'newest.json']
+
+
+def test_failed_download_from_cached_info_removes_its_partial_files(monkeypatch):
+    class FailingYDL:
+        def __init__(self, opts):
+            self.opts = opts
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def process_ie_result(self, info, download):
+            with open(self.opts['outtmpl'].replace('%(title)s', 'clip').replace('%(ext)s', 'webm.part'), 'wb') as f:
+                f.write(b'partial')
+            raise OSError('stream URL expired')
+    def no_retry(url, ydl_opts, run, cleanup=None):
+        raise app.DownloadError('stop here', 502)
+    monkeypatch.setattr(app, 'get_cached_info', lambda url, with_urls=False: ({'title': 'clip'}, None))
+    monkeypatch.setattr(app, 'new_ydl', FailingYDL)
+    monkeypatch.setattr(app, 'run_attempts', no_retry)
+    before = set(os.listdir(app.DOWNLOAD_FOLDER))
+    with pytest.raises(app.DownloadError):
+        app._download_uncached('https://www.instagram.com/p/abc/', 'mp3', None, lambda state, **progress: None)
+    assert set(os.listdir(app.DOWNLOAD_FOLDER)) == before
@@ -0,0 +1,35 @@
+import threading
+
+import app
+
+
+class FakeProcess:
+    def __init__(self, script_hash='h'):
+        self.script_hash, self.tasks, self.closed = script_hash, 0, False
+        self.pinging, self.answer = threading.Event(), threading.Event()
+
+    def expired(self):
+        return False
+
+    def call(self, msg, timeout=None):
+        self.pinging.set()
+        self.answer.wait(5)
+        return {'type': 'pong'}
+
+    def close(self):
+        self.closed = True
+
+
+def test_health_check_keeps_pinged_process_counted_against_the_pool():
+    pool = app.JSSolverPool(1)
+    proc = FakeProcess()
+    pool._idle.append(proc)
+    checker = threading.Thread(target=pool._check_idle)
+    checker.start()
+    assert proc.pinging.wait(5)
+    # solve() would have to wait here instead of spawning a second process
+    assert not pool._slots.acquire(blocking=False)
+    proc.answer.set()
+    checker.join(5)
+    assert pool._idle == [proc] and not proc.closed
+    assert pool._slots.acquire(blocking=False)
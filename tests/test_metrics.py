@@ -0,0 +1,28 @@
+import json
+import os
+import subprocess
+import time
+
+import app
+
+
+def metrics_file(directory, pid, count):
+    path = directory / f'{pid}-1.json'
+    key = app._labels_key({'outcome': 'ok'})
+    path.write_text(json.dumps({'counter': {'streamrip_downloads_total': {key: count}}, 'histogram': {}}))
+    old = time.time() - 60
+    os.utime(path, (old, old))
+    return path
+
+
+def test_files_of_exited_workers_are_rolled_up(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'METRICS_ROLLUP', str(tmp_path / 'rollup.json'))
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    metrics_file(tmp_path, exited.pid, 3)
+    metrics_file(tmp_path, exited.pid + 1000000, 4)  # no such pid either
+    live = metrics_file(tmp_path, os.getpid(), 5)
+    for _ in range(2):
+        assert 'streamrip_downloads_total{outcome="ok"} 12' in app.render_metrics()
+    assert sorted(os.listdir(tmp_path)) == sorted(['rollup.json', live.name])
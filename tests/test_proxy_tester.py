@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import benchmark
+import proxy_tester
+
+
+@pytest.fixture(scope='module')
+def internet():
+    inet = benchmark._serve(benchmark.FakeInternet(('127.0.0.1', 0), benchmark.make_wav(1), benchmark.Fault(),
+                                                   benchmark.Fault(), {}))
+    proxy = benchmark._serve(benchmark.ProxyServer(('127.0.0.1', 0), benchmark._HTTPProxyHandler, benchmark.Fault()))
+    socks = benchmark._serve(benchmark.ProxyServer(('127.0.0.1', 0), benchmark._SOCKS5Handler, benchmark.Fault()))
+    yield f'http://127.0.0.1:{inet.server_address[1]}', f'http://127.0.0.1:{proxy.port}', f'socks5://127.0.0.1:{socks.port}'
+    for server in (inet, proxy, socks): server.shutdown()
+
+
+def test_malformed_candidates_fail_at_parse_without_stopping_workers(internet):
+    origin, http_proxy, socks_proxy = internet
+    junk = ['http://1.2.3.4:99999', 'http://[bad', 'ftp://1.2.3.4:21', 'garbage']
+    results = []
+    found = proxy_tester.find_working(junk + [http_proxy, socks_proxy], concurrency=2, on_result=results.append,
+                                      check_url=f'{origin}/generate_204', timeout=2)
+    assert set(found) == {http_proxy, socks_proxy}
+    assert len(results) == 6
+    assert sorted(r['stage'] for r in results if not r['ok']) == ['parse'] * 4
+
+
+def test_stages_and_media_throughput(internet):
+    origin, http_proxy, _ = internet
+    ok = proxy_tester.find_working([http_proxy], check_url=f'{origin}/generate_204',
+                                   media_url=f'{origin}/media/a.wav', timeout=2)[http_proxy]
+    assert ok['latency'] is not None and ok['throughput'] > 0
+    results = []
+    proxy_tester.find_working(['http://127.0.0.1:1'], on_result=results.append, check_url=f'{origin}/generate_204', timeout=2)
+    assert results[0]['stage'] == 'tcp'
+
+
+def test_wanted_stops_early(internet):
+    origin, http_proxy, socks_proxy = internet
+    found = proxy_tester.find_working([http_proxy, socks_proxy], 1, check_url=f'{origin}/generate_204', timeout=2)
+    assert len(found) == 1
+
+
+def test_parse_proxy_list():
+    text = '1.1.1.1:80\n  # comment\nsocks5://2.2.2.2:1080 # tail\n\n1.1.1.1:80\n'
+    assert proxy_tester.parse_proxy_list(text, 'lists/http.txt') == {'http://1.1.1.1:80', 'socks5://2.2.2.2:1080'}
+    assert proxy_tester.parse_proxy_list('3.3.3.3:1', 'socks5.txt') == {'socks5://3.3.3.3:1'}
+
+
+@pytest.mark.parametrize('handler, scheme', [(benchmark._HTTPProxyHandler, 'http'), (benchmark._SOCKS5Handler, 'socks5')])
+def test_proxy_credentials(internet, handler, scheme):
+    origin = internet[0]
+    server = benchmark._serve(benchmark.ProxyServer(('127.0.0.1', 0), handler, benchmark.Fault(), auth=('us er', 'p@ss')))
+    try:
+        def run(proxy, url):
+            return asyncio.run(proxy_tester.probe(proxy, check_url=f'{url}/generate_204', media_url=f'{url}/media/a.wav', timeout=2))
+        good = f'{scheme}://us%20er:p%40ss@127.0.0.1:{server.port}'
+        assert run(good, origin)['ok']
+        for proxy in (f'{scheme}://127.0.0.1:{server.port}', f'{scheme}://us%20er:wrong@127.0.0.1:{server.port}'):
+            result = run(proxy, origin)
+            # Plain HTTP is forwarded without a tunnel, so the HTTP proxy's 407 answers the check itself
+            assert not result['ok'] and result['stage'] == ('handshake' if scheme == 'socks5' else 'check')
+    finally:
+        server.shutdown()
+
+
+def test_failing_on_result_is_logged_and_probing_continues(internet, caplog):
+    origin, http_proxy, socks_proxy = internet
+    def on_result(result):
+        raise RuntimeError('callback broke')
+    found = proxy_tester.find_working([http_proxy, socks_proxy], concurrency=1, on_result=on_result,
+                                      check_url=f'{origin}/generate_204', timeout=2)
+    assert found == {}  # results whose callback failed are skipped, but every candidate was probed
+    assert len([r for r in caplog.records if r.name == 'proxy_tester' and 'callback broke' in r.getMessage()]) == 2
@@ -0,0 +1,54 @@
+import json
+import time
+
+import app
+
+
+def test_compaction_skips_bad_lines_and_keeps_the_file_for_open_writers(monkeypatch, tmp_path):
+    log = tmp_path / 'strategy_events.jsonl'
+    monkeypatch.setattr(app, 'STRATEGY_LOG', str(log))
+    now = time.time()
+    log.write_text(json.dumps({'s': 'old', 'ok': True, 't': 1, 'ts': now - app.STRATEGY_WINDOW - 60}) + '\n'
+                   + '{"s": "torn\n'
+                   + json.dumps({'s': 'new', 'ok': True, 't': 1, 'ts': now}) + '\n')
+    writer = open(log, 'a')  # a worker that opened the log before compaction
+    app._compact_strategy_log()
+    writer.write(json.dumps({'s': 'late', 'ok': False, 't': 2, 'ts': now}) + '\n')
+    writer.close()
+    assert [json.loads(l)['s'] for l in log.read_text().splitlines()] == ['new', 'late']
+
+
+def event(s, age):
+    return json.dumps({'s': s, 'ok': True, 't': 1, 'ts': time.time() - age}) + '\n'
+
+
+def test_events_are_read_incrementally_and_reloaded_after_compaction(monkeypatch, tmp_path):
+    log = tmp_path / 'strategy_events.jsonl'
+    monkeypatch.setattr(app, 'STRATEGY_LOG', str(log))
+    monkeypatch.setattr(app, '_strategy_events', app.deque())
+    monkeypatch.setattr(app, '_strategy_log_offset', 0)
+    monkeypatch.setattr(app, '_strategy_log_head', None)
+    log.write_text(event('stale', 3 * app.STRATEGY_WINDOW) + event('a', 10))
+    app._load_strategy_events()
+    with open(log, 'a') as f:
+        f.write(event('b', 5) + '{"s": "half-writ')
+    app._load_strategy_events()
+    assert [e['s'] for e in app._strategy_events] == ['a', 'b']
+    offset = app._strategy_log_offset
+    app._load_strategy_events()
+    assert app._strategy_log_offset == offset and len(app._strategy_events) == 2
+    app._compact_strategy_log()
+    app._load_strategy_events()
+    assert [e['s'] for e in app._strategy_events] == ['a', 'b']
+
+
+def test_log_is_compacted_only_when_large_and_two_windows_old(monkeypatch, tmp_path):
+    log = tmp_path / 'strategy_events.jsonl'
+    monkeypatch.setattr(app, 'STRATEGY_LOG', str(log))
+    monkeypatch.setattr(app, 'STRATEGY_LOG_COMPACT_BYTES', 100)
+    log.write_text(event('recent', 1.5 * app.STRATEGY_WINDOW) * 5)
+    app.record_strategy('new', True, 1)
+    assert len(log.read_text().splitlines()) == 6  # oldest event is not two windows old yet
+    log.write_text(event('stale', 3 * app.STRATEGY_WINDOW) * 5)
+    app.record_strategy('new', True, 1)
+    assert [json.loads(l)['s'] for l in log.read_text().splitlines()] == ['new']
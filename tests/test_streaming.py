@@ -0,0 +1,71 @@
+import fcntl
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+
+URL = 'https://www.instagram.com/p/abc/'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'result_cache_key', lambda url, fmt: None)
+    monkeypatch.setattr(app, 'extract_stream_source', lambda url: ({'url': 'http://127.0.0.1:9/', 'title': 'clip'}, None))
+    monkeypatch.setattr(app, 'TRANSCODE_SLOTS', 1)
+    monkeypatch.setattr(app, 'TRANSCODE_QUEUE_TIMEOUT', 0)
+    return app.app.test_client()
+
+
+@pytest.fixture
+def busy_slot():
+    fd = os.open(os.path.join(app.LOCK_DIR, 'transcode-slot-0.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    yield
+    os.close(fd)
+
+
+def test_stream_without_free_slot_is_refused_before_sending_audio(client, busy_slot):
+    response = client.get('/api/download', query_string={'url': URL, 'stream': '1'})
+    assert response.status_code == 503
+    assert response.is_json and 'busy' in response.get_json()['error']
+
+
+def test_stream_counts_against_client_limit_until_closed(client, monkeypatch):
+    monkeypatch.setattr(app, 'ADMIT_PER_CLIENT', 1)
+    parts = []
+    def produce(url, info, proxy, out, *args):
+        # Write the first bytes and never finish, so the stream stays open
+        parts.append(out.name)
+        out.write(b'ID3')
+        out.close()
+        args[-1].__exit__(None, None, None)
+    monkeypatch.setattr(app, '_produce_stream', produce)
+    first = client.get('/api/download', query_string={'url': URL, 'stream': '1'}, buffered=False)
+    assert first.status_code == 200
+    assert app._client_jobs == {'127.0.0.1': 1} and app._queued_jobs == 0
+    assert client.get('/api/download', query_string={'url': URL, 'stream': '1'}).status_code == 429
+    first.close()
+    assert app._client_jobs == {}
+    os.remove(parts[0])
+
+
+def test_refused_stream_releases_its_client_slot(client, busy_slot):
+    assert client.get('/api/download', query_string={'url': URL, 'stream': '1'}).status_code == 503
+    assert app._client_jobs == {} and app._queued_jobs == 0
+
+
+def test_failed_stream_leaves_no_cache_entry_behind(monkeypatch, tmp_path):
+    key = f'stream-{tmp_path.name}'
+    monkeypatch.setattr(app, 'result_cache_key', lambda url, fmt: key)
+    monkeypatch.setattr(app, 'extract_stream_source', lambda url: ({'url': 'http://127.0.0.1:9/', 'title': 'clip'}, None))
+    popen = subprocess.Popen
+    # ffmpeg that reads its input and fails
+    monkeypatch.setattr(app.subprocess, 'Popen', lambda args, **kwargs: popen(
+        [sys.executable, '-c', 'import sys; sys.stdin.buffer.read(); sys.exit(1)'], **kwargs))
+    download_name, body = app.stream_transcode(URL)
+    assert download_name == 'clip.mp3' and b''.join(body) == b''
+    path, meta_path = app._result_cache_paths(key, 'mp3')
+    assert not os.path.exists(meta_path) and not os.path.exists(f'{path}.part')
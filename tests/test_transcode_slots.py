@@ -0,0 +1,44 @@
+import fcntl
+import os
+import threading
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def one_slot(monkeypatch):
+    monkeypatch.setattr(app, 'TRANSCODE_SLOTS', 1)
+    fd = os.open(os.path.join(app.LOCK_DIR, 'transcode-slot-0.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    yield lambda: os.close(fd)
+    try: os.close(fd)
+    except OSError: pass
+
+
+def test_waiters_get_the_slot_in_arrival_order(one_slot):
+    order = []
+    def wait(n):
+        with app.transcode_slot():
+            order.append(n)
+            time.sleep(0.05)
+    threads = []
+    for n in range(4):
+        threads.append(threading.Thread(target=wait, args=(n,)))
+        threads[-1].start()
+        time.sleep(0.05)
+    one_slot()
+    for t in threads: t.join(5)
+    assert order == [0, 1, 2, 3]
+    assert os.listdir(app.TRANSCODE_QUEUE_DIR) == []
+
+
+def test_abandoned_ticket_does_not_block_the_queue(one_slot):
+    # A waiter that died leaves its ticket file behind with no lock on it
+    open(os.path.join(app.TRANSCODE_QUEUE_DIR, f'{0:020d}-dead'), 'w').close()
+    one_slot()
+    with app.transcode_slot():
+        pass
+    assert os.listdir(app.TRANSCODE_QUEUE_DIR) == []